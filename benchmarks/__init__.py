@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+'''
+Performance benchmarks for bsonrpc. Not part of the installed package.
+
+Run e.g. ``python -m benchmarks.proxy_overhead`` from the project root.
+'''
+__license__ = 'http://mozilla.org/MPL/2.0/'
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Memory allocated per request round trip, measured with tracemalloc.
+
+Reports:
+
+* peak: extra memory allocated at peak during one round trip
+  (averaged over the measured round trips)
+* in-flight: memory held by one pending request on the client side,
+  measured with many requests waiting for a blocked handler
+
+Usage: ``python -m benchmarks.allocations [-n CALLS]``
+'''
+from __future__ import print_function
+
+import argparse
+import socket
+import threading
+import tracemalloc
+
+from bsonrpc import BSONRpc, JSONRpc, request, service_class
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+@service_class
+class BlockingServices(object):
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+
+    @request
+    def echo(self, value):
+        self.gate.wait()
+        return value
+
+
+def _peak_per_round_trip(proxy, calls):
+    total = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        proxy.echo('hello')
+        total += tracemalloc.get_traced_memory()[1] - start
+    return total / float(calls)
+
+
+def _in_flight_per_request(services, proxy, count):
+    services.gate.clear()
+    threads = [threading.Thread(target=proxy.echo, args=('hello',))
+               for _ in range(count)]
+    for thr in threads:  # Threads themselves are not measured.
+        thr.daemon = True
+    before = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, '*bsonrpc*')])
+    for thr in threads:
+        thr.start()
+    while len(proxy._rpc.dispatcher._pending) < count:
+        threading.Event().wait(0.01)
+    after = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, '*bsonrpc*')])
+    services.gate.set()
+    for thr in threads:
+        thr.join()
+    held = sum(stat.size_diff for stat in after.compare_to(before, 'lineno'))
+    return held / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--calls', type=int, default=1000,
+                        help='Round trips to measure. (default: 1000)')
+    parser.add_argument('--in-flight', type=int, default=200,
+                        help='Concurrent pending requests. (default: 200)')
+    args = parser.parse_args()
+    tracemalloc.start()
+    for rpc_cls in (JSONRpc, BSONRpc):
+        s1, s2 = socket.socketpair()
+        services = BlockingServices()
+        srv = rpc_cls(s1, services)
+        cli = rpc_cls(s2)
+        proxy = cli.get_peer_proxy()
+        proxy.echo('warm-up')
+        peak = _peak_per_round_trip(proxy, args.calls)
+        in_flight = _in_flight_per_request(services, proxy, args.in_flight)
+        print(rpc_cls.__name__)
+        print('  peak per round trip     %8.0f bytes' % peak)
+        print('  held per pending call   %8.0f bytes' % in_flight)
+        cli.close()
+        srv.join()
+        cli.join()
+
+
+if __name__ == '__main__':
+    main()
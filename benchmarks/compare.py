@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+Compare two runs of ``benchmarks.suite`` and flag regressions.
+
+Cases (codec/framing, threading model, transport, workload, payload size
+and concurrency) found in both runs are compared on:
+
+* throughput: the rates of the repetitions of the case (``--repeat`` of
+  the suite, at least 5 per run for significance at the default
+  ``--alpha`` of 1%)
+* latency: the subsamples of call latencies
+
+A difference is flagged if the two-sided Mann-Whitney U test finds it
+significant (p < ``--alpha``) and the medians differ by more than
+``--threshold`` (relative). Environment differences of the runs (Python,
+codec backends, CPU count, ...) are printed first, as they may explain
+differences.
+
+Exits with status 1 if any case regressed.
+
+Usage: ``python -m benchmarks.compare baseline.json candidate.json
+[--alpha 0.01] [--threshold 0.05] [-o comparison.json]``
+'''
+from __future__ import division, print_function
+
+import argparse
+import json
+import math
+import sys
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+CASE_KEYS = ('config', 'threading_model', 'transport', 'workload',
+             'payload_size', 'concurrency')
+
+# Up to this many samples in total without ties the exact distribution of
+# U is used, above it the normal approximation.
+_EXACT_LIMIT = 30
+
+
+def _ranks(values):
+    # Average ranks (1-based) of ``values``, and the tie groups' sizes.
+    order = sorted(range(len(values)), key=lambda index: values[index])
+    ranks = [0.0] * len(values)
+    ties = []
+    start = 0
+    while start < len(order):
+        end = start
+        while (end + 1 < len(order) and
+               values[order[end + 1]] == values[order[start]]):
+            end += 1
+        for position in range(start, end + 1):
+            ranks[order[position]] = (start + end) / 2 + 1
+        if end > start:
+            ties.append(end - start + 1)
+        start = end + 1
+    return ranks, ties
+
+
+def _exact_p(u, n1, n2):
+    # counts[k]: number of orderings of the samples with U == k.
+    counts = [[[0] * (n1 * n2 + 1) for _ in range(n2 + 1)]
+              for _ in range(n1 + 1)]
+    for i in range(n1 + 1):
+        for j in range(n2 + 1):
+            if i == 0 or j == 0:
+                counts[i][j][0] = 1
+                continue
+            for k in range(i * j + 1):
+                # Largest value from the first sample: it is above all j of
+                # the second one, else it is from the second sample.
+                counts[i][j][k] = ((counts[i - 1][j][k - j] if k >= j else 0) +
+                                   counts[i][j - 1][k])
+    total = float(sum(counts[n1][n2]))
+    low = min(u, n1 * n2 - u)
+    p = 2 * sum(counts[n1][n2][:int(math.floor(low)) + 1]) / total
+    return min(1.0, p)
+
+
+def mann_whitney(first, second):
+    '''
+    Two-sided Mann-Whitney U test.
+
+    :param first: Sample of values.
+    :param second: Sample of values.
+    :returns: (U of ``first``, p-value) -- p is ``1.0`` if either sample
+              is empty.
+    '''
+    n1, n2 = len(first), len(second)
+    if not n1 or not n2:
+        return 0.0, 1.0
+    ranks, ties = _ranks(list(first) + list(second))
+    u = sum(ranks[:n1]) - n1 * (n1 + 1) / 2
+    if not ties and n1 + n2 <= _EXACT_LIMIT:
+        return u, _exact_p(u, n1, n2)
+    n = n1 + n2
+    mean = n1 * n2 / 2
+    tie_term = sum(t ** 3 - t for t in ties) / (n * (n - 1))
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term)
+    if variance <= 0:
+        return u, 1.0
+    # Continuity correction.
+    z = (abs(u - mean) - 0.5) / math.sqrt(variance)
+    return u, min(1.0, math.erfc(max(z, 0.0) / math.sqrt(2)))
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def compare_samples(baseline, candidate, higher_is_better, alpha,
+                    threshold):
+    '''
+    :returns: dict -- ``baseline``/``candidate`` medians, relative
+              ``change``, ``p`` and ``verdict``: ``regression``,
+              ``improvement``, ``same`` or ``insufficient`` (no samples).
+    '''
+    if not baseline or not candidate:
+        return {'verdict': 'insufficient'}
+    base, cand = _median(baseline), _median(candidate)
+    change = (cand - base) / base if base else 0.0
+    _, p = mann_whitney(baseline, candidate)
+    verdict = 'same'
+    if p < alpha and abs(change) > threshold:
+        better = change > 0 if higher_is_better else change < 0
+        verdict = 'improvement' if better else 'regression'
+    return {'baseline': base, 'candidate': cand, 'change': change, 'p': p,
+            'verdict': verdict}
+
+
+def case_key(record):
+    return tuple(record[key] for key in CASE_KEYS)
+
+
+def compare(baseline, candidate, alpha=0.01, threshold=0.05):
+    '''
+    Compare the cases of two suite reports.
+
+    :returns: list of dicts -- Per case found in both: the ``case`` fields
+              and ``throughput`` and ``latency`` comparisons (see
+              ``compare_samples``).
+    '''
+    base_cases = dict((case_key(record), record)
+                      for record in baseline['results'])
+    comparisons = []
+    for record in candidate['results']:
+        key = case_key(record)
+        base = base_cases.get(key)
+        if base is None:
+            continue
+        comparison = dict(zip(CASE_KEYS, key))
+        comparison['throughput'] = compare_samples(
+            base.get('per_second_samples', []),
+            record.get('per_second_samples', []),
+            True, alpha, threshold)
+        comparison['latency'] = compare_samples(
+            base.get('latency_samples_us', []),
+            record.get('latency_samples_us', []),
+            False, alpha, threshold)
+        comparisons.append(comparison)
+    return comparisons
+
+
+def environment_changes(baseline, candidate):
+    '''
+    :returns: dict -- ``{name: (baseline, candidate)}`` of the differing
+              environment metadata (time and arguments excluded).
+    '''
+    base = baseline.get('meta', {})
+    cand = candidate.get('meta', {})
+    return dict((name, (base.get(name), cand.get(name)))
+                for name in sorted(set(base) | set(cand))
+                if name not in ('time', 'argv') and
+                base.get(name) != cand.get(name))
+
+
+def _format(result):
+    if result['verdict'] == 'insufficient':
+        return '-'
+    mark = {'regression': ' REGRESSION', 'improvement': ' improvement',
+            'same': ''}[result['verdict']]
+    return '%+.1f%% (p=%.3f)%s' % (result['change'] * 100, result['p'],
+                                   mark)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('baseline', help='JSON results of the baseline.')
+    parser.add_argument('candidate', help='JSON results to check.')
+    parser.add_argument('--alpha', type=float, default=0.01,
+                        help='Significance level. (default: 0.01)')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='Ignore relative changes of the median up to '
+                             'this. (default: 0.05)')
+    parser.add_argument('-o', '--output',
+                        help='File to write the JSON comparison to.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    with open(args.baseline) as stream:
+        baseline = json.load(stream)
+    with open(args.candidate) as stream:
+        candidate = json.load(stream)
+    changes = environment_changes(baseline, candidate)
+    for name, (base, cand) in sorted(changes.items()):
+        print('environment: %s: %s -> %s' % (name, base, cand))
+    comparisons = compare(baseline, candidate, args.alpha, args.threshold)
+    regressed = False
+    for comparison in comparisons:
+        print('%-48s throughput %-28s latency %s' % (
+            ' '.join(str(comparison[key]) for key in CASE_KEYS),
+            _format(comparison['throughput']),
+            _format(comparison['latency'])))
+        regressed = regressed or any(
+            comparison[name]['verdict'] == 'regression'
+            for name in ('throughput', 'latency'))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'environment': changes, 'cases': comparisons}, out,
+                      indent=2, sort_keys=True)
+    if regressed:
+        print('Regressions found.', file=sys.stderr)
+        sys.exit(1)
+    return comparisons
+
+
+if __name__ == '__main__':
+    main()
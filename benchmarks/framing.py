@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+'''
+Adversarial micro-benchmarks of message extraction (framing).
+
+Feeds byte patterns through ``SocketQueue._to_queue`` of each codec/framing
+the way the receiver does (buffer + received chunk), without sockets:
+
+* ``one-byte``: one message delivered one byte per recv
+* ``giant-string``: one message with a huge string literal, 4 KiB per recv
+* ``unicode-escapes``: one message with a string of dense ``\\u`` escapes
+  (JSON) or 2-byte UTF-8 characters (BSON, MessagePack), 4 KiB per recv
+* ``pipelined``: many tiny messages received in a single recv
+
+Input sizes double from ``--min-size`` up to ``--max-size`` bytes, or until
+one run takes longer than ``--max-seconds``. Reported are bytes per second
+per size and the complexity trend: the slope of log(time) over log(size),
+1 for linear and 2 for quadratic extraction. ``--fail-slope`` exits with
+status 1 if any slope exceeds the given value, for catching regressions
+in CI.
+
+Usage: ``python -m benchmarks.framing [-c json-rfc7464] [-p one-byte]
+[--max-size 1048576] [--fail-slope 1.5] [-o results.json]``
+'''
+from __future__ import division, print_function
+
+import argparse
+import json
+import math
+import sys
+from timeit import default_timer
+
+from bsonrpc.framing import (
+    JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
+from bsonrpc.memory import MemoryStats
+from bsonrpc.socket_queue import (
+    BSONCodec, JSONCodec, MsgPackCodec, SocketQueue)
+from bsonrpc.stats import ConnectionStats
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+def _json_codec(framing_cls):
+    return lambda: JSONCodec(framing_cls.extract_message,
+                             framing_cls.into_frame)
+
+
+#: Codec/framing name -> codec factory.
+CODECS = {
+    'bson': BSONCodec,
+    'json-rfc7464': _json_codec(JSONFramingRFC7464),
+    'json-netstring': _json_codec(JSONFramingNetstring),
+    'json-none': _json_codec(JSONFramingNone),
+    'msgpack': MsgPackCodec,
+}
+
+_CHUNK = SocketQueue.BUFSIZE
+
+
+def _notification(text):
+    return {'jsonrpc': '2.0', 'method': 'note', 'params': [text]}
+
+
+def _frame(codec, msg):
+    return codec.into_frame(codec.dumps(msg))
+
+
+def _one_message(codec, text, size):
+    # Grow the text until the framed message is about ``size`` bytes.
+    overhead = len(_frame(codec, _notification(u'')))
+    per_char = len(_frame(codec, _notification(text * 64))) - overhead
+    count = max(1, (size - overhead) * 64 // max(1, per_char))
+    return _frame(codec, _notification(text * count))
+
+
+def _split(data, chunk):
+    return [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+
+def one_byte(codec, size):
+    return _split(_one_message(codec, u'x', size), 1), 1
+
+
+def giant_string(codec, size):
+    return _split(_one_message(codec, u'x', size), _CHUNK), 1
+
+
+def unicode_escapes(codec, size):
+    return _split(_one_message(codec, u'\xe9', size), _CHUNK), 1
+
+
+def pipelined(codec, size):
+    tiny = _frame(codec, _notification(u'x'))
+    count = max(1, size // len(tiny))
+    return [tiny * count], count
+
+
+#: Pattern name -> function(codec, size) -> (chunks, message count).
+PATTERNS = {
+    'one-byte': one_byte,
+    'giant-string': giant_string,
+    'unicode-escapes': unicode_escapes,
+    'pipelined': pipelined,
+}
+
+
+class _Sink(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def put(self, item):
+        self.count += 1
+
+    def append(self, size):
+        pass
+
+
+def _extractor(codec):
+    # SocketQueue without socket and receiver thread, to call _to_queue.
+    queue = SocketQueue.__new__(SocketQueue)
+    queue.codec = codec
+    queue.attachment_spool_size = 1 << 20
+    queue._incoming = None
+    queue.stats = ConnectionStats()
+    queue.stage_timer = None
+    queue.memory_budget = None
+    queue.bypass = None
+    queue.memory = MemoryStats()
+    queue._sizes = _Sink()
+    queue._queue = _Sink()
+    return queue
+
+
+def feed(codec, chunks):
+    '''
+    Feed ``chunks`` through ``SocketQueue._to_queue`` like the receiver.
+
+    :returns: (seconds, number of messages extracted)
+    '''
+    queue = _extractor(codec)
+    to_queue = queue._to_queue
+    bbuffer = b''
+    started = default_timer()
+    for chunk in chunks:
+        bbuffer = to_queue(bbuffer + chunk)
+    elapsed = default_timer() - started
+    if bbuffer:
+        raise RuntimeError(u'%d bytes left unextracted.' % len(bbuffer))
+    return elapsed, queue._queue.count
+
+
+def slope(points):
+    '''
+    :param points: list of (size, seconds).
+    :returns: float | None -- Least squares slope of log(seconds) over
+              log(size), ``None`` with less than two points.
+    '''
+    points = [(math.log(size), math.log(max(seconds, 1e-9)))
+              for size, seconds in points]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var_x:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def run_case(codec_name, pattern, args):
+    '''
+    Measure one codec/framing with one pattern over growing input sizes.
+
+    :returns: dict -- The result record.
+    '''
+    codec = CODECS[codec_name]()
+    runs = []
+    size = args.min_size
+    while size <= args.max_size:
+        chunks, expected = PATTERNS[pattern](codec, size)
+        total = sum(len(chunk) for chunk in chunks)
+        best = None
+        for _ in range(args.repeat):
+            elapsed, count = feed(codec, chunks)
+            if count != expected:
+                raise RuntimeError(u'%s/%s: extracted %d of %d messages.' %
+                                   (codec_name, pattern, count, expected))
+            best = elapsed if best is None else min(best, elapsed)
+            if elapsed > args.max_seconds:
+                break
+        runs.append({'bytes': total, 'seconds': best,
+                     'bytes_per_second': total / max(best, 1e-9)})
+        if best > args.max_seconds:
+            break
+        size *= 2
+    # Sizes which take microseconds are dominated by fixed costs.
+    measurable = [(run['bytes'], run['seconds']) for run in runs
+                  if run['seconds'] >= 1e-3]
+    return {
+        'codec': codec_name,
+        'pattern': pattern,
+        'runs': runs,
+        'slope': slope(measurable),
+    }
+
+
+def _csv(value):
+    return value.split(',')
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-c', '--codecs', type=_csv, default=sorted(CODECS),
+                        help='Codecs/framings. (default: all)')
+    parser.add_argument('-p', '--patterns', type=_csv,
+                        default=sorted(PATTERNS),
+                        help='Byte patterns. (default: all)')
+    parser.add_argument('--min-size', type=int, default=1 << 10,
+                        help='Smallest input in bytes. (default: 1 KiB)')
+    parser.add_argument('--max-size', type=int, default=1 << 20,
+                        help='Largest input in bytes. (default: 1 MiB)')
+    parser.add_argument('--max-seconds', type=float, default=1.0,
+                        help='Stop growing the input of a case after a run '
+                             'this long. (default: 1.0)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs per size, the fastest counts. '
+                             '(default: 3)')
+    parser.add_argument('--fail-slope', type=float,
+                        help='Exit with status 1 if a slope exceeds this.')
+    parser.add_argument('-o', '--output',
+                        help='File to write the JSON results to.')
+    args = parser.parse_args(argv)
+    for name, known in (('codecs', CODECS), ('patterns', PATTERNS)):
+        unknown = set(getattr(args, name)) - set(known)
+        if unknown:
+            parser.error('unknown %s: %s' % (name, ', '.join(sorted(unknown))))
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    results = []
+    failed = False
+    print('%-15s %-16s %10s %12s %6s' %
+          ('codec', 'pattern', 'max bytes', 'MB/s (max)', 'slope'))
+    for codec_name in args.codecs:
+        for pattern in args.patterns:
+            record = run_case(codec_name, pattern, args)
+            results.append(record)
+            last = record['runs'][-1]
+            trend = record['slope']
+            print('%-15s %-16s %10d %12.2f %6s' %
+                  (codec_name, pattern, last['bytes'],
+                   last['bytes_per_second'] / 1e6,
+                   '-' if trend is None else '%.2f' % trend))
+            if (args.fail_slope is not None and trend is not None and
+                    trend > args.fail_slope):
+                failed = True
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'results': results}, out, indent=2, sort_keys=True)
+    if failed:
+        print('Slope above %.2f: superlinear extraction.' % args.fail_slope,
+              file=sys.stderr)
+        sys.exit(1)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+Per-call client overhead of peer proxy calls.
+
+Compares the pre-compiled proxy stubs against a copy of the call path
+before them: a fresh closure per attribute access, the timeout keyword
+regex compiled per call, ``Definitions.request`` and encoding with a new
+``json.dumps`` encoder (JSON) or ``bson.BSON`` (BSON) per message:
+
+* client side only: message building and encoding, no I/O
+* full round trips over a socketpair
+
+Usage: ``python -m benchmarks.proxy_overhead [-n CALLS]``
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import re
+import socket
+import timeit
+
+import bson
+
+from bsonrpc import BSONRpc, JSONRpc, request, service_class
+from bsonrpc.socket_queue import JSONCodec
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+
+def _closure_call(rpc, name):
+    # The proxy call path before pre-compiled stubs: PeerProxy.__getattr__
+    # and invoke_request of that time.
+    def _curried(*args, **kwargs):
+        kwargs['_____timeout'] = None
+        rec = re.compile(r'^_*timeout$')
+        to_keys = sorted(filter(lambda x: rec.match(x), kwargs.keys()))
+        if to_keys:
+            timeout = kwargs[to_keys[0]]
+            del kwargs[to_keys[0]]
+        else:
+            timeout = None
+        return rpc._round_trip(
+            rpc.definitions.request(None, name, args, kwargs), timeout)
+    return _curried
+
+
+class _LegacyCodec(object):
+    '''
+    Encodes messages like the codecs before pre-compiled stubs.
+    '''
+
+    def __init__(self, codec):
+        self._codec = codec
+        self._json = isinstance(codec, JSONCodec)
+
+    def dumps(self, msg):
+        if self._json:
+            # Constructs a JSONEncoder per call.
+            return json.dumps(msg, separators=(',', ':'),
+                              sort_keys=True).encode('utf-8')
+        return bytes(bson.BSON.encode(msg))
+
+    def __getattr__(self, name):
+        return getattr(self._codec, name)
+
+
+def _legacy(rpc):
+    rpc.socket_queue.codec = _LegacyCodec(rpc.socket_queue.codec)
+    return rpc
+
+
+def _encode_only(rpc):
+    # Replace the I/O part of the call with encoding the message.
+    codec = rpc.socket_queue.codec
+
+    def _round_trip(msg, timeout):
+        codec.into_frame(codec.dumps(msg))
+    rpc._round_trip = _round_trip
+    return rpc
+
+
+def _per_call_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--calls', type=int, default=5000,
+                        help='Calls per measurement. (default: 5000)')
+    args = parser.parse_args(argv)
+    for rpc_cls in (JSONRpc, BSONRpc):
+        s1, s2 = socket.socketpair()
+        srv = rpc_cls(s1, EchoServices())
+        cli = rpc_cls(s2)
+        proxy = cli.get_peer_proxy()
+        s5, s6 = socket.socketpair()
+        legacy_srv = rpc_cls(s5, EchoServices())
+        legacy = _legacy(rpc_cls(s6))
+        s3, s4 = socket.socketpair()
+        offline = _encode_only(rpc_cls(s3))
+        offline_proxy = offline.get_peer_proxy()
+        s7, s8 = socket.socketpair()
+        offline_legacy = _encode_only(_legacy(rpc_cls(s7)))
+        try:
+            results = [
+                ('client generic',
+                 _per_call_us(
+                     lambda: _closure_call(offline_legacy, 'echo')('hello'),
+                     args.calls * 10)),
+                ('client stub',
+                 _per_call_us(lambda: offline_proxy.echo('hello'),
+                              args.calls * 10)),
+                ('round trip generic',
+                 _per_call_us(lambda: _closure_call(legacy, 'echo')('hello'),
+                              args.calls)),
+                ('round trip stub',
+                 _per_call_us(lambda: proxy.echo('hello'), args.calls)),
+            ]
+            print(rpc_cls.__name__)
+            for label, per_call in results:
+                print('  %-20s %8.2f us/call' % (label, per_call))
+        finally:
+            for rpc in (offline, offline_legacy, cli, legacy):
+                rpc.close()
+                rpc.join()
+            for rpc in (srv, legacy_srv):
+                rpc.join()
+            for sock in (s4, s8):
+                sock.close()
+
+
+if __name__ == '__main__':
+    main()
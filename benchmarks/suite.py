@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite over codec/framing, threading model and transport.
+
+Measures for each combination of codec/framing (``bson``,
+``json-rfc7464``, ``json-netstring``, ``json-none``, ``msgpack``),
+threading model,
+transport (``socketpair``, ``loopback``), payload size and concurrency:
+
+* ``request``: echo round trips -- requests per second and round-trip
+  latency percentiles
+* ``batch``: echo requests in batches -- calls per second
+* ``notification``: one-way notifications -- notifications per second,
+  measured until the peer has handled all of them
+
+``concurrency`` is the number of callers (threads or greenlets) sharing
+one connection. Combinations keeping more than ``--max-inflight`` bytes
+of payload in flight (all callers, whole batches) are skipped, as are payloads above 64 KiB with
+``json-none`` (unless ``--unlimited``): the unframed parser rescans the
+buffered message on every received chunk, which makes large messages take
+minutes.
+
+Each case is measured ``--repeat`` times on its connection. Results are
+written as JSON (``-o``, default: stdout) with progress on stderr:
+environment metadata (versions of Python, bsonrpc and the codec backends,
+CPU count) and per case the rates of each repetition and a subsample of
+the call latencies, for comparing runs with ``benchmarks.compare``.
+
+Usage: ``python -m benchmarks.suite [-c bson,json-rfc7464] [-t threads]
+[-s 100,10000] [-j 1,10] [-o results.json]``
+'''
+from __future__ import division, print_function
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import socket
+import sys
+import time
+from timeit import default_timer
+
+import bsonrpc
+from bsonrpc import (
+    BSONRpc, JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464,
+    JSONRpc, MsgPackRpc, ThreadingModel, loopback_pair, notification, request,
+    service_class)
+from bsonrpc.concurrent import sleep, spawn
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+#: Codec/framing name -> (connector class, options, max payload size).
+CONFIGS = {
+    'bson': (BSONRpc, {}, None),
+    'json-rfc7464': (JSONRpc, {'framing_cls': JSONFramingRFC7464}, None),
+    'json-netstring': (JSONRpc, {'framing_cls': JSONFramingNetstring},
+                       None),
+    'json-none': (JSONRpc, {'framing_cls': JSONFramingNone}, 1 << 16),
+    'msgpack': (MsgPackRpc, {}, None),
+}
+
+THREADING_MODELS = {
+    'threads': ThreadingModel.THREADS,
+    'gevent': ThreadingModel.GEVENT,
+}
+
+TRANSPORTS = ('socketpair', 'loopback')
+
+WORKLOADS = ('request', 'batch', 'notification')
+
+
+@service_class
+class BenchmarkServices(object):
+
+    def __init__(self):
+        self.notified = 0
+
+    @request
+    def echo(self, value):
+        return value
+
+    @notification
+    def note(self, value):
+        self.notified += 1
+
+
+def _socketpair(threading_model, transport):
+    if transport == 'loopback':
+        return loopback_pair(threading_model)
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent.socket
+        return gevent.socket.socketpair()
+    return socket.socketpair()
+
+
+def percentiles(samples):
+    '''
+    :param samples: Latencies in seconds.
+    :returns: dict -- p50, p90, p99, p999, max and mean in microseconds.
+    '''
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def _rank(fraction):
+        index = min(len(ordered) - 1, int(fraction * len(ordered)))
+        return ordered[index] * 1e6
+
+    return {
+        'p50': _rank(0.5),
+        'p90': _rank(0.9),
+        'p99': _rank(0.99),
+        'p999': _rank(0.999),
+        'max': ordered[-1] * 1e6,
+        'mean': sum(ordered) / len(ordered) * 1e6,
+    }
+
+
+def _run_callers(threading_model, concurrency, count, call):
+    '''
+    Call ``call()`` ``count`` times from ``concurrency`` callers.
+
+    :returns: (elapsed seconds, list of per-call latencies)
+    '''
+    latencies = []
+    per_caller = [count // concurrency + (1 if i < count % concurrency
+                                          else 0)
+                  for i in range(concurrency)]
+
+    def _caller(calls):
+        record = latencies.append
+        for _ in range(calls):
+            started = default_timer()
+            call()
+            record(default_timer() - started)
+
+    started = default_timer()
+    workers = [spawn(threading_model, _caller, calls)
+               for calls in per_caller if calls]
+    for worker in workers:
+        worker.join()
+    return default_timer() - started, latencies
+
+
+def _measure(workload, cli, services, threading_model, payload,
+             concurrency, count, batch_size):
+    '''
+    :returns: (calls, elapsed seconds, list of latencies)
+    '''
+    if workload == 'request':
+        elapsed, latencies = _run_callers(
+            threading_model, concurrency, count,
+            lambda: cli.invoke_request('echo', payload))
+        return count, elapsed, latencies
+    if workload == 'batch':
+        batch = [('r', 'echo', (payload,), {})] * batch_size
+        batches = max(1, count // batch_size)
+        elapsed, latencies = _run_callers(
+            threading_model, concurrency, batches,
+            lambda: cli.batch_call(batch))
+        return batches * batch_size, elapsed, latencies
+    services.notified = 0
+    elapsed, _ = _run_callers(
+        threading_model, concurrency, count,
+        lambda: cli.invoke_notification('note', payload))
+    started = default_timer()
+    while services.notified < count:
+        sleep(threading_model, 0.001)
+    elapsed += default_timer() - started
+    return count, elapsed, []
+
+
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def run_case(config, threading_model, transport, workload, size,
+             concurrency, args):
+    '''
+    Run one benchmark case on a fresh connection.
+
+    :returns: dict -- The result record.
+    '''
+    rpc_cls, options, _ = CONFIGS[config]
+    tm = THREADING_MODELS[threading_model]
+    options = dict(options, threading_model=tm,
+                   concurrent_request_handling=tm,
+                   concurrent_notification_handling=None)
+    s1, s2 = _socketpair(tm, transport)
+    services = BenchmarkServices()
+    srv = rpc_cls(s1, services, **options)
+    cli = rpc_cls(s2, **options)
+    count = max(concurrency, min(args.requests,
+                                 args.max_bytes // max(1, size)))
+    record = {
+        'config': config,
+        'threading_model': threading_model,
+        'transport': transport,
+        'workload': workload,
+        'payload_size': size,
+        'concurrency': concurrency,
+    }
+    try:
+        payload = 'x' * size
+        # Warm up connection, stubs and codec.
+        cli.invoke_request('echo', payload)
+        rates = []
+        latencies = []
+        calls = seconds = 0
+        for _ in range(args.repeat):
+            done, elapsed, measured = _measure(
+                workload, cli, services, tm, payload, concurrency, count,
+                args.batch_size)
+            calls += done
+            seconds += elapsed
+            rates.append(done / elapsed)
+            latencies.extend(measured)
+        record.update({'count': calls, 'seconds': seconds,
+                       'per_second': _median(rates),
+                       'per_second_samples': rates})
+        if workload == 'batch':
+            record['batch_size'] = args.batch_size
+        if latencies:
+            record['latency_us'] = percentiles(latencies)
+            sampled = random.Random(0).sample(
+                latencies, min(len(latencies), args.latency_samples))
+            record['latency_samples_us'] = [
+                round(latency * 1e6, 1) for latency in sampled]
+    finally:
+        cli.close()
+        cli.join(5.0)
+        srv.join(5.0)
+    return record
+
+
+def _csv(convert=str):
+    return lambda value: [convert(item) for item in value.split(',')]
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-c', '--configs', type=_csv(),
+                        default=sorted(CONFIGS),
+                        help='Codecs/framings. (default: all)')
+    parser.add_argument('-t', '--threading-models', type=_csv(),
+                        default=sorted(THREADING_MODELS),
+                        help='Threading models. (default: all)')
+    parser.add_argument('-T', '--transports', type=_csv(),
+                        default=list(TRANSPORTS),
+                        help='Transports. (default: all)')
+    parser.add_argument('-w', '--workloads', type=_csv(),
+                        default=list(WORKLOADS),
+                        help='Workloads. (default: all)')
+    parser.add_argument('-s', '--sizes', type=_csv(int),
+                        default=[100, 10000, 1000000, 10000000],
+                        help='Payload sizes in bytes. '
+                             '(default: 100,10000,1000000,10000000)')
+    parser.add_argument('-j', '--concurrency', type=_csv(int),
+                        default=[1, 10, 100, 1000],
+                        help='Concurrent callers. (default: 1,10,100,1000)')
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='Max calls per case. (default: 2000)')
+    parser.add_argument('--max-bytes', type=int, default=1 << 26,
+                        help='Max payload bytes per case, fewer calls are '
+                             'made with large payloads. (default: 64 MiB)')
+    parser.add_argument('--max-inflight', type=int, default=1 << 28,
+                        help='Skip cases with more payload bytes in flight. '
+                             '(default: 256 MiB)')
+    parser.add_argument('--unlimited', action='store_true',
+                        help='Do not skip large payloads of slow framings.')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Requests per batch. (default: 100)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Measurements per case, for comparisons '
+                             'between runs. (default: 5)')
+    parser.add_argument('--latency-samples', type=int, default=1000,
+                        help='Call latencies kept per case. '
+                             '(default: 1000)')
+    parser.add_argument('-o', '--output',
+                        help='File to write the JSON results to. '
+                             '(default: stdout)')
+    args = parser.parse_args(argv)
+    for name, known in (('configs', CONFIGS),
+                        ('threading_models', THREADING_MODELS),
+                        ('transports', TRANSPORTS),
+                        ('workloads', WORKLOADS)):
+        unknown = set(getattr(args, name)) - set(known)
+        if unknown:
+            parser.error('unknown %s: %s' % (name.replace('_', ' '),
+                                             ', '.join(sorted(unknown))))
+    return args
+
+
+def cases(args):
+    '''
+    :returns: list of argument tuples of ``run_case`` selected by ``args``.
+    '''
+    selected = []
+    for config in args.configs:
+        _, _, max_size = CONFIGS[config]
+        if args.unlimited:
+            max_size = None
+        for threading_model in args.threading_models:
+            for transport in args.transports:
+                for workload in args.workloads:
+                    for size in args.sizes:
+                        if max_size is not None and size > max_size:
+                            continue
+                        for concurrency in args.concurrency:
+                            inflight = size * concurrency
+                            if workload == 'batch':
+                                inflight *= args.batch_size
+                            if inflight > args.max_inflight:
+                                continue
+                            selected.append(
+                                (config, threading_model, transport,
+                                 workload, size, concurrency))
+    return selected
+
+
+def _version(module_name):
+    try:
+        module = __import__(module_name)
+    except ImportError:
+        return None
+    return getattr(module, '__version__', getattr(module, 'version', ''))
+
+
+def environment():
+    '''
+    :returns: dict -- Versions of Python, bsonrpc and the codec backends,
+              CPU count and platform of this run.
+    '''
+    import bson
+    bson_backend = ('pymongo %s' % _version('pymongo')
+                    if hasattr(bson, 'encode') or hasattr(bson, 'BSON')
+                    else 'pybson')
+    return {
+        'bsonrpc': bsonrpc.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'bson': '%s (C extension: %s)' % (
+            bson_backend, bool(getattr(bson, 'has_c', lambda: False)())),
+        'json': 'json %s (C scanner: %s)' % (
+            json.__version__,
+            getattr(json.scanner, 'c_make_scanner', None) is not None),
+        'gevent': _version('gevent'),
+        'msgpack': _version('msgpack'),
+    }
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    results = []
+    selected = cases(args)
+    for index, case in enumerate(selected):
+        print('[%d/%d] %s' % (index + 1, len(selected),
+                              ' '.join(str(item) for item in case)),
+              file=sys.stderr)
+        record = run_case(*(case + (args,)))
+        print('        %.0f/s' % record['per_second'], file=sys.stderr)
+        results.append(record)
+    meta = environment()
+    meta.update({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'argv': sys.argv[1:] if argv is None else list(argv),
+    })
+    report = {'meta': meta, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,20 @@
 '''
 Library for JSON RPC 2.0 and BSON RPC
 '''
+from bsonrpc.attachments import Attachment
+from bsonrpc.cache import ResultCache
+from bsonrpc.concurrent import HandlerPool
 from bsonrpc.exceptions import BsonRpcError
 from bsonrpc.framing import (
     JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
 from bsonrpc.interfaces import (
     notification, request, rpc_notification, rpc_request, service_class)
-from bsonrpc.options import NoArgumentsPresentation, ThreadingModel
-from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.loopback import loopback_pair
+from bsonrpc.options import (
+    MemoryBudgetAction, NoArgumentsPresentation, ThreadingModel)
+from bsonrpc.prefork import PreforkServer
+from bsonrpc.rpc import BSONRpc, JSONRpc, MsgPackRpc
+from bsonrpc.server import RpcServer
 from bsonrpc.util import BatchBuilder
 
 
@@ -17,15 +24,23 @@ __version__ = '0.2.1'
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
 __all__ = [
+    'Attachment',
     'BSONRpc',
     'BatchBuilder',
     'BsonRpcError',
+    'HandlerPool',
     'JSONFramingNetstring',
     'JSONFramingNone',
     'JSONFramingRFC7464',
     'JSONRpc',
+    'MemoryBudgetAction',
+    'MsgPackRpc',
     'NoArgumentsPresentation',
+    'PreforkServer',
+    'ResultCache',
+    'RpcServer',
     'ThreadingModel',
+    'loopback_pair',
     'notification',
     'request',
     'rpc_notification',
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+'''
+Out-of-band binary attachments.
+
+Attachments are sent as raw bytes after the message referring to them.
+The message lists the sizes of the attachments in an ``attachments``
+member and has each attachment replaced with a ``{"$attachment": <index>}``
+placeholder. Attachments are looked for (and placeholders resolved) in the
+``params`` of requests and notifications, in the ``result`` of responses
+and in stream items: either the value itself or its direct items/members.
+'''
+import os
+from tempfile import SpooledTemporaryFile
+
+import six
+
+from bsonrpc.exceptions import FramingError
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+PLACEHOLDER = '$attachment'
+
+_CHUNK = 1 << 16
+
+
+class Attachment(object):
+    '''
+    Binary data to be sent out-of-band, as a parameter of a request or
+    notification or as the result of a request handler.
+
+    Received attachments are given to handlers and callers as
+    ``memoryview`` objects or, above the ``attachment_spool_size`` option,
+    as files spooled to disk (``tempfile.SpooledTemporaryFile``).
+
+    Example:
+    ::
+
+      proxy.upload('artifact.tar', Attachment.from_path('artifact.tar'))
+    '''
+
+    __slots__ = ('source', 'size', '_close')
+
+    def __init__(self, source, size=None, close=False):
+        '''
+        :param source: Bytes-like object or a file object opened in binary
+                       mode.
+        :type source: bytes | bytearray | memoryview | file
+        :param size: Number of bytes to send from the current position of
+                     a file. Default: ``None`` (rest of the file)
+        :type size: int | None
+        :param close: Close the file after it has been sent.
+        :type close: bool
+        '''
+        if isinstance(source, six.text_type):
+            raise TypeError(u'Attachment of text, encode it to bytes.')
+        self.source = source
+        self._close = close
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.size = memoryview(source).nbytes
+        elif size is None:
+            self.size = os.fstat(source.fileno()).st_size - source.tell()
+        else:
+            self.size = size
+
+    @classmethod
+    def from_path(cls, path):
+        '''
+        :returns: Attachment sending the file at ``path``.
+        '''
+        return cls(open(path, 'rb'), close=True)
+
+    def write_to(self, sock):
+        '''
+        Send the attachment to ``sock``. Files are sent with
+        ``sock.sendfile`` if available.
+        '''
+        source = self.source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            sock.sendall(source)
+            return
+        try:
+            sendfile = getattr(sock, 'sendfile', None)
+            if sendfile is not None and hasattr(source, 'fileno'):
+                sent = sendfile(source, source.tell(), self.size)
+                if sent != self.size:
+                    raise IOError(u'File shorter than the attachment size.')
+                return
+            remaining = self.size
+            while remaining:
+                data = source.read(min(remaining, _CHUNK))
+                if not data:
+                    raise IOError(u'File shorter than the attachment size.')
+                sock.sendall(data)
+                remaining -= len(data)
+        finally:
+            if self._close:
+                source.close()
+
+    def __repr__(self):
+        return '<Attachment %d bytes>' % self.size
+
+
+def _locate(msg):
+    if 'params' in msg:
+        return 'params'
+    if 'result' in msg:
+        return 'result'
+    if 'stream_item' in msg:
+        return 'stream_item'
+    return None
+
+
+def split_attachments(msg):
+    '''
+    Replace attachments in an outgoing message with placeholders.
+
+    :returns: (message, list of attachments) or (msg, None) if there are
+              no attachments.
+    '''
+    if type(msg) is not dict:
+        return msg, None
+    key = _locate(msg)
+    if key is None:
+        return msg, None
+    value = msg[key]
+    found = []
+
+    def _placeholder(item):
+        if isinstance(item, Attachment):
+            found.append(item)
+            return {PLACEHOLDER: len(found) - 1}
+        return item
+
+    if isinstance(value, Attachment):
+        value = _placeholder(value)
+    elif isinstance(value, (list, tuple)):
+        if not any(isinstance(item, Attachment) for item in value):
+            return msg, None
+        value = [_placeholder(item) for item in value]
+    elif isinstance(value, dict):
+        if not any(isinstance(item, Attachment) for item in value.values()):
+            return msg, None
+        value = dict((k, _placeholder(v)) for k, v in value.items())
+    else:
+        return msg, None
+    msg = dict(msg)
+    msg[key] = value
+    msg['attachments'] = [attachment.size for attachment in found]
+    return msg, found
+
+
+def _is_placeholder(item):
+    return (type(item) is dict and len(item) == 1 and
+            isinstance(item.get(PLACEHOLDER), int))
+
+
+class IncomingAttachments(object):
+    '''
+    Collects the attachments following a received message.
+    '''
+
+    def __init__(self, msg, spool_size, max_size=None, max_count=None,
+                 max_total=None):
+        '''
+        :param msg: Message announcing the attachments.
+        :param spool_size: Attachments larger than this are spooled to
+                           temporary files.
+        :param max_size: Largest attachment accepted (bytes), ``None`` for
+                         no limit.
+        :param max_count: Most attachments accepted, ``None`` for no limit.
+        :param max_total: Most bytes of all attachments accepted, ``None``
+                          for no limit.
+        :raises: FramingError if the attachments exceed a limit.
+        '''
+        self.msg = msg
+        self.spool_size = spool_size
+        self._sizes = list(msg.pop('attachments'))
+        if max_count is not None and len(self._sizes) > max_count:
+            raise FramingError(u'%d attachments exceed the maximum of %d.' %
+                               (len(self._sizes), max_count))
+        if max_size is not None and any(size > max_size
+                                        for size in self._sizes):
+            raise FramingError(u'Attachment of %d bytes exceeds the maximum '
+                               u'of %d bytes.' % (max(self._sizes), max_size))
+        if max_total is not None and sum(self._sizes) > max_total:
+            raise FramingError(u'Attachments of %d bytes exceed the maximum '
+                               u'of %d bytes.' % (sum(self._sizes), max_total))
+        #: Bytes received into memory (not spooled) so far.
+        self.held = 0
+        self._received = []
+        self._current = None
+        self._remaining = 0
+        self._next()
+
+    @staticmethod
+    def announced_by(msg):
+        '''
+        :returns: bool -- ``msg`` is followed by attachments.
+        '''
+        if type(msg) is not dict or 'attachments' not in msg:
+            return False
+        sizes = msg['attachments']
+        return (isinstance(sizes, list) and
+                all(isinstance(size, int) and size >= 0 for size in sizes))
+
+    @property
+    def done(self):
+        return self._current is None
+
+    @property
+    def recv_size(self):
+        '''
+        Suitable amount of bytes to receive at a time.
+        '''
+        return max(4096, min(self._remaining, _CHUNK * 4))
+
+    def _next(self):
+        while self._sizes:
+            self._remaining = self._sizes.pop(0)
+            if self._remaining > self.spool_size:
+                self._current = SpooledTemporaryFile(self.spool_size)
+            else:
+                self._current = bytearray()
+            if self._remaining:
+                return
+            self._finish()
+        self._current = None
+
+    def _finish(self):
+        current = self._current
+        if isinstance(current, bytearray):
+            self._received.append(memoryview(current))
+        else:
+            current.seek(0)
+            self._received.append(current)
+
+    def feed(self, data):
+        '''
+        Consume bytes of the attachments from ``data``.
+
+        :returns: Bytes left over after the last attachment.
+        '''
+        offset = 0
+        view = memoryview(data)
+        while self._current is not None and offset < len(data):
+            count = min(self._remaining, len(data) - offset)
+            if isinstance(self._current, bytearray):
+                self._current += view[offset:offset + count]
+                self.held += count
+            else:
+                self._current.write(view[offset:offset + count])
+            offset += count
+            self._remaining -= count
+            if not self._remaining:
+                self._finish()
+                self._next()
+        return data[offset:]
+
+    def message(self):
+        '''
+        :returns: The message with placeholders replaced by the received
+                  attachments.
+        '''
+        msg = self.msg
+        key = _locate(msg)
+        if key is None:
+            return msg
+        received = self._received
+
+        def _resolve(item):
+            if (_is_placeholder(item) and
+                    0 <= item[PLACEHOLDER] < len(received)):
+                return received[item[PLACEHOLDER]]
+            return item
+
+        value = msg[key]
+        if _is_placeholder(value):
+            msg[key] = _resolve(value)
+        elif isinstance(value, list):
+            msg[key] = [_resolve(item) for item in value]
+        elif isinstance(value, dict):
+            msg[key] = dict((k, _resolve(v)) for k, v in value.items())
+        return msg
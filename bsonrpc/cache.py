@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+Result cache for request handlers. See the ``cache`` argument of
+the ``request`` and ``rpc_request`` decorators.
+'''
+from collections import OrderedDict
+from threading import Lock
+
+from bsonrpc.concurrent import new_promise
+from bsonrpc.misc import monotonic
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return (dict, tuple(sorted(
+            (k, _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(v) for v in value))
+    # 1, 1.0 and True are equal and hash the same, but are not the same
+    # result.
+    return (type(value), value)
+
+
+def default_cache_key(*args, **kwargs):
+    '''
+    Default cache key: the request parameters turned into
+    a hashable structure. Scalars are distinguished by type.
+    '''
+    return _freeze((args, kwargs))
+
+
+class _Failure(object):
+
+    __slots__ = ('exception',)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class ResultCache(object):
+    '''
+    Cache of request handler results.
+
+    Results are stored already encoded for the codec of the connection
+    so a cache hit skips both the execution of the handler and the encoding
+    of the result. The cache is attached to a handler method and is thus
+    shared by all connections served by that method. Simultaneous identical
+    requests cause only one execution of the handler, the other requests
+    wait for and share its result. Errors raised by the handler are
+    not cached.
+    '''
+
+    def __init__(self, ttl=None, max_entries=1024, key=None):
+        '''
+        :param ttl: Time to live of entries in seconds. ``None``: no expiry.
+        :type ttl: float | None
+        :param max_entries: Maximum number of entries. Least recently used
+                            entries are evicted first.
+        :type max_entries: int
+        :param key: Function producing the cache key (any hashable value)
+                    from the request parameters, called as
+                    ``key(*args, **kwargs)``.
+                    Default: all parameters as-is.
+        :type key: callable | None
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = key or default_cache_key
+        self.hits = 0
+        self.misses = 0
+        # {key: (expires_at, fragment), ...}
+        self._entries = OrderedDict()
+        # {key: promise, ...}
+        self._inflight = {}
+        # Guards only non-blocking sections.
+        self._lock = Lock()
+
+    def clear(self):
+        '''
+        Drop all cached entries.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, fragment = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries[key] = self._entries.pop(key)  # Most recently used.
+        return fragment
+
+    def _store(self, key, fragment, now):
+        expires_at = None if self.ttl is None else now + self.ttl
+        self._entries[key] = (expires_at, fragment)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def fetch(self, key, compute, threading_model):
+        '''
+        Get the cached value of ``key`` or compute and cache it.
+
+        :param key: Hashable cache key.
+        :param compute: Function producing the value if not cached.
+        :param threading_model: Threading model of the calling connection.
+        :returns: Cached or computed value.
+        '''
+        with self._lock:
+            fragment = self._lookup(key, monotonic())
+            if fragment is not None:
+                self.hits += 1
+                return fragment
+            promise = self._inflight.get(key)
+            owner = promise is None
+            if owner:
+                self.misses += 1
+                promise = new_promise(threading_model)
+                self._inflight[key] = promise
+        if not owner:
+            value = promise.wait()
+            if isinstance(value, _Failure):
+                raise value.exception
+            return value
+        try:
+            fragment = compute()
+        except BaseException as e:
+            # Also e.g. GreenletExit: waiters and later fetches of the key
+            # must not be left waiting for this promise.
+            with self._lock:
+                del self._inflight[key]
+            promise.set(_Failure(e))
+            raise
+        with self._lock:
+            del self._inflight[key]
+            self._store(key, fragment, monotonic())
+        promise.set(fragment)
+        return fragment
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+'''
+Compression of messages, wrapping any codec and framing.
+
+Each framed message is sent in a compression frame: one byte for the
+compression algorithm (0 for uncompressed), 4 bytes (big endian) for the
+length of the payload and the payload, which is the message framed by the
+wrapped codec/framing - compressed if it was large enough.
+
+Algorithms included are ``'zlib'``, ``'bz2'`` and ``'lzma'`` from the
+standard library. The receiving side decompresses any of them, so only
+the sending side's choice matters, but both sides must have compression
+enabled, or negotiate it with the handshake (see ``bsonrpc.handshake``).
+
+Decompression stops at ``max_size`` bytes (``compression_max_size``
+option): a payload inflating beyond it is a ``FramingError``, so a small
+compressed frame cannot make the receiver allocate unbounded memory.
+'''
+from struct import Struct
+
+from bsonrpc.exceptions import FramingError
+from bsonrpc.misc import thread_time
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+_HEADER = Struct('>BI')
+
+# Times stay zero (not measured) without thread CPU time.
+_cpu_time = thread_time or (lambda: 0.0)
+
+
+def _zlib(level):
+    import zlib
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    return (lambda data: zlib.compress(data, level)), zlib.decompressobj
+
+
+def _bz2(level):
+    import bz2
+    if level is None:
+        level = 9
+    return (lambda data: bz2.compress(data, level)), bz2.BZ2Decompressor
+
+
+def _lzma(level):
+    import lzma
+    return ((lambda data: lzma.compress(data, preset=level)),
+            lzma.LZMADecompressor)
+
+
+def _decompress(decompressor, data, max_size):
+    if max_size is None:
+        return decompressor.decompress(data)
+    try:
+        payload = decompressor.decompress(data, max_size + 1)
+    except TypeError:
+        # BZ2Decompressor of Python 2 has no max_length: checked after
+        # decompressing all.
+        payload = decompressor.decompress(data)
+    if len(payload) > max_size:
+        raise FramingError(u'Decompressed message exceeds %d bytes.' %
+                           max_size)
+    return payload
+
+
+#: Compression algorithms: name -> (flag byte, factory(level)). Factories
+#: return (compress function, decompressor class).
+ALGORITHMS = {
+    'zlib': (1, _zlib),
+    'bz2': (2, _bz2),
+    'lzma': (3, _lzma),
+}
+
+
+class CompressionStats(object):
+    '''
+    Counters of a compressing codec. Times are CPU time in seconds of the
+    threads compressing/decompressing, zero on platforms without thread
+    CPU time (``time.thread_time`` or ``RUSAGE_THREAD``).
+    '''
+
+    __slots__ = ('messages_out', 'compressed_out', 'raw_bytes_out',
+                 'wire_bytes_out', 'compress_time', 'messages_in',
+                 'compressed_in', 'raw_bytes_in', 'wire_bytes_in',
+                 'decompress_time')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        '''
+        :returns: dict -- The counters and ``ratio_out``/``ratio_in``,
+                  wire bytes per raw byte (``1.0`` when nothing has been
+                  transferred).
+        '''
+        stats = dict((name, getattr(self, name)) for name in self.__slots__)
+        stats['ratio_out'] = (float(self.wire_bytes_out) /
+                              self.raw_bytes_out if self.raw_bytes_out
+                              else 1.0)
+        stats['ratio_in'] = (float(self.wire_bytes_in) /
+                             self.raw_bytes_in if self.raw_bytes_in
+                             else 1.0)
+        return stats
+
+
+class CompressionCodec(object):
+    '''
+    Wraps a codec (with its framing) to compress messages larger than
+    ``threshold`` bytes.
+    '''
+
+    def __init__(self, codec, algorithm='zlib', level=None, threshold=1024,
+                 max_size=1 << 26):
+        '''
+        :param codec: The wrapped codec.
+        :type codec: BSONCodec | JSONCodec
+        :param algorithm: Compression algorithm for outgoing messages,
+                          ``None`` to only decompress received ones.
+        :type algorithm: str | None
+        :param level: Compression level, ``None`` for the default of the
+                      algorithm.
+        :type level: int | None
+        :param threshold: Messages smaller than this (framed, in bytes) are
+                          sent uncompressed.
+        :type threshold: int
+        :param max_size: Largest size (in bytes) a received payload may
+                         decompress to, ``None`` for no limit.
+        :type max_size: int | None
+        '''
+        if algorithm is not None and algorithm not in ALGORITHMS:
+            raise ValueError(u'Unknown compression algorithm: %s' %
+                             algorithm)
+        self.codec = codec
+        self.identity = codec.identity
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.max_size = max_size
+        self.stats = CompressionStats()
+        self._flag = 0
+        self._compress = None
+        if algorithm is not None:
+            self._flag, factory = ALGORITHMS[algorithm]
+            self._compress = factory(level)[0]
+        self._decompressors = {}
+
+    def loads(self, b_msg):
+        return self.codec.loads(b_msg)
+
+    def dumps(self, msg):
+        return self.codec.dumps(msg)
+
+    def fragment(self, members):
+        return self.codec.fragment(members)
+
+    def _decompressor(self, flag):
+        decompressor = self._decompressors.get(flag)
+        if decompressor is None:
+            for known_flag, factory in ALGORITHMS.values():
+                if known_flag == flag:
+                    decompressor = factory(None)[1]
+                    break
+            else:
+                raise FramingError(u'Unknown compression flag: %d' % flag)
+            self._decompressors[flag] = decompressor
+        return decompressor
+
+    def into_frame(self, message_bytes):
+        framed = self.codec.into_frame(message_bytes)
+        stats = self.stats
+        stats.messages_out += 1
+        stats.raw_bytes_out += len(framed)
+        flag = 0
+        payload = framed
+        if self._compress is not None and len(framed) >= self.threshold:
+            started = _cpu_time()
+            compressed = self._compress(framed)
+            stats.compress_time += _cpu_time() - started
+            if len(compressed) < len(framed):
+                flag = self._flag
+                payload = compressed
+                stats.compressed_out += 1
+        stats.wire_bytes_out += len(payload) + _HEADER.size
+        return _HEADER.pack(flag, len(payload)) + payload
+
+    def extract_message(self, raw_bytes):
+        if len(raw_bytes) < _HEADER.size:
+            return None, raw_bytes
+        flag, length = _HEADER.unpack_from(raw_bytes)
+        end = _HEADER.size + length
+        if len(raw_bytes) < end:
+            return None, raw_bytes
+        payload = raw_bytes[_HEADER.size:end]
+        stats = self.stats
+        stats.messages_in += 1
+        stats.wire_bytes_in += end
+        if flag:
+            decompressor = self._decompressor(flag)
+            started = _cpu_time()
+            try:
+                payload = _decompress(decompressor(), payload, self.max_size)
+            except FramingError:
+                raise
+            except Exception as e:
+                raise FramingError(e)
+            stats.decompress_time += _cpu_time() - started
+            stats.compressed_in += 1
+        stats.raw_bytes_in += len(payload)
+        b_msg, rest = self.codec.extract_message(payload)
+        if b_msg is None or rest:
+            raise FramingError(u'Compression frame does not contain exactly '
+                               u'one message.')
+        return b_msg, raw_bytes[end:]
@@ -5,6 +5,8 @@ object generators. These generators will create either
 native threading based or greenlet based objects depending
 on which threading_model is selected.
 '''
+import logging
+
 from bsonrpc.options import ThreadingModel
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
@@ -29,6 +31,8 @@ def spawn(threading_model, fn, *args, **kwargs):
         return _spawn_greenlet(fn, *args, **kwargs)
     if threading_model == ThreadingModel.THREADS:
         return _spawn_thread(fn, *args, **kwargs)
+    if isinstance(threading_model, HandlerPool):
+        return threading_model.spawn(fn, *args, **kwargs)
 
 
 def _new_queue(*args, **kwargs):
@@ -65,33 +69,97 @@ def new_lock(threading_model, *args, **kwargs):
         return _new_thread_lock(*args, **kwargs)
 
 
-class Promise(object):
+def sleep(threading_model, seconds):
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent
+        gevent.sleep(seconds)
+    else:
+        import time
+        time.sleep(seconds)
+
 
-    def __init__(self, event):
-        object.__setattr__(self, '_event', event)
-        object.__setattr__(self, '_value', None)
+# Guards only the slow paths of Future: lazy creation of the waiter and
+# the callback list. Plain thread locks like this one are also used with
+# gevent where they are never held while blocking (no greenlet switch can
+# happen while holding them).
+_future_lock = _new_thread_lock()
 
-    def __getattr__(self, name):
-        return getattr(self._event, name)
 
-    def __setattr__(self, name, value):
-        if hasattr(self._event, name):
-            object.__setattr__(self._event, name, value)
-        else:
-            object.__setattr__(self, name, value)
+class Future(object):
+    '''
+    Single-assignment result holder for a pending request.
+
+    The event used for blocking waits is created only if ``wait`` is called
+    before the value has been set.
+    '''
+
+    __slots__ = ('_threading_model', '_done', '_value', '_waiter',
+                 '_callbacks')
+
+    def __init__(self, threading_model):
+        self._threading_model = threading_model
+        self._done = False
+        self._value = None
+        self._waiter = None
+        self._callbacks = None
 
     @property
     def value(self):
         return self._value
 
+    def is_set(self):
+        return self._done
+
     def set(self, value):
-        object.__setattr__(self, '_value', value)
-        self._event.set()
+        self._value = value
+        self._done = True
+        # wait() publishes its waiter before re-checking _done, so at least
+        # one of the two sides sees the other.
+        waiter = self._waiter
+        if waiter is not None:
+            waiter.set()
+        if self._callbacks is not None:
+            self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks = self._callbacks
+        while callbacks:
+            try:
+                callback = callbacks.pop(0)
+            except IndexError:
+                break  # Taken by a concurrent add_done_callback.
+            callback(self._value)
+
+    def add_done_callback(self, fn):
+        '''
+        Call ``fn(value)`` once the value is set. If already set ``fn`` is
+        called immediately in the calling thread, otherwise in the thread
+        setting the value.
+        '''
+        if self._done:
+            fn(self._value)
+            return
+        with _future_lock:
+            if self._callbacks is None:
+                self._callbacks = []
+            self._callbacks.append(fn)
+        if self._done:
+            self._run_callbacks()
 
     def wait(self, timeout=None):
-        if not self._event.wait(timeout):
-            raise RuntimeError(
-                u'Promise timeout after %.02f seconds.' % timeout)
+        if self._done:
+            return self._value
+        waiter = self._waiter
+        if waiter is None:
+            with _future_lock:
+                waiter = self._waiter
+                if waiter is None:
+                    waiter = _new_event(self._threading_model)
+                    self._waiter = waiter
+        if not self._done and not waiter.wait(timeout):
+            if not self._done:
+                raise RuntimeError(
+                    u'Promise timeout after %.02f seconds.' % timeout)
         return self._value
 
 
@@ -105,8 +173,143 @@ def _new_gevent_event():
     return Event()
 
 
-def new_promise(threading_model):
+def _new_event(threading_model):
     if threading_model == ThreadingModel.GEVENT:
-        return Promise(_new_gevent_event())
+        return _new_gevent_event()
     if threading_model == ThreadingModel.THREADS:
-        return Promise(_new_thread_event())
+        return _new_thread_event()
+
+
+def new_promise(threading_model):
+    return Future(threading_model)
+
+
+class _PoolTask(object):
+
+    __slots__ = ('fn', 'args', 'kwargs', '_future')
+
+    def __init__(self, threading_model, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self._future = Future(threading_model)
+
+    def run(self):
+        try:
+            self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self._future.set(None)
+
+    def is_alive(self):
+        return not self._future.is_set()
+
+    def join(self, timeout=None):
+        try:
+            self._future.wait(timeout)
+        except RuntimeError:
+            pass  # Like Thread.join: caller checks is_alive()
+
+
+class HandlerPool(object):
+    '''
+    Fixed size pool of workers executing request/notification handlers.
+
+    A pool can be given as ``concurrent_request_handling`` or
+    ``concurrent_notification_handling`` option - also to several
+    connections to share the pool between them. Workers are started on
+    demand up to ``size``, after which handlers wait in a queue for a free
+    worker.
+
+    Note that handlers waiting for responses from the peer occupy their
+    workers meanwhile. If all workers are waiting for responses, which in
+    turn wait for handlers in this pool, the connections deadlock.
+    '''
+
+    def __init__(self, size=64, threading_model=ThreadingModel.THREADS):
+        '''
+        :param size: Maximum number of workers.
+        :type size: int
+        :param threading_model: Type of the workers.
+        :type threading_model: bsonrpc.ThreadingModel.THREADS or
+                               bsonrpc.ThreadingModel.GEVENT
+        '''
+        self.size = size
+        self.threading_model = threading_model
+        self._lock = _new_thread_lock()
+        self._workers = []
+        self._idle = 0
+        self._queued = 0
+        self._gevent_pool = None
+        if threading_model == ThreadingModel.GEVENT:
+            from gevent.pool import Pool
+            self._gevent_pool = Pool(size)
+        else:
+            self._tasks = new_queue(threading_model)
+
+    def stats(self):
+        '''
+        :returns: dict -- ``size``, ``workers``, ``busy`` and ``queued``.
+        '''
+        if self._gevent_pool is not None:
+            busy = len(self._gevent_pool)
+            return {'size': self.size, 'workers': busy,
+                    'busy': busy, 'queued': 0}
+        workers = len(self._workers)
+        return {'size': self.size, 'workers': workers,
+                'busy': workers - self._idle, 'queued': self._queued}
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            task = self._tasks.get()
+            with self._lock:
+                self._idle -= 1
+                self._queued -= 1
+            if task is None:
+                break
+            task.run()
+
+    def spawn(self, fn, *args, **kwargs):
+        '''
+        Execute ``fn(*args, **kwargs)`` in the pool.
+
+        :returns: Task handle with ``join(timeout=None)`` and ``is_alive()``
+                  (a greenlet in case of gevent).
+        '''
+        if self._gevent_pool is not None:
+            # Blocks while the pool is full.
+            return self._gevent_pool.spawn(fn, *args, **kwargs)
+        from threading import Thread
+        task = _PoolTask(self.threading_model, fn, args, kwargs)
+        worker = None
+        with self._lock:
+            self._queued += 1
+            if (self._queued > self._idle and
+                    len(self._workers) < self.size):
+                worker = Thread(target=self._work)
+                worker.daemon = True
+                self._workers.append(worker)
+        if worker is not None:
+            worker.start()
+        self._tasks.put(task)
+        return task
+
+    def shutdown(self, timeout=None):
+        '''
+        Stop the workers after queued handlers have been executed.
+        '''
+        if self._gevent_pool is not None:
+            self._gevent_pool.join(timeout=timeout)
+            return
+        with self._lock:
+            workers = list(self._workers)
+            self._queued += len(workers)
+        for _ in workers:
+            self._tasks.put(None)
+        for worker in workers:
+            worker.join(timeout)
+        with self._lock:
+            self._workers = [w for w in self._workers if w not in workers]
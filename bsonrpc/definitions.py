@@ -7,7 +7,7 @@ import six
 
 from bsonrpc.exceptions import (
     InternalError, InvalidParams, InvalidRequest, MethodNotFound,
-    ParseError, ServerError, UnspecifiedPeerError)
+    ParseError, ServerDraining, ServerError, UnspecifiedPeerError)
 from bsonrpc.options import NoArgumentsPresentation
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
@@ -20,7 +20,7 @@ class Definitions(object):
         self.protocol_version = protocol_version
         self._no_args = no_args  # Strategy to represent no args
 
-    def _set_params(self, msg, args, kwargs):
+    def set_params(self, msg, args, kwargs):
         if not args and not kwargs:
             if self._no_args == NoArgumentsPresentation.EMPTY_ARRAY:
                 msg['params'] = []
@@ -39,7 +39,7 @@ class Definitions(object):
             'id': msg_id,
             'method': method_name,
         }
-        msg = self._set_params(msg, args, kwargs)
+        msg = self.set_params(msg, args, kwargs)
         return msg
 
     def notification(self, method_name, args, kwargs):
@@ -47,7 +47,7 @@ class Definitions(object):
             self.protocol: self.protocol_version,
             'method': method_name,
         }
-        msg = self._set_params(msg, args, kwargs)
+        msg = self.set_params(msg, args, kwargs)
         return msg
 
     def ok_response(self, msg_id, result):
@@ -57,6 +57,29 @@ class Definitions(object):
             'result': result
         }
 
+    def spliced_ok_response(self, msg_id, result_fragment):
+        return SplicedMessage({
+            self.protocol: self.protocol_version,
+            'id': msg_id,
+        }, result_fragment)
+
+    def stream_item(self, msg_id, item):
+        return {
+            self.protocol: self.protocol_version,
+            'id': msg_id,
+            'stream_item': item,
+        }
+
+    def stream_control(self, msg_id, credit, cancel=False):
+        msg = {
+            self.protocol: self.protocol_version,
+            'id': msg_id,
+            'stream_credit': credit,
+        }
+        if cancel:
+            msg['stream_cancel'] = True
+        return msg
+
     def error_response(self, msg_id, error, details=None):
         msg = {
             self.protocol: self.protocol_version,
@@ -97,6 +120,20 @@ class Definitions(object):
                 isinstance(msg.get('id', None), (six.string_types, int)) and
                 (result_and_no_error or error_and_no_result))
 
+    def _valid_stream_id(self, msg):
+        return (self._chk_protocol(msg) and
+                isinstance(msg.get('id', None), (six.string_types, int)) and
+                'method' not in msg and
+                'result' not in msg and
+                'error' not in msg)
+
+    def is_stream_item(self, msg):
+        return 'stream_item' in msg and self._valid_stream_id(msg)
+
+    def is_stream_control(self, msg):
+        return (isinstance(msg.get('stream_credit', None), int) and
+                self._valid_stream_id(msg))
+
     def is_nil_id_error_response(self, msg):
         error_and_no_result = 'error' in msg and 'result' not in msg
         return (self._chk_protocol(msg) and
@@ -121,6 +158,38 @@ class Definitions(object):
         return True
 
 
+class Fragment(object):
+    '''
+    Pre-encoded members of a message object. Created by the ``fragment``
+    method of the codecs and spliced into outgoing messages by wrapping
+    them into a ``SplicedMessage``.
+    '''
+
+    __slots__ = ('data', 'count')
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+
+class SplicedMessage(object):
+    '''
+    Outgoing message object some members of which are given as
+    pre-encoded fragments. Codecs encode ``msg`` and splice the
+    fragments in without re-encoding them.
+    '''
+
+    __slots__ = ('msg', 'fragments')
+
+    def __init__(self, msg, *fragments):
+        self.msg = msg
+        self.fragments = fragments
+
+    def __repr__(self):
+        return '%r + <%d pre-encoded bytes>' % (
+            self.msg, sum(len(f.data) for f in self.fragments))
+
+
 class RpcErrors(object):
 
     parse_error = {'code': -32700, 'message': 'Parse error'}
@@ -129,6 +198,7 @@ class RpcErrors(object):
     invalid_params = {'code': -32602, 'message': 'Invalid params'}
     internal_error = {'code': -32603, 'message': 'Internal error'}
     server_error = {'code': -32000, 'message': 'Server error'}
+    server_draining = {'code': -32001, 'message': 'Server draining'}
 
     _promote = {
         -32700: ParseError,
@@ -137,6 +207,7 @@ class RpcErrors(object):
         -32602: InvalidParams,
         -32603: InternalError,
         -32000: ServerError,
+        -32001: ServerDraining,
     }
 
     @classmethod
@@ -4,17 +4,28 @@ Dispatcher for RPC Objects. Routes messages and executes services.
 '''
 import logging
 import six
+from threading import Lock
 
-from bsonrpc.concurrent import new_promise, spawn
+from bsonrpc.concurrent import _new_event, new_promise, spawn
 from bsonrpc.definitions import RpcErrors
-from bsonrpc.exceptions import BsonRpcError
+from bsonrpc.exceptions import BsonRpcError, ConnectionClosed
+from bsonrpc.executors import run_in_executor
+from bsonrpc.heartbeat import PING, PONG
+from bsonrpc.histogram import MethodHistograms
+from bsonrpc.misc import monotonic, thread_time
 from bsonrpc.options import ThreadingModel
+from bsonrpc.pending import PendingTable
+from bsonrpc.slowlog import SlowRequestLog
+from bsonrpc.stats import INTROSPECTION_METHOD
+from bsonrpc.streams import StreamCredit, iter_items, materialize
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
 
 class RpcForServices(object):
 
+    __slots__ = ('_rpc', '_close_after', '_aborted')
+
     def __init__(self, rpc):
         self._rpc = rpc
         self._close_after = False
@@ -29,7 +40,8 @@ class RpcForServices(object):
         return self._close_after
 
     def __getattr__(self, name):
-        if name in ('close', 'join',) or name.startswith('_'):
+        # drain and join would wait for the calling handler itself.
+        if name in ('close', 'drain', 'join') or name.startswith('_'):
             raise AttributeError(
                 "'%s' is not allowed within service handler.'" % name)
         return getattr(self._rpc, name)
@@ -49,12 +61,43 @@ class Dispatcher(object):
         :param rpc: Rpc parent object.
         :type rpc: RpcBase
         '''
+        # Requests with library allocated ids.
+        self._pending = PendingTable()
+        # Requests with ids from a custom id_generator:
         # {"<msg_id>": <promise>, ...}
         self._responses = {}
         # { ("<msg_id>", "<msg_id>",): promise, ...}
         self._batch_responses = {}
+        # Credits of streams sent by request handlers:
+        # {"<msg_id>": <StreamCredit>, ...}
+        self._streams = {}
         # Active threads
         self._active_threads = []
+        # Requests, batches and notifications being handled.
+        self._in_flight = 0
+        self._in_flight_peak = 0
+        self._pending_peak = 0
+        self._in_flight_lock = Lock()
+        self._idle = _new_event(rpc.threading_model)
+        self._idle.set()
+        self._draining = False
+        #: Wall clock time of request handlers by method.
+        self.handler_wall = MethodHistograms()
+        #: CPU time of the threads running request handlers by method.
+        self.handler_cpu = MethodHistograms()
+        # Stage times of the message being dispatched (stage_timing).
+        self._timing = None
+        # A message is being dispatched (its handler may run in run()).
+        self._busy = False
+        #: Slow and profiled requests, ``None`` unless enabled by the
+        #: ``slow_request_threshold``/``slow_request_profile_every``
+        #: options.
+        self.slow_log = None
+        if (rpc.slow_request_threshold is not None or
+                rpc.slow_request_profile_every):
+            self.slow_log = SlowRequestLog(rpc.slow_request_threshold,
+                                           rpc.slow_request_profile_every,
+                                           rpc.slow_request_log_size)
         self.rpc = rpc
         self.conn_label = six.text_type(
             self.rpc.connection_id and '%s: ' % self.rpc.connection_id)
@@ -69,25 +112,111 @@ class Dispatcher(object):
     def _log_error(self, msg, *args, **kwargs):
         logging.error(self.conn_label + six.text_type(msg), *args, **kwargs)
 
-    def register(self, msg_id):
-        promise = new_promise(self.rpc.threading_model)
-        if isinstance(msg_id, tuple):
+    def register(self, msg_id=None, promise=None):
+        '''
+        Register a promise for the response(s) to be received.
+
+        :param msg_id: Request id, tuple of request ids of a batch or
+                       ``None`` to allocate a new request id.
+        :param promise: Object to receive the response with ``set(value)``
+                        (e.g. a ``ResultStream``) or ``None`` for a new
+                        promise.
+        :returns: msg_id, promise
+        '''
+        if promise is None:
+            promise = new_promise(self.rpc.threading_model)
+        if msg_id is None:
+            msg_id = self._pending.register(promise)
+        elif isinstance(msg_id, tuple):
             self._batch_responses[msg_id] = promise
         else:
             self._responses[msg_id] = promise
-        return promise
+        pending = self.pending_count
+        if pending > self._pending_peak:
+            self._pending_peak = pending
+        return msg_id, promise
 
     def unregister(self, msg_id):
         if isinstance(msg_id, tuple):
-            promise = self._batch_responses.get(msg_id)
-            if msg_id in self._batch_responses:
-                del self._batch_responses[msg_id]
+            self._batch_responses.pop(msg_id, None)
+        elif msg_id in self._responses:
+            del self._responses[msg_id]
         else:
-            promise = self._responses.get(msg_id)
-            if msg_id in self._responses:
-                del self._responses[msg_id]
-        if promise and not promise.is_set():
-            promise.set(BsonRpcError('Timeout'))
+            self._pending.unregister(msg_id)
+
+    @property
+    def in_flight(self):
+        '''
+        Number of requests, batches and notifications being handled.
+        '''
+        return self._in_flight
+
+    @property
+    def in_flight_peak(self):
+        '''
+        Highest ``in_flight`` seen.
+        '''
+        return self._in_flight_peak
+
+    @property
+    def pending_count(self):
+        '''
+        Number of sent requests waiting for responses.
+        '''
+        return (len(self._pending) + len(self._responses) +
+                len(self._batch_responses))
+
+    @property
+    def pending_peak(self):
+        '''
+        Highest number of requests waiting for responses at a time.
+        '''
+        return self._pending_peak
+
+    def _begin(self, reject=True):
+        '''
+        Count a message as in flight.
+
+        :param reject: Refuse if draining.
+        :returns: bool -- False if refused.
+        '''
+        with self._in_flight_lock:
+            if reject and self._draining:
+                return False
+            self._in_flight += 1
+            if self._in_flight > self._in_flight_peak:
+                self._in_flight_peak = self._in_flight
+            self._idle.clear()
+            return True
+
+    def _end(self):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    def start_draining(self):
+        '''
+        Answer new requests with ``RpcErrors.server_draining``.
+        '''
+        with self._in_flight_lock:
+            self._draining = True
+
+    def wait_idle(self, timeout=None):
+        '''
+        Wait for the messages in flight to be handled.
+
+        :returns: bool -- False if ``timeout`` expired.
+        '''
+        return bool(self._idle.wait(timeout))
+
+    def _reject_draining(self, msg_id):
+        try:
+            self.rpc.socket_queue.put(
+                self.rpc.definitions.error_response(
+                    msg_id, RpcErrors.server_draining))
+        except Exception:
+            pass  # Closed meanwhile.
 
     def _handle_parse_error(self, exception):
         try:
@@ -107,18 +236,87 @@ class Dispatcher(object):
         if isinstance(params, dict):
             return [], params
 
-    def _execute_request(self, msg, rfs):
+    def _call_handler(self, method, method_name, rfs, args, kwargs):
+        executor = getattr(method, '_executor', None)
+        if executor is not None:
+            return run_in_executor(executor, self.rpc.threading_model,
+                                   self.rpc.services, method_name,
+                                   args, kwargs)
+        return method(self.rpc.services, rfs, *args, **kwargs)
+
+    def _execute_cached(self, method, method_name, msg_id, rfs, args, kwargs):
+        cache = method._result_cache
+        codec = self.rpc.socket_queue.codec
+
+        def _compute():
+            result = self._call_handler(method, method_name, rfs,
+                                        args, kwargs)
+            return codec.fragment({'result': materialize(result)})
+
+        fragment = cache.fetch(
+            (method_name, codec.identity, cache.key(*args, **kwargs)),
+            _compute,
+            self.rpc.threading_model)
+        return self.rpc.definitions.spliced_ok_response(msg_id, fragment)
+
+    def _execute_stream(self, method, method_name, msg_id, rfs, args,
+                        kwargs, credit):
+        credit = StreamCredit(self.rpc.threading_model, credit)
+        self._streams[msg_id] = credit
+        items = None
+        try:
+            items = iter_items(
+                self._call_handler(method, method_name, rfs, args, kwargs))
+            count = 0
+            for item in items:
+                if not credit.take():
+                    return None  # Cancelled by the caller.
+                self.rpc.socket_queue.put(
+                    self.rpc.definitions.stream_item(msg_id, item))
+                count += 1
+            return self.rpc.definitions.ok_response(msg_id, count)
+        finally:
+            self._streams.pop(msg_id, None)
+            if hasattr(items, 'close'):
+                items.close()
+
+    def _execute_request(self, msg, rfs, queue_wait=None):
         msg_id = msg['id']
         method_name = msg['method']
         args, kwargs = self._get_params(msg)
         try:
+            if (method_name == INTROSPECTION_METHOD and
+                    self.rpc.introspection):
+                return self.rpc.definitions.ok_response(
+                    msg_id, self.rpc.stats())
             method = self.rpc.services._request_handlers.get(method_name)
-            if method:
-                result = method(self.rpc.services, rfs, *args, **kwargs)
-                return self.rpc.definitions.ok_response(msg_id, result)
-            else:
+            if not method:
                 return self.rpc.definitions.error_response(
                     msg_id, RpcErrors.method_not_found)
+            slow_log = self.slow_log
+            if slow_log is not None:
+                measurement = slow_log.start(args, kwargs)
+            started = monotonic()
+            if thread_time is not None:
+                cpu_started = thread_time()
+            try:
+                if isinstance(msg.get('stream'), int):
+                    return self._execute_stream(
+                        method, method_name, msg_id, rfs, args, kwargs,
+                        msg['stream'])
+                if getattr(method, '_result_cache', None) is not None:
+                    return self._execute_cached(
+                        method, method_name, msg_id, rfs, args, kwargs)
+                result = materialize(self._call_handler(
+                    method, method_name, rfs, args, kwargs))
+                return self.rpc.definitions.ok_response(msg_id, result)
+            finally:
+                if thread_time is not None:
+                    self.handler_cpu.record(method_name,
+                                            thread_time() - cpu_started)
+                self.handler_wall.record(method_name, monotonic() - started)
+                if slow_log is not None:
+                    slow_log.finish(msg, measurement, queue_wait)
             # NOTE: Python raises TypeError in the "invalid params" case but
             #       that exception may also originate from any number of places
             #       inside the executed function. Python just does not provide
@@ -132,20 +330,55 @@ class Dispatcher(object):
                 msg_id, RpcErrors.server_error, six.text_type(e))
 
     def _handle_request(self, msg):
+        timer = self.rpc.socket_queue.stage_timer
+        timing = self._timing
+
         def _execute():
+            try:
+                _respond()
+            finally:
+                self._end()
+
+        def _respond():
+            started = monotonic()
+            queue_wait = started - handed_over
+            if timing is not None:
+                timer.record('worker_wait', queue_wait, timing)
+                queue_wait += timing['queue_wait']
             self._log_info(u'Received request: ' + six.text_type(msg))
             rfs = RpcForServices(self.rpc)
-            response = self._execute_request(msg, rfs)
+            response = self._execute_request(msg, rfs, queue_wait)
+            if timing is not None:
+                timer.record('handler', monotonic() - started, timing)
             if rfs.aborted:
                 self._log_info(u'Connection aborted in request handler.')
                 return
-            self.rpc.socket_queue.put(response)
+            if response is None:
+                self._log_info(u'Stream cancelled by peer.')
+                return
+            try:
+                self.rpc.socket_queue.put(response, timing=timing)
+            except Exception:
+                if not self.rpc.is_closed:
+                    raise
+                self._log_info(u'Connection closed before the response '
+                               u'was sent.')
+                return
+            if timing is not None:
+                timer.finish(msg, timing)
             self._log_info(u'Sent response: ' + six.text_type(response))
             if rfs.close_after_response_requested:
                 self.rpc.close()
                 self._log_info(
                     u'RPC closed due to invocation by Request handler.')
+        if not self._begin():
+            self._reject_draining(msg['id'])
+            return
+        handed_over = monotonic()
         tm = self.rpc.concurrent_request_handling
+        if tm is None and 'stream' in msg:
+            # Waiting for credit would block the dispatcher.
+            tm = self.rpc.threading_model
         if tm is None:
             _execute()
         else:
@@ -163,12 +396,18 @@ class Dispatcher(object):
             promise = new_promise(ThreadingModel.THREADS)
             _execute(promise)
         else:
-            promise = new_promise(tm)
+            promise = new_promise(self.rpc.threading_model)
             self._active_threads.append(spawn(tm, _execute, promise))
         return promise
 
     def _execute_notification(self, msg, rfs, after_effects):
         def _execute():
+            try:
+                _handle()
+            finally:
+                self._end()
+
+        def _handle():
             method_name = msg['method']
             args, kwargs = self._get_params(msg)
             method = self.rpc.services._notification_handlers.get(method_name)
@@ -189,6 +428,8 @@ class Dispatcher(object):
                 self._log_error(
                     u'Unrecognized notification from peer: ' +
                     six.text_type(msg))
+        # Notifications can not be refused, they are handled while draining.
+        self._begin(reject=False)
         tm = self.rpc.concurrent_notification_handling
         if tm is None:
             _execute()
@@ -199,12 +440,22 @@ class Dispatcher(object):
             return thr
 
     def _handle_notification(self, msg):
+        if msg['method'] == PING:
+            try:
+                self.rpc.socket_queue.put(
+                    self.rpc.definitions.notification(PONG, (), {}),
+                    block=False)
+            except Exception:
+                pass  # Closing, no need to answer.
+            return
+        if msg['method'] == PONG:
+            return
         rfs = RpcForServices(self.rpc)
         self._execute_notification(msg, rfs, True)
 
     def _handle_response(self, msg):
         msg_id = msg['id']
-        promise = self._responses.get(msg_id)
+        promise = self._pending.get(msg_id) or self._responses.get(msg_id)
         if promise:
             if 'result' in msg:
                 promise.set(msg['result'])
@@ -215,6 +466,46 @@ class Dispatcher(object):
                 u'Unrecognized/expired response from peer: ' +
                 six.text_type(msg))
 
+    def deliver(self, msg):
+        '''
+        Set the promise of a response right away, called by the receiver
+        of the socket queue while this dispatcher is busy (e.g. running a
+        handler calling the peer) or the connection is over its memory
+        budget. Otherwise responses are queued in order with the other
+        messages.
+
+        :returns: bool -- ``msg`` was a response to a waiting caller.
+        '''
+        if not (self._busy or self.rpc.socket_queue.over_budget):
+            return False
+        if type(msg) is not dict or not self.rpc.definitions.is_response(msg):
+            return False
+        promise = (self._pending.get(msg['id']) or
+                   self._responses.get(msg['id']))
+        if not promise or hasattr(promise, 'put_item'):
+            return False  # Stream results follow their items.
+        self._handle_response(msg)
+        return True
+
+    def _handle_stream_item(self, msg):
+        stream = (self._pending.get(msg['id']) or
+                  self._responses.get(msg['id']))
+        if hasattr(stream, 'put_item'):
+            stream.put_item(msg['stream_item'])
+        else:
+            self._log_error(
+                u'Unrecognized/expired stream item from peer: ' +
+                six.text_type(msg))
+
+    def _handle_stream_control(self, msg):
+        credit = self._streams.get(msg['id'])
+        if credit is None:
+            return  # Stream ended meanwhile.
+        if msg.get('stream_cancel'):
+            credit.cancel()
+        else:
+            credit.grant(msg['stream_credit'])
+
     def _handle_nil_id_error_response(self, msg):
         self._log_error(msg)
 
@@ -228,6 +519,12 @@ class Dispatcher(object):
         self._log_error(u'Invalid Request: ' + six.text_type(msg))
 
     def _dispatch_batch(self, msgs):
+        def _execute():
+            try:
+                _process()
+            finally:
+                self._end()
+
         def _process():
             self._log_info(u'Received batch: ' + six.text_type(msgs))
             rfs = RpcForServices(self.rpc)
@@ -258,7 +555,18 @@ class Dispatcher(object):
                 self._log_info(
                     u'RPC closed due to invocation by Request or '
                     u'Notification handler.')
-        self._active_threads.append(spawn(self.rpc.threading_model, _process))
+        if not self._begin():
+            rpcd = self.rpc.definitions
+            responses = [rpcd.error_response(msg['id'],
+                                             RpcErrors.server_draining)
+                         for msg in msgs if 'id' in msg]
+            if responses:
+                try:
+                    self.rpc.socket_queue.put(responses)
+                except Exception:
+                    pass  # Closed meanwhile.
+            return
+        self._active_threads.append(spawn(self.rpc.threading_model, _execute))
 
     def _handle_batch_response(self, msgs):
         def _extract_msg_content(msg):
@@ -272,7 +580,7 @@ class Dispatcher(object):
         resp_map = dict(map(lambda x: (x['id'], x), with_id_msgs))
         msg_ids = set(resp_map.keys())
         resolved = False
-        for idtuple, promise in self._batch_responses.items():
+        for idtuple, promise in list(self._batch_responses.items()):
             if msg_ids.issubset(set(idtuple)):
                 batch_response = []
                 for req_id in idtuple:
@@ -310,6 +618,8 @@ class Dispatcher(object):
                 (rpcd.is_request, self._handle_request),
                 (rpcd.is_notification, self._handle_notification),
                 (rpcd.is_response, self._handle_response),
+                (rpcd.is_stream_item, self._handle_stream_item),
+                (rpcd.is_stream_control, self._handle_stream_control),
                 (rpcd.is_nil_id_error_response,
                     self._handle_nil_id_error_response),
                 (_otherwise, self._handle_schema_error),
@@ -321,10 +631,12 @@ class Dispatcher(object):
             ]
         }
 
+        timer = self.rpc.socket_queue.stage_timer
         self._log_info(u'Start RPC message dispatcher.')
         while True:
             try:
-                msg = self.rpc.socket_queue.get()
+                msg, timing = self.rpc.socket_queue.get_timed()
+                received = monotonic() if timing is not None else None
                 self._active_threads = list(
                     filter(lambda t: _is_alive(t), self._active_threads))
                 if msg is None:
@@ -337,12 +649,36 @@ class Dispatcher(object):
                             type(msg),
                             [(_otherwise, self._handle_schema_error)]):
                         if match_fn(msg):
-                            handler_fn(msg)
+                            if timing is not None:
+                                timer.record('dispatch',
+                                             monotonic() - received, timing)
+                                self._timing = timing
+                            self._busy = True
+                            try:
+                                handler_fn(msg)
+                            finally:
+                                self._busy = False
+                                self._timing = None
                             break
             except Exception as e:
                 self._log_error(e)
+        for credit in list(self._streams.values()):
+            credit.cancel()  # Release handlers waiting for credit.
+        self._fail_pending()
         self._log_info(u'Exit RPC message dispatcher.')
 
+    def _fail_pending(self):
+        '''
+        Release callers waiting for responses which will never arrive.
+        '''
+        promises = (self._pending.promises() +
+                    list(self._responses.values()) +
+                    list(self._batch_responses.values()))
+        for promise in promises:
+            if not getattr(promise, 'is_set', lambda: False)():
+                promise.set(ConnectionClosed(
+                    u'Connection closed before the response was received.'))
+
     def join(self, timeout=None):
         def _totaljoiner():
             self._thread.join()
@@ -39,6 +39,25 @@ class DecodingError(CodecError):
     '''
 
 
+class ConnectionClosed(BsonRpcError):
+    '''
+    Connection closed while waiting for the response to Request(s).
+    '''
+
+
+class HandshakeError(BsonRpcError):
+    '''
+    Peers failed to agree on the connection setup, see
+    ``bsonrpc.handshake``.
+    '''
+
+
+class MemoryBudgetExceeded(BsonRpcError):
+    '''
+    Connection closed for holding more memory than its ``memory_budget``.
+    '''
+
+
 class ResponseTimeout(BsonRpcError):
     '''
     Response to Request(s) did not arrive in required time.
@@ -101,3 +120,10 @@ class ServerError(PeerError):
     '''
     Code -32000
     '''
+
+
+class ServerDraining(ServerError):
+    '''
+    Code -32001, the peer is shutting down and did not execute the
+    request. Safe to retry with another peer.
+    '''
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+Running request handlers in executors, e.g. CPU-bound handlers in
+a process pool.
+'''
+from __future__ import absolute_import
+
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from bsonrpc.options import ThreadingModel
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+_process_pool = None
+_process_pool_lock = Lock()
+
+# Attribute of services objects holding their token in the registry.
+_TOKEN = '_bsonrpc_executor_token'
+
+# In worker processes: token -> services object received, least recently
+# used first.
+_worker_services = OrderedDict()
+
+# Services objects kept per worker process. Evicted ones are sent again
+# when used.
+_WORKER_SERVICES_MAX = 256
+
+
+def process_pool(max_workers=None):
+    '''
+    The shared process pool used by ``@request(executor='process')``
+    handlers. Created on first use.
+
+    :param max_workers: Number of worker processes if the pool is created
+                        by this call. Default: ``None`` (number of CPUs)
+    :type max_workers: int | None
+    :returns: concurrent.futures.ProcessPoolExecutor
+    '''
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _process_pool = ProcessPoolExecutor(max_workers)
+        return _process_pool
+
+
+def shutdown_process_pool(wait=True):
+    '''
+    Shut down the shared process pool. A new pool is created if it is
+    used again.
+    '''
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait)
+
+
+def _discard_broken(pool):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+
+
+class _NotRegistered(Exception):
+    '''
+    The worker process has not received the services object.
+    '''
+
+
+def _token(services):
+    # Identifies the services object (not its class) across processes.
+    token = getattr(services, _TOKEN, None)
+    if token is None:
+        token = uuid.uuid4().hex
+        setattr(services, _TOKEN, token)
+    return token
+
+
+def _call_handler(services, method_name, args, kwargs):
+    method = type(services)._request_handlers[method_name]
+    return method(services, None, *args, **kwargs)
+
+
+def _call_registered(token, method_name, args, kwargs):
+    # Executed in the worker: only the token, method name and parameters
+    # are pickled per call.
+    services = _worker_services.pop(token, None)
+    if services is None:
+        raise _NotRegistered()
+    _worker_services[token] = services  # Most recently used.
+    return _call_handler(services, method_name, args, kwargs)
+
+
+def _register_and_call(token, services, method_name, args, kwargs):
+    _worker_services[token] = services
+    while len(_worker_services) > _WORKER_SERVICES_MAX:
+        _worker_services.popitem(last=False)
+    return _call_handler(services, method_name, args, kwargs)
+
+
+def _wait(future, threading_model):
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent
+        # Wait in the hub's native thread pool to not block the hub.
+        return gevent.get_hub().threadpool.apply(future.result)
+    return future.result()
+
+
+def validate_executor(executor):
+    '''
+    :returns: ``executor`` if it is valid for ``@request(executor=...)``.
+    :raises TypeError: if it is not.
+    '''
+    if executor is None or executor == 'process':
+        return executor
+    from concurrent.futures import Executor
+    if not isinstance(executor, Executor):
+        raise TypeError("executor must be 'process' or a "
+                        "concurrent.futures.Executor instance.")
+    return executor
+
+
+def run_in_executor(executor, threading_model, services, method_name,
+                    args, kwargs):
+    '''
+    Execute request handler ``method_name`` of ``services`` in
+    ``executor`` and wait for the result.
+
+    Parameters and result are pickled when passed to a process pool. The
+    services object is sent to each worker process once and kept there
+    (identified by a token set on it), so handlers see a copy of their own
+    services object as it was when first sent to the worker.
+    '''
+    from concurrent.futures.process import (
+        BrokenProcessPool, ProcessPoolExecutor)
+    pool = process_pool() if executor == 'process' else executor
+    try:
+        if not isinstance(pool, ProcessPoolExecutor):
+            return _wait(pool.submit(
+                _call_handler, services, method_name, args, kwargs),
+                threading_model)
+        token = _token(services)
+        try:
+            return _wait(pool.submit(
+                _call_registered, token, method_name, args, kwargs),
+                threading_model)
+        except _NotRegistered:
+            return _wait(pool.submit(
+                _register_and_call, token, services, method_name, args,
+                kwargs), threading_model)
+    except BrokenProcessPool:
+        # A worker died, following calls start over with a new pool.
+        if executor == 'process':
+            _discard_broken(pool)
+        raise
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+'''
+Negotiation of framing, compression and features at connection start,
+enabled with the ``handshake`` option on both peers.
+
+Before any message, each side sends one line: ``bsonrpc-hello `` and a
+JSON object advertising
+
+* ``protocol``: ``bsonrpc`` or ``jsonrpc`` -- must be the same on both
+  sides, the connector classes are not negotiated
+* ``framings``: JSON framings accepted (``handshake_framings`` option,
+  default: all built-in framings)
+* ``compression``: the algorithm it wants to compress with (the
+  ``compression`` option) and ``accepts``, the algorithms it can
+  decompress
+* ``features``: e.g. ``batch``, ``stream``, ``attachments``
+
+Both sides then choose the same: the best framing accepted by both, in
+the order of ``FRAMINGS``, and compression of each direction with the
+sender's algorithm if the receiver accepts it. So a faster framing or
+compression can be rolled out one peer at a time: it is used as soon as
+both peers of a connection support it.
+'''
+import json
+
+from bsonrpc.compression import ALGORITHMS, CompressionCodec
+from bsonrpc.exceptions import HandshakeError
+from bsonrpc.framing import (
+    JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
+from bsonrpc.socket_queue import JSONCodec
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+MAGIC = b'bsonrpc-hello '
+
+VERSION = 1
+
+#: Built-in JSON framings by name, best first.
+FRAMINGS = (
+    ('netstring', JSONFramingNetstring),
+    ('rfc7464', JSONFramingRFC7464),
+    ('none', JSONFramingNone),
+)
+
+# Longest hello line accepted.
+_MAX_LINE = 1 << 16
+
+
+def _framing_name(framing_cls):
+    for name, known in FRAMINGS:
+        if known is framing_cls:
+            return name
+    raise HandshakeError(u'Only built-in framings can be negotiated, not %s.'
+                         % framing_cls.__name__)
+
+
+def _accepted_algorithms():
+    accepted = []
+    for name, (_, factory) in sorted(ALGORITHMS.items()):
+        try:
+            factory(None)
+        except ImportError:
+            continue
+        accepted.append(name)
+    return accepted
+
+
+def hello(rpc):
+    '''
+    :returns: dict -- What ``rpc`` advertises to its peer.
+    '''
+    features = ['attachments', 'heartbeat', 'stream']
+    if hasattr(rpc, 'batch_call'):
+        features.append('batch')
+    advertised = {
+        'version': VERSION,
+        'protocol': rpc.protocol,
+        'compression': rpc.compression,
+        'accepts': _accepted_algorithms(),
+        'features': sorted(features),
+    }
+    if rpc.protocol == 'jsonrpc':
+        framings = rpc.handshake_framings
+        if framings is None:
+            framings = [framing_cls for _, framing_cls in FRAMINGS]
+        advertised['framings'] = [_framing_name(framing_cls)
+                                  for framing_cls in framings]
+    return advertised
+
+
+def _read_line(socket):
+    data = b''
+    while b'\n' not in data:
+        if len(data) > _MAX_LINE:
+            raise HandshakeError(u'Handshake line too long.')
+        chunk = socket.recv(4096)
+        if not chunk:
+            raise HandshakeError(u'Connection closed during handshake.')
+        data += chunk
+    line, _, rest = data.partition(b'\n')
+    return line, rest
+
+
+def exchange(socket, advertised, timeout=None):
+    '''
+    Send ``advertised`` and receive the peer's hello.
+
+    :param timeout: Seconds to wait for the peer, if ``socket`` supports
+                    timeouts.
+    :returns: (peer's hello (dict), bytes received after it)
+    '''
+    previous = None
+    has_timeout = hasattr(socket, 'settimeout')
+    if has_timeout:
+        previous = socket.gettimeout()
+        socket.settimeout(timeout)
+    try:
+        socket.sendall(MAGIC + json.dumps(advertised,
+                                          sort_keys=True).encode('utf-8') +
+                       b'\n')
+        line, rest = _read_line(socket)
+    except HandshakeError:
+        raise
+    except Exception as e:
+        raise HandshakeError(u'Handshake failed: %s' % e)
+    finally:
+        if has_timeout:
+            socket.settimeout(previous)
+    if not line.startswith(MAGIC):
+        raise HandshakeError(u'Peer does not handshake.')
+    try:
+        peer = json.loads(line[len(MAGIC):].decode('utf-8'))
+    except Exception as e:
+        raise HandshakeError(u'Malformed handshake: %s' % e)
+    if type(peer) is not dict:
+        raise HandshakeError(u'Malformed handshake.')
+    return peer, rest
+
+
+def choose(local, peer):
+    '''
+    Choose the connection setup both sides agree on.
+
+    :param local: Hello of this side.
+    :param peer: Hello of the peer.
+    :returns: dict -- ``protocol``, ``framing`` (name or ``None``),
+              ``compression_out``/``compression_in`` (algorithm or
+              ``None``) and ``features`` supported by both.
+    :raises: HandshakeError if there is no common setup.
+    '''
+    if peer.get('protocol') != local['protocol']:
+        raise HandshakeError(u'Protocol mismatch: %s (peer) != %s.' %
+                             (peer.get('protocol'), local['protocol']))
+    framing = None
+    if 'framings' in local:
+        common = set(local['framings']) & set(peer.get('framings') or [])
+        for name, _ in FRAMINGS:
+            if name in common:
+                framing = name
+                break
+        else:
+            raise HandshakeError(u'No common framing.')
+
+    def _direction(sender, receiver):
+        algorithm = sender.get('compression')
+        if algorithm in (receiver.get('accepts') or []):
+            return algorithm
+        return None
+
+    return {
+        'protocol': local['protocol'],
+        'framing': framing,
+        'compression_out': _direction(local, peer),
+        'compression_in': _direction(peer, local),
+        'features': sorted(set(local['features']) &
+                           set(peer.get('features') or [])),
+    }
+
+
+def negotiate(rpc, socket, codec):
+    '''
+    Handshake over ``socket`` for the connector ``rpc``.
+
+    :param codec: Codec of ``rpc`` as configured.
+    :returns: (codec to use, bytes received after the handshake, result
+              of ``choose``)
+    :raises: HandshakeError
+    '''
+    local = hello(rpc)
+    peer, rest = exchange(socket, local, rpc.handshake_timeout)
+    chosen = choose(local, peer)
+    if chosen['framing'] is not None:
+        framing_cls = dict(FRAMINGS)[chosen['framing']]
+        rpc.framing_cls = framing_cls
+        codec = JSONCodec(framing_cls.extract_message,
+                          framing_cls.into_frame,
+                          custom_codec_implementation=codec.identity[1])
+    if chosen['compression_out'] or chosen['compression_in']:
+        # Both sides come to the same decision -> both use compression
+        # frames.
+        codec = CompressionCodec(codec, chosen['compression_out'],
+                                 rpc.compression_level,
+                                 rpc.compression_threshold,
+                                 rpc.compression_max_size)
+    return codec, rest, chosen
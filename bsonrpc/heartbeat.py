@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+Heartbeats and reaping of idle connections.
+
+Connections with the ``heartbeat_interval`` or ``idle_timeout`` option
+are watched by one monitor thread (or greenlet) per threading model:
+
+* When nothing has been received from the peer for ``heartbeat_interval``
+  seconds, an ``rpc.ping`` notification is sent. The peer answers with an
+  ``rpc.pong`` notification.
+* When nothing has been received for ``idle_timeout`` seconds, the
+  connection is closed ("reaped"). Requests waiting for responses fail
+  with ``ConnectionClosed``.
+'''
+import weakref
+from threading import Lock
+
+from bsonrpc.concurrent import sleep
+from bsonrpc.misc import monotonic
+from bsonrpc.options import ThreadingModel
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+PING = 'rpc.ping'
+
+PONG = 'rpc.pong'
+
+
+class HeartbeatMonitor(object):
+    '''
+    Sends heartbeats to and reaps the idle connections registered to it.
+    '''
+
+    def __init__(self, threading_model):
+        self.threading_model = threading_model
+        self.tick = 1.0
+        #: Number of connections closed for being idle.
+        self.reaped = 0
+        #: Number of pings sent.
+        self.pings = 0
+        self._connections = weakref.WeakSet()
+        self._last_ping = weakref.WeakKeyDictionary()
+        self._lock = Lock()
+        self._running = False
+
+    def stats(self):
+        '''
+        :returns: dict -- ``connections`` (watched), ``reaped`` and
+                  ``pings``.
+        '''
+        return {'connections': len(self._connections),
+                'reaped': self.reaped,
+                'pings': self.pings}
+
+    def register(self, rpc):
+        intervals = [value for value in (rpc.heartbeat_interval,
+                                         rpc.idle_timeout) if value]
+        self.tick = min([self.tick] + [max(0.01, i / 4.0)
+                                       for i in intervals])
+        with self._lock:
+            self._connections.add(rpc)
+            if self._running:
+                return
+            self._running = True
+        self._start()
+
+    def _start(self):
+        if self.threading_model == ThreadingModel.GEVENT:
+            import gevent
+            gevent.spawn(self._run)
+        else:
+            from threading import Thread
+            thread = Thread(target=self._run, name='bsonrpc-heartbeat')
+            thread.daemon = True
+            thread.start()
+
+    def _check(self, rpc, now):
+        if rpc.is_closed:
+            self._connections.discard(rpc)
+            return
+        idle = now - rpc.socket_queue.last_received
+        if rpc.idle_timeout and idle >= rpc.idle_timeout:
+            self._connections.discard(rpc)
+            rpc.reaped = True
+            self.reaped += 1
+            rpc.dispatcher._log_info(
+                u'Closing connection idle for %.1f seconds.', idle)
+            rpc.close()
+            return
+        interval = rpc.heartbeat_interval
+        if (interval and idle >= interval and
+                now - self._last_ping.get(rpc, 0) >= interval):
+            self._last_ping[rpc] = now
+            # Skipped if another thread is sending (and maybe blocked).
+            if rpc.socket_queue.put(
+                    rpc.definitions.notification(PING, (), {}),
+                    block=False):
+                self.pings += 1
+
+    def _run(self):
+        while True:
+            sleep(self.threading_model, self.tick)
+            with self._lock:
+                connections = list(self._connections)
+                if not connections:
+                    self._running = False
+                    return
+            now = monotonic()
+            for rpc in connections:
+                try:
+                    self._check(rpc, now)
+                except Exception as e:
+                    rpc.dispatcher._log_error(
+                        u'Heartbeat failed: %s', e)
+
+
+_monitors = {}
+
+
+def monitor(threading_model):
+    '''
+    :returns: The HeartbeatMonitor of ``threading_model``.
+    '''
+    if threading_model not in _monitors:
+        _monitors.setdefault(threading_model,
+                             HeartbeatMonitor(threading_model))
+    return _monitors[threading_model]
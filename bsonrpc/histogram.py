@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+'''
+Log-bucketed (HDR-style) latency histograms.
+
+Values are recorded in microseconds into buckets of constant relative
+width: values below 64 us are exact, above them each power of two is
+divided into 32 buckets, i.e. percentiles are within ~3% of the recorded
+values over any range. Recording is a few integer operations and a dict
+update, without locks: concurrent recording may rarely lose a count, the
+same as with the counters of ``bsonrpc.stats``.
+'''
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+_SUB_BITS = 5
+
+_SUB = 1 << _SUB_BITS
+
+
+def bucket_index(micros):
+    '''
+    :param micros: Non-negative integer value.
+    :returns: int -- Index of the bucket of ``micros``.
+    '''
+    if micros < 2 * _SUB:
+        return micros
+    shift = micros.bit_length() - _SUB_BITS - 1
+    return _SUB * (shift + 1) + (micros >> shift) - _SUB
+
+
+def bucket_range(index):
+    '''
+    :returns: (lowest, highest) integer value of the bucket ``index``.
+    '''
+    if index < 2 * _SUB:
+        return index, index
+    shift = index // _SUB - 1
+    mantissa = index % _SUB + _SUB
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class Histogram(object):
+    '''
+    Histogram of durations.
+    '''
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        #: {bucket index: count}
+        self.counts = {}
+        self.count = 0
+        #: Sum of the recorded durations in seconds.
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        '''
+        Record a duration.
+
+        :param seconds: Duration in seconds.
+        :type seconds: float
+        '''
+        if seconds < 0:
+            seconds = 0.0
+        index = bucket_index(int(seconds * 1e6))
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+
+    def merge(self, other):
+        '''
+        Add the recorded values of ``other`` to this histogram.
+
+        :returns: self
+        '''
+        counts = self.counts
+        for index, count in list(other.counts.items()):
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for name, pick in (('min', min), ('max', max)):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if mine is None or theirs is None:
+                setattr(self, name, theirs if mine is None else mine)
+            else:
+                setattr(self, name, pick(mine, theirs))
+        return self
+
+    def copy(self):
+        '''
+        :returns: Histogram -- Independent copy.
+        '''
+        return Histogram().merge(self)
+
+    def percentile(self, percent):
+        '''
+        :param percent: 0 - 100
+        :type percent: float
+        :returns: float | None -- Duration in seconds at or below which
+                  ``percent`` of the recorded durations are (bucket
+                  midpoint), ``None`` if nothing was recorded.
+        '''
+        if not self.count:
+            return None
+        rank = max(1, int(round(percent / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                low, high = bucket_range(index)
+                value = (low + high) / 2.0 / 1e6
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def as_dict(self):
+        '''
+        :returns: dict -- ``count``, ``mean``, ``min``, ``max``, ``p50``,
+                  ``p90``, ``p99`` and ``p999`` in seconds.
+        '''
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+
+class MethodHistograms(object):
+    '''
+    Histograms by method name.
+    '''
+
+    def __init__(self):
+        self._histograms = {}
+
+    def record(self, method_name, seconds):
+        histogram = self._histograms.get(method_name)
+        if histogram is None:
+            histogram = self._histograms.setdefault(method_name, Histogram())
+        histogram.record(seconds)
+
+    def get(self, method_name):
+        '''
+        :returns: Histogram | None
+        '''
+        return self._histograms.get(method_name)
+
+    def methods(self):
+        return sorted(self._histograms)
+
+    def snapshot(self, reset=False):
+        '''
+        :param reset: Start recording into empty histograms.
+        :type reset: bool
+        :returns: MethodHistograms -- Copy of the histograms.
+        '''
+        snapshot = MethodHistograms()
+        if reset:
+            # Recorders holding the old dict may still add to it, so copy
+            # it anyway.
+            histograms, self._histograms = self._histograms, {}
+        else:
+            histograms = self._histograms
+        for name, histogram in list(histograms.items()):
+            snapshot._histograms[name] = histogram.copy()
+        return snapshot
+
+    def merge(self, other):
+        '''
+        Add the histograms of ``other``, e.g. of other connections.
+
+        :returns: self
+        '''
+        for name, histogram in list(other._histograms.items()):
+            mine = self._histograms.get(name)
+            if mine is None:
+                self._histograms[name] = histogram.copy()
+            else:
+                mine.merge(histogram)
+        return self
+
+    def as_dict(self):
+        '''
+        :returns: dict -- ``Histogram.as_dict()`` by method name.
+        '''
+        return dict((name, histogram.as_dict())
+                    for name, histogram in list(self._histograms.items()))
@@ -2,7 +2,10 @@
 '''
 Decorators for proving services.
 '''
-from functools import wraps
+from functools import partial, wraps
+
+from bsonrpc.cache import ResultCache
+from bsonrpc.executors import validate_executor
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
@@ -26,15 +29,49 @@ def service_class(cls):
     return cls
 
 
-def request(method):
+def _result_cache(cache):
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ResultCache()
+    if not isinstance(cache, ResultCache):
+        raise TypeError(
+            'cache must be True or a bsonrpc.ResultCache instance.')
+    return cache
+
+
+def request(method=None, cache=None, executor=None):
     '''
     A method decorator announcing the method to be exposed as
     a request handler.
 
     This decorator assumes that the method parameters are trivially
     exposed to the peer node in 'as-is' manner.
+
+    Can be used either as ``@request`` or with options as
+    ``@request(cache=...)``.
+
+    :param cache: Cache the results of the handler. Either ``True`` for
+                  a cache with default settings or a
+                  ``bsonrpc.ResultCache`` instance for e.g. time to live,
+                  max entries or custom cache key.
+    :type cache: bool | bsonrpc.ResultCache | None
+    :param executor: Run the handler in an executor instead of the thread
+                     handling the request: ``'process'`` for the shared
+                     process pool (see
+                     ``bsonrpc.executors.process_pool``) or
+                     a ``concurrent.futures.Executor`` instance.
+                     Meant for CPU-bound handlers. The services object,
+                     parameters and result must be picklable for process
+                     pools. Each worker process receives the services
+                     object once and the handler works on that copy.
+    :type executor: str | concurrent.futures.Executor | None
     '''
+    if method is None:
+        return partial(request, cache=cache, executor=executor)
     method._request_handler = True
+    method._result_cache = _result_cache(cache)
+    method._executor = validate_executor(executor)
 
     @wraps(method)
     def wrapper(self, rpc, *args, **kwargs):
@@ -58,7 +95,7 @@ def notification(method):
     return wrapper
 
 
-def rpc_request(method):
+def rpc_request(method=None, cache=None):
     '''
     A method decorator announcing the method to be exposed as
     a request handler.
@@ -68,8 +105,14 @@ def rpc_request(method):
     will have an access to make RPC callbacks on the peer node (requests and
     notifications) during its execution. From the second parameter onward the
     parameters are exposed as-is to the peer node.
+
+    Can be used either as ``@rpc_request`` or with options as
+    ``@rpc_request(cache=...)``. See ``request`` for the options.
     '''
+    if method is None:
+        return partial(rpc_request, cache=cache)
     method._request_handler = True
+    method._result_cache = _result_cache(cache)
     return method
 
 
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+'''
+Load generator driving the real client and server code paths.
+
+Starts an ``RpcServer`` with ``LoadServices`` in-process (or connects to
+one started with ``--serve`` elsewhere) and drives load against it:
+
+* closed loop (default): ``--concurrency`` callers, each invoking the next
+  request as soon as the previous one has returned
+* open loop (``--rate``): requests start at a fixed arrival rate, whether
+  or not earlier ones have returned, by up to ``--concurrency`` callers.
+  Latency is measured from the scheduled start of a request, so requests
+  delayed by a saturated system count their delay (no coordinated
+  omission).
+
+Printed are throughput, errors and latency percentiles of requests (of
+batches with ``--batch-size``).
+
+Usage: ``python -m bsonrpc.loadgen [-c bson] [-m echo] [-s 1000]
+[-j 16] [--rate 5000] [-d 10] [--connect host:port | --serve host:port]``
+'''
+from __future__ import division, print_function
+
+import argparse
+import itertools
+import json
+import sys
+from threading import Lock
+
+from bsonrpc.concurrent import sleep, spawn
+from bsonrpc.framing import (
+    JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
+from bsonrpc.histogram import Histogram
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.misc import monotonic
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc, MsgPackRpc
+from bsonrpc.server import RpcServer
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+CODECS = {
+    'bson': BSONRpc,
+    'json': JSONRpc,
+    'msgpack': MsgPackRpc,
+}
+
+FRAMINGS = {
+    'rfc7464': JSONFramingRFC7464,
+    'netstring': JSONFramingNetstring,
+    'none': JSONFramingNone,
+}
+
+THREADING_MODELS = {
+    'threads': ThreadingModel.THREADS,
+    'gevent': ThreadingModel.GEVENT,
+}
+
+METHODS = ('echo', 'sleep', 'payload')
+
+
+def make_payload(shape, size):
+    '''
+    :param shape: ``string``, ``binary``, ``list`` (of integers) or
+                  ``dict`` (of integers by string keys).
+    :param size: Length of the payload.
+    '''
+    if shape == 'string':
+        return u'x' * size
+    if shape == 'binary':
+        return b'x' * size
+    if shape == 'list':
+        return list(range(size))
+    if shape == 'dict':
+        return dict(('k%d' % index, index) for index in range(size))
+    raise ValueError(u'Unknown payload shape: %s' % shape)
+
+
+@service_class
+class LoadServices(object):
+    '''
+    Services of the load generator server.
+    '''
+
+    def __init__(self, threading_model=ThreadingModel.THREADS):
+        self.threading_model = threading_model
+
+    @request
+    def echo(self, value):
+        return value
+
+    @request
+    def sleep(self, seconds):
+        sleep(self.threading_model, seconds)
+
+    @request
+    def payload(self, shape, size):
+        return make_payload(shape, size)
+
+
+def _connect(threading_model, address):
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent.socket as socket_module
+    else:
+        import socket as socket_module
+    return socket_module.create_connection(address)
+
+
+def _address(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class LoadResult(object):
+    '''
+    Latencies and counts of a load run.
+    '''
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = Lock()
+
+    def record(self, seconds, calls, errors):
+        with self._lock:
+            self.latency.record(seconds)
+            self.calls += calls
+            self.errors += errors
+
+    def as_dict(self):
+        '''
+        :returns: dict -- ``calls``, ``errors``, ``seconds``,
+                  ``calls_per_second`` and ``latency`` (see
+                  ``bsonrpc.histogram.Histogram.as_dict``).
+        '''
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'calls_per_second': (self.calls / self.seconds
+                                 if self.seconds else 0.0),
+            'latency': self.latency.as_dict(),
+        }
+
+
+def _call_fn(rpc, args):
+    method = args.method
+    if method == 'echo':
+        params = (make_payload(args.shape, args.size),)
+    elif method == 'sleep':
+        params = (args.sleep,)
+    else:
+        params = (args.shape, args.size)
+    if args.batch_size > 1:
+        batch = [('r', method, params, {})] * args.batch_size
+
+        def _batch():
+            results = rpc.batch_call(batch)
+            return sum(1 for result in results
+                       if isinstance(result, Exception))
+        return _batch
+
+    def _request():
+        rpc.invoke_request(method, *params)
+        return 0
+    return _request
+
+
+def _invoke(result, call, calls, started):
+    try:
+        errors = call()
+    except Exception:
+        errors = calls
+    result.record(monotonic() - started, calls, errors)
+
+
+def run_load(connections, args):
+    '''
+    Drive load over ``connections`` (connectors) for ``args.duration``
+    seconds.
+
+    :returns: LoadResult
+    '''
+    tm = THREADING_MODELS[args.threading_model]
+    result = LoadResult()
+    calls = max(1, args.batch_size)
+    callers = [_call_fn(connections[index % len(connections)], args)
+               for index in range(args.concurrency)]
+    started = monotonic()
+    deadline = started + args.duration
+    if args.rate:
+        arrivals = itertools.count()
+        arrivals_lock = Lock()
+
+        def _caller(call):
+            while True:
+                with arrivals_lock:
+                    scheduled = started + next(arrivals) / args.rate
+                if scheduled >= deadline:
+                    return
+                wait = scheduled - monotonic()
+                if wait > 0:
+                    sleep(tm, wait)
+                _invoke(result, call, calls, scheduled)
+    else:
+        def _caller(call):
+            while monotonic() < deadline:
+                _invoke(result, call, calls, monotonic())
+
+    workers = [spawn(tm, _caller, call) for call in callers]
+    for worker in workers:
+        worker.join()
+    result.seconds = monotonic() - started
+    return result
+
+
+def _options(args):
+    options = {'threading_model': THREADING_MODELS[args.threading_model]}
+    if args.codec == 'json':
+        options['framing_cls'] = FRAMINGS[args.framing]
+    return options
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-c', '--codec', choices=sorted(CODECS),
+                        default='bson', help='(default: bson)')
+    parser.add_argument('-f', '--framing', choices=sorted(FRAMINGS),
+                        default='rfc7464',
+                        help='Framing of JSON RPC. (default: rfc7464)')
+    parser.add_argument('-t', '--threading-model',
+                        choices=sorted(THREADING_MODELS), default='threads',
+                        help='(default: threads)')
+    parser.add_argument('-m', '--method', choices=METHODS, default='echo',
+                        help='echo: send and receive the payload, sleep: '
+                             'wait --sleep seconds, payload: receive the '
+                             'payload. (default: echo)')
+    parser.add_argument('-s', '--size', type=int, default=100,
+                        help='Payload length. (default: 100)')
+    parser.add_argument('--shape', default='string',
+                        choices=('string', 'binary', 'list', 'dict'),
+                        help='Payload shape. (default: string)')
+    parser.add_argument('--sleep', type=float, default=0.001,
+                        help='Seconds slept by the sleep method. '
+                             '(default: 0.001)')
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help='Requests per batch, 1 for no batches. '
+                             '(default: 1)')
+    parser.add_argument('-j', '--concurrency', type=int, default=1,
+                        help='Callers. (default: 1)')
+    parser.add_argument('-n', '--connections', type=int, default=1,
+                        help='Connections shared by the callers. '
+                             '(default: 1)')
+    parser.add_argument('-r', '--rate', type=float,
+                        help='Open loop: requests (batches) started per '
+                             'second. (default: closed loop)')
+    parser.add_argument('-d', '--duration', type=float, default=5.0,
+                        help='Seconds to drive load. (default: 5)')
+    parser.add_argument('--connect', type=_address, metavar='HOST:PORT',
+                        help='Server to load instead of an in-process one.')
+    parser.add_argument('--serve', type=_address, metavar='HOST:PORT',
+                        help='Only run the server, until interrupted.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the result as JSON.')
+    args = parser.parse_args(argv)
+    if args.shape == 'binary' and args.codec == 'json':
+        parser.error('binary payloads require --codec bson or msgpack')
+    if args.concurrency < 1 or args.connections < 1:
+        parser.error('concurrency and connections must be positive')
+    return args
+
+
+def _print_result(result, args):
+    stats = result.as_dict()
+    latency = stats['latency']
+    mode = ('open loop, %g/s' % args.rate if args.rate else
+            'closed loop')
+    print(u'%s %s, %d callers, %d connections, %s' %
+          (args.codec, args.method, args.concurrency, args.connections,
+           mode))
+    print(u'calls:      %d in %.2f s (%d errors)' %
+          (stats['calls'], stats['seconds'], stats['errors']))
+    print(u'throughput: %.1f calls/s' % stats['calls_per_second'])
+    if latency['count']:
+        print(u'latency ms: ' + u'  '.join(
+            u'%s %.3f' % (name, latency[name] * 1e3)
+            for name in ('p50', 'p90', 'p99', 'p999', 'max')))
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    tm = THREADING_MODELS[args.threading_model]
+    rpc_cls = CODECS[args.codec]
+    options = _options(args)
+    server = None
+    if args.connect is None:
+        server = RpcServer(args.serve or ('127.0.0.1', 0),
+                           lambda: LoadServices(tm), rpc_cls,
+                           **options).start()
+        if args.serve:
+            print(u'Serving on %s:%d' % server.bound_address[:2])
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.stop(timeout=5.0)
+            return None
+        address = server.bound_address[:2]
+    else:
+        address = args.connect
+    connections = [rpc_cls(_connect(tm, address),
+                           concurrent_request_handling=tm, **options)
+                   for _ in range(args.connections)]
+    try:
+        result = run_load(connections, args)
+    finally:
+        for rpc in connections:
+            rpc.close()
+        if server is not None:
+            server.stop(timeout=5.0)
+    if args.json:
+        json.dump(result.as_dict(), sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        _print_result(result, args)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''
+Memory accounting of connections.
+
+Counted are the bytes a connection holds:
+
+* ``recv_buffer``: received bytes not yet extracted as messages (partial
+  messages) and attachments being received into memory
+* ``inbound``: received messages waiting in the ``SocketQueue`` for the
+  dispatcher, by their encoded size plus attachments held in memory
+* ``outbound``: encoded messages being sent or waiting for other threads
+  sending on the connection
+
+and ``pending``, the number of requests waiting for responses. Each has
+its current value and high-water mark (``*_peak``).
+
+With the ``memory_budget`` option the receiver of a connection holding
+more than the budget (``recv_buffer`` + ``inbound`` + ``outbound``) stops
+reading from the socket until the dispatcher has caught up, so TCP flow
+control slows down the peer (``MemoryBudgetAction.BACKPRESSURE``). The
+connection is closed if that cannot help, i.e. a single message being
+received (with its attachments held in memory) exceeds the budget, or
+right away with ``MemoryBudgetAction.CLOSE``.
+
+While the dispatcher is busy or the connection is over the budget,
+responses to waiting callers are not queued for the dispatcher but handed
+over by the receiver, and the receiver over the budget reads on until it
+has queued one more message. A handler calling the peer so gets its
+response also while the dispatcher runs that handler
+(``concurrent_request_handling`` ``None``). The response may still wait
+for the budget if more than one other message precedes it.
+'''
+from threading import Lock
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+class MemoryStats(object):
+    '''
+    Byte counts and high-water marks of a ``SocketQueue``.
+    '''
+
+    __slots__ = ('recv_buffer', 'recv_buffer_peak', '_queued', '_taken',
+                 'inbound_peak', 'outbound', 'outbound_peak', '_lock')
+
+    def __init__(self):
+        self.recv_buffer = 0
+        self.recv_buffer_peak = 0
+        # Written by the receiver and the dispatcher only, respectively, so
+        # no update is lost without locking.
+        self._queued = 0
+        self._taken = 0
+        self.inbound_peak = 0
+        self.outbound = 0
+        self.outbound_peak = 0
+        # Guards outbound, updated by any thread sending.
+        self._lock = Lock()
+
+    @property
+    def inbound(self):
+        '''
+        :property: int -- Bytes of messages waiting for the dispatcher.
+        '''
+        return self._queued - self._taken
+
+    @property
+    def total(self):
+        '''
+        :property: int -- Bytes currently held.
+        '''
+        return self.recv_buffer + self.inbound + self.outbound
+
+    def buffered(self, size, peak):
+        '''
+        ``size`` bytes are in the receive buffer, ``peak`` at most meanwhile.
+        '''
+        self.recv_buffer = size
+        if peak > self.recv_buffer_peak:
+            self.recv_buffer_peak = peak
+
+    def queued(self, size):
+        '''
+        A message of ``size`` bytes was queued for the dispatcher.
+        '''
+        self._queued += size
+        inbound = self._queued - self._taken
+        if inbound > self.inbound_peak:
+            self.inbound_peak = inbound
+
+    def taken(self, size):
+        '''
+        The dispatcher took a message of ``size`` bytes.
+        '''
+        self._taken += size
+
+    def sending(self, size):
+        '''
+        ``size`` more (or, if negative, less) bytes are being sent.
+        '''
+        with self._lock:
+            self.outbound += size
+            if self.outbound > self.outbound_peak:
+                self.outbound_peak = self.outbound
+
+    def as_dict(self):
+        '''
+        :returns: dict -- Byte counts (current and ``*_peak``) and
+                  ``total``.
+        '''
+        return {
+            'recv_buffer': self.recv_buffer,
+            'recv_buffer_peak': self.recv_buffer_peak,
+            'inbound': self.inbound,
+            'inbound_peak': self.inbound_peak,
+            'outbound': self.outbound,
+            'outbound_peak': self.outbound_peak,
+            'total': self.total,
+        }
@@ -2,9 +2,33 @@
 '''
 Miscellaneous helper functions.
 '''
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
 
+#: Clock for measuring intervals.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _rusage_thread_time():
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+#: CPU time of the current thread. ``None`` where the platform provides
+#: none (no ``time.thread_time`` nor ``RUSAGE_THREAD``): callers record no
+#: CPU times then rather than wall clock times passing for them.
+thread_time = getattr(time, 'thread_time', None)
+if thread_time is None and hasattr(resource, 'RUSAGE_THREAD'):
+    thread_time = _rusage_thread_time
+
+
 def default_id_generator():
     msg_id = 0
     while True:
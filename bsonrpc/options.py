@@ -2,8 +2,6 @@
 '''
 Option definitions and default options.
 '''
-from bsonrpc.misc import default_id_generator
-
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
 
@@ -13,6 +11,8 @@ class MessageCodec(object):
 
     JSON = 'json'
 
+    MSGPACK = 'msgpack'
+
 
 class ThreadingModel(object):
 
@@ -21,6 +21,13 @@ class ThreadingModel(object):
     GEVENT = 'gevent'
 
 
+class MemoryBudgetAction(object):
+
+    BACKPRESSURE = 'backpressure'
+
+    CLOSE = 'close'
+
+
 class NoArgumentsPresentation(object):
 
     OMIT = 'omit'
@@ -32,9 +39,41 @@ class NoArgumentsPresentation(object):
 
 class DefaultOptionsMixin(object):
 
+    attachment_max_count = 1024
+
+    attachment_max_size = 1 << 30
+
+    attachment_max_total = 1 << 30
+
+    attachment_spool_size = 1 << 20
+
+    compression = None
+
+    compression_level = None
+
+    compression_max_size = 1 << 26
+
+    compression_threshold = 1024
+
     connection_id = ''
 
-    id_generator = default_id_generator()
+    handshake = False
+
+    handshake_framings = None
+
+    handshake_timeout = 10.0
+
+    heartbeat_interval = None
+
+    id_generator = None
+
+    idle_timeout = None
+
+    introspection = False
+
+    memory_budget = None
+
+    memory_budget_action = MemoryBudgetAction.BACKPRESSURE
 
     concurrent_notification_handling = None
 
@@ -42,6 +81,18 @@ class DefaultOptionsMixin(object):
 
     no_arguments_presentation = NoArgumentsPresentation.OMIT
 
+    slow_request_log_size = 100
+
+    slow_request_profile_every = 0
+
+    slow_request_threshold = None
+
+    stage_sample_every = 0
+
+    stage_timing = False
+
+    stream_window = 16
+
     threading_model = ThreadingModel.THREADS
 
     custom_codec_implementation = None
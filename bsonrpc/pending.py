@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+Slot table for requests waiting for their responses.
+'''
+from collections import deque
+from threading import Lock
+
+from bsonrpc.exceptions import BsonRpcError
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+class PendingTable(object):
+    '''
+    Preallocated table of pending requests which also allocates the
+    request ids.
+
+    A request id encodes the index of the slot holding the promise and the
+    generation of the slot: ``id = generation * STRIDE + index``. Generation
+    is incremented at every reuse of the slot, so ids are unique within the
+    table and late responses to expired requests are not mistaken for
+    responses to newer ones.
+
+    Registering, resolving and unregistering are O(1) and lock free:
+    the table relies on the atomicity of single ``deque`` and ``list``
+    operations. Only growing the table takes a lock.
+    '''
+
+    #: Maximum number of slots.
+    STRIDE = 1 << 20
+
+    def __init__(self, size=64):
+        self._promises = [None] * size
+        self._generations = [0] * size
+        self._free = deque(range(size))
+        self._grow_lock = Lock()
+
+    def __len__(self):
+        '''
+        Number of pending requests.
+        '''
+        return len(self._promises) - len(self._free)
+
+    def _grow(self):
+        with self._grow_lock:
+            try:  # Somebody else may have grown the table meanwhile.
+                return self._free.popleft()
+            except IndexError:
+                pass
+            size = len(self._promises)
+            if size >= self.STRIDE:
+                raise BsonRpcError(u'Too many pending requests.')
+            added = min(size, self.STRIDE - size)
+            self._generations.extend([0] * added)
+            self._promises.extend([None] * added)
+            self._free.extend(range(size + 1, size + added))
+            return size
+
+    def register(self, promise):
+        '''
+        Store ``promise`` and allocate a request id for it.
+
+        :returns: Request id (int).
+        '''
+        try:
+            index = self._free.popleft()
+        except IndexError:
+            index = self._grow()
+        generation = self._generations[index] + 1
+        self._generations[index] = generation
+        self._promises[index] = promise
+        return generation * self.STRIDE + index
+
+    def get(self, msg_id):
+        '''
+        :returns: The promise registered with ``msg_id`` or ``None``.
+        '''
+        try:
+            generation, index = divmod(msg_id, self.STRIDE)
+            if self._generations[index] == generation:
+                return self._promises[index]
+        except (IndexError, TypeError):
+            pass  # Not an id allocated by this table.
+        return None
+
+    def unregister(self, msg_id):
+        '''
+        Free the slot of ``msg_id``.
+        '''
+        try:
+            generation, index = divmod(msg_id, self.STRIDE)
+            if (self._generations[index] != generation or
+                    self._promises[index] is None):
+                return
+        except (IndexError, TypeError):
+            return  # Not an id allocated by this table.
+        self._promises[index] = None
+        self._free.append(index)
+
+    def promises(self):
+        '''
+        :returns: list of currently registered promises.
+        '''
+        return [p for p in list(self._promises) if p is not None]
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+'''
+PreforkServer: serves one service definition from several worker processes
+to use all cores of a machine.
+'''
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import time
+from mmap import mmap
+
+import six
+
+from bsonrpc.concurrent import sleep, spawn
+from bsonrpc.misc import monotonic
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import JSONRpc
+from bsonrpc.server import RpcServer, bind_socket
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+# Stats slot of a worker in shared memory:
+# pid, connections, accepted, rejected, busy handlers, queued handlers
+_SLOT = struct.Struct('<6q')
+
+# Stop message to a worker: seconds the worker may take to stop.
+_STOP = struct.Struct('<d')
+
+_STOP_TIMEOUT = 5.0
+
+
+def _fork(threading_model):
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent.os
+        return gevent.os.fork()
+    return os.fork()
+
+
+class PreforkServer(object):
+    '''
+    Pre-forking multi-process RPC server.
+
+    Forks ``workers`` processes, each running an `RpcServer`_ with its own
+    connections and handler pool. On platforms supporting it TCP workers
+    listen on their own ``SO_REUSEPORT`` sockets and the kernel balances
+    connections between them, otherwise all workers accept from one
+    listening socket created before forking.
+
+    The parent process supervises the workers: workers that die are
+    restarted and their stats are combined in ``stats()``. Workers exit
+    when the parent stops (within the timeout given to ``stop()``) or
+    dies.
+
+    Note that each worker has its own copy of ``services``, state is not
+    shared between the workers. Create the server before starting any
+    threads in the parent process.
+
+    Example:
+    ::
+
+      server = PreforkServer(('0.0.0.0', 6000), MyServices, BSONRpc)
+      server.serve_forever()
+    '''
+
+    def __init__(self, address, services, rpc_cls=JSONRpc, workers=None,
+                 reuse_port=None, restart_delay=1.0, stats_interval=0.5,
+                 **server_options):
+        '''
+        :param address: ``(host, port)`` for TCP or a path for a Unix
+                        socket.
+        :type address: tuple | str
+        :param services: As for `RpcServer`_.
+        :param rpc_cls: Connector class.
+        :type rpc_cls: bsonrpc.JSONRpc | bsonrpc.BSONRpc
+        :param workers: Number of worker processes.
+                        Default: ``None`` (number of CPUs)
+        :type workers: int | None
+        :param reuse_port: Whether workers listen on their own
+                           ``SO_REUSEPORT`` sockets. Default: ``None``
+                           (if supported and listening on TCP)
+        :type reuse_port: bool | None
+        :param restart_delay: Seconds to wait before restarting a worker
+                              which died within this time after its start.
+        :type restart_delay: float
+        :param stats_interval: Seconds between stats updates from workers.
+        :type stats_interval: float
+        :param server_options: Other `RpcServer`_ arguments, e.g.
+                               ``max_connections`` (per worker) and
+                               connector options.
+        '''
+        self.address = address
+        self.services = services
+        self.rpc_cls = rpc_cls
+        self.workers = workers or multiprocessing.cpu_count()
+        is_tcp = not isinstance(address, six.string_types)
+        if reuse_port is None:
+            reuse_port = is_tcp and hasattr(socket, 'SO_REUSEPORT')
+        self.reuse_port = reuse_port
+        self.restart_delay = restart_delay
+        self.stats_interval = stats_interval
+        self.server_options = server_options
+        self.threading_model = server_options.get(
+            'threading_model', rpc_cls.threading_model)
+        self._listener = None
+        self._stats = None
+        self._pids = {}           # pid -> [index, started, control fd]
+        self._retired = [0, 0]    # accepted, rejected of dead workers
+        self._restarts = 0
+        self._stopping = False
+        self._supervisor = None
+
+    def _bind(self):
+        if self.reuse_port:
+            # Reserves the port (also a random one) for the workers, a
+            # bound socket which is not listening receives no connections.
+            return bind_socket(self.address, backlog=None, reuse_port=True)
+        return bind_socket(self.address,
+                           backlog=self.server_options.get('backlog', 128))
+
+    @property
+    def bound_address(self):
+        '''
+        :property: Address the workers listen on (e.g. the actual port
+                   if port 0 was given).
+        '''
+        return self._listener.getsockname()
+
+    @property
+    def pids(self):
+        '''
+        :property: list of the process ids of the running workers.
+        '''
+        return sorted(self._pids)
+
+    def _read_slot(self, index):
+        return _SLOT.unpack_from(self._stats, index * _SLOT.size)
+
+    def stats(self):
+        '''
+        :returns: dict -- Combined stats of the workers: ``workers``
+                  (running), ``restarts``, ``connections`` (open),
+                  ``accepted`` and ``rejected`` connection counts,
+                  ``busy`` and ``queued`` handlers and ``per_worker``,
+                  a list of the stats of each running worker.
+        '''
+        per_worker = []
+        for pid, (index, _, _) in sorted(self._pids.items()):
+            slot = self._read_slot(index)
+            per_worker.append({
+                'pid': pid,
+                'connections': slot[1],
+                'accepted': slot[2],
+                'rejected': slot[3],
+                'busy': slot[4],
+                'queued': slot[5],
+            })
+        total = dict(
+            (key, sum(w[key] for w in per_worker))
+            for key in ('connections', 'accepted', 'rejected',
+                        'busy', 'queued'))
+        total['accepted'] += self._retired[0]
+        total['rejected'] += self._retired[1]
+        total['workers'] = len(per_worker)
+        total['restarts'] = self._restarts
+        total['per_worker'] = per_worker
+        return total
+
+    def _stop_timeout(self, message):
+        # Stop message of the parent, EOF only if the parent died.
+        timeout = _STOP_TIMEOUT
+        if len(message) == _STOP.size:
+            timeout = _STOP.unpack(message)[0]
+        # Leave time for the reporter to finish before being killed.
+        return max(0.0, timeout - 2 * self.stats_interval)
+
+    def _worker_main(self, index, control_fd):
+        listener = None
+        address = self.address
+        if not self.reuse_port:
+            listener = self._listener
+            if self.threading_model == ThreadingModel.GEVENT:
+                import gevent.socket
+                listener = gevent.socket.socket(
+                    listener.family, listener.type, 0, listener.detach())
+        else:
+            address = self.bound_address
+            self._listener.close()
+        server = RpcServer(address, self.services, self.rpc_cls,
+                           reuse_port=self.reuse_port, listener=listener,
+                           **self.server_options).start()
+
+        def _report():
+            pool = server.handler_pool.stats()
+            stats = server.stats()
+            _SLOT.pack_into(self._stats, index * _SLOT.size, os.getpid(),
+                            stats['connections'], stats['accepted'],
+                            stats['rejected'], pool['busy'], pool['queued'])
+
+        def _reporter():
+            while not stopped:
+                _report()
+                sleep(self.threading_model, self.stats_interval)
+
+        stopped = []
+        reporter = spawn(self.threading_model, _reporter)
+        if self.threading_model == ThreadingModel.GEVENT:
+            import gevent.os
+            message = gevent.os.tp_read(control_fd, _STOP.size)
+        else:
+            message = os.read(control_fd, _STOP.size)
+        stopped.append(True)
+        server.stop(self._stop_timeout(message))
+        reporter.join()
+        _report()
+
+    def _start_worker(self, index):
+        control_r, control_w = os.pipe()
+        _SLOT.pack_into(self._stats, index * _SLOT.size, 0, 0, 0, 0, 0, 0)
+        pid = _fork(self.threading_model)
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.close(control_w)
+                for _, _, fd in self._pids.values():
+                    if fd is not None:
+                        os.close(fd)  # Pipes of the siblings.
+                self._pids = {}
+                self._worker_main(index, control_r)
+            except BaseException as e:
+                logging.exception(e)
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(control_r)
+        self._pids[pid] = [index, monotonic(), control_w]
+        return pid
+
+    def _reap(self):
+        while self._pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid not in self._pids:
+                continue
+            index, started, control_w = self._pids.pop(pid)
+            if control_w is not None:
+                os.close(control_w)
+            slot = self._read_slot(index)
+            self._retired[0] += slot[2]
+            self._retired[1] += slot[3]
+            _SLOT.pack_into(self._stats, index * _SLOT.size, 0, 0, 0, 0, 0, 0)
+            if self._stopping:
+                continue
+            logging.error(u'Worker %d exited with status %d, restarting.',
+                          pid, status)
+            if monotonic() - started < self.restart_delay:
+                time.sleep(self.restart_delay)  # Don't restart in a loop.
+            if not self._stopping:
+                self._restarts += 1
+                self._start_worker(index)
+
+    def _supervise(self):
+        while not self._stopping:
+            self._reap()
+            time.sleep(0.1)
+
+    def start(self, timeout=10.0):
+        '''
+        Bind, fork the workers and supervise them in a background thread.
+        Returns once the workers are listening.
+
+        :param timeout: Max time in seconds to wait for the workers.
+        :type timeout: float
+        :returns: self
+        '''
+        self._stopping = False
+        self._listener = self._bind()
+        self._stats = mmap(-1, _SLOT.size * self.workers)
+        for index in range(self.workers):
+            self._start_worker(index)
+        deadline = monotonic() + timeout
+        while (monotonic() < deadline and
+               not all(self._read_slot(index)[0]
+                       for index, _, _ in self._pids.values())):
+            time.sleep(0.01)  # Workers report their pid when listening.
+        self._supervisor = spawn(ThreadingModel.THREADS, self._supervise)
+        return self
+
+    def serve_forever(self):
+        '''
+        Start the server and block until it is stopped (or SIGTERM/SIGINT
+        is received, when called from the main thread).
+        '''
+        if self._supervisor is None:
+            self.start()
+        try:
+            signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        except ValueError:
+            pass  # Not the main thread.
+        try:
+            while self._supervisor.is_alive():
+                self._supervisor.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self, timeout=_STOP_TIMEOUT):
+        '''
+        Stop the workers. Workers drain their connections (see
+        `RpcServer`_ ``stop()``) within ``timeout`` seconds, workers still
+        running after that are killed.
+
+        :param timeout: Max time in seconds to wait for the workers.
+        :type timeout: float
+        '''
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.join()
+        deadline = monotonic() + timeout
+        for worker in self._pids.values():
+            try:
+                os.write(worker[2], _STOP.pack(timeout))
+            except OSError:
+                pass  # Died meanwhile.
+            os.close(worker[2])  # Workers also exit at EOF.
+            worker[2] = None
+        while self._pids and monotonic() < deadline:
+            self._reap()
+            time.sleep(0.02)
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+            del self._pids[pid]
+        if self._listener is not None:
+            self._listener.close()
+        if isinstance(self.address, six.string_types):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
@@ -2,28 +2,56 @@
 '''
 Main module providing BSONRpc and JSONRpc.
 '''
+import itertools
 import re
 import six
+from threading import Lock
 
+from bsonrpc import handshake, heartbeat
+from bsonrpc.compression import CompressionCodec
 from bsonrpc.definitions import Definitions
-from bsonrpc.exceptions import BsonRpcError, ResponseTimeout
+from bsonrpc.exceptions import (
+    BsonRpcError, ConnectionClosed, ResponseTimeout)
 from bsonrpc.dispatcher import Dispatcher
 from bsonrpc.framing import JSONFramingRFC7464
+from bsonrpc.histogram import MethodHistograms
+from bsonrpc.misc import monotonic
 from bsonrpc.options import DefaultOptionsMixin, MessageCodec
-from bsonrpc.socket_queue import BSONCodec, JSONCodec, SocketQueue
+from bsonrpc.socket_queue import (
+    BSONCodec, JSONCodec, MsgPackCodec, SocketQueue)
+from bsonrpc.stages import StageTimer
+from bsonrpc.streams import ResultStream
 from bsonrpc.util import BatchBuilder, PeerProxy
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
 
+_TIMEOUT_KEY = re.compile(r'^_*timeout$')
+
+
+def _pop_timeout(kwargs):
+    to_keys = sorted(filter(_TIMEOUT_KEY.match, kwargs.keys()))
+    if to_keys:
+        return kwargs.pop(to_keys[0])
+    return None
+
+
 class ResultScope(object):
-    
-    def __init__(self, dispatcher, msg_id):
+
+    __slots__ = ('dispatcher', 'msg_id')
+
+    def __init__(self, dispatcher, msg_id=None):
+        """
+        :param msg_id: Request id(s) or ``None`` to let the dispatcher
+                       allocate an id, available as ``msg_id`` attribute
+                       after entering the scope.
+        """
         self.dispatcher = dispatcher
         self.msg_id = msg_id
     
     def __enter__(self):
-        return self.dispatcher.register(self.msg_id)
+        self.msg_id, promise = self.dispatcher.register(self.msg_id)
+        return promise
     
     def __exit__(self, tp, value, tb):
         self.dispatcher.unregister(self.msg_id)
@@ -31,17 +59,52 @@ class ResultScope(object):
 
 class RpcBase(DefaultOptionsMixin):
 
+    # Guards custom id generators, possibly shared between connections.
+    _id_generator_lock = Lock()
+
     def __init__(self, socket, codec, services=None, **options):
         assert (hasattr(services, '_request_handlers') and
                 hasattr(services, '_notification_handlers'))
         for key, value in options.items():
             setattr(self, key, value)
+        # Ids for batch requests, if no custom id_generator.
+        self._batch_ids = itertools.count(1)
         self.definitions = Definitions(self.protocol,
                                        self.protocol_version,
                                        self.no_arguments_presentation)
         self.services = services
-        self.socket_queue = SocketQueue(socket, codec, self.threading_model)
+        received = b''
+        #: Result of the handshake, see ``bsonrpc.handshake.choose``,
+        #: ``None`` without the ``handshake`` option.
+        self.negotiated = None
+        if self.handshake:
+            codec, received, self.negotiated = handshake.negotiate(
+                self, socket, codec)
+        elif self.compression:
+            codec = CompressionCodec(codec, self.compression,
+                                     self.compression_level,
+                                     self.compression_threshold,
+                                     self.compression_max_size)
+        stage_timer = (StageTimer(self.stage_sample_every)
+                       if self.stage_timing else None)
+        self.socket_queue = SocketQueue(
+            socket, codec, self.threading_model,
+            attachment_spool_size=self.attachment_spool_size,
+            attachment_max_size=self.attachment_max_size,
+            attachment_max_count=self.attachment_max_count,
+            attachment_max_total=self.attachment_max_total,
+            stage_timer=stage_timer,
+            memory_budget=self.memory_budget,
+            memory_budget_action=self.memory_budget_action,
+            initial_bytes=received)
+        #: Round-trip times of requests invoked by method.
+        self.call_latency = MethodHistograms()
         self.dispatcher = Dispatcher(self)
+        self.socket_queue.bypass = self.dispatcher.deliver
+        #: Closed by the heartbeat monitor for being idle.
+        self.reaped = False
+        if self.heartbeat_interval or self.idle_timeout:
+            heartbeat.monitor(self.threading_model).register(self)
 
     @property
     def is_closed(self):
@@ -50,6 +113,115 @@ class RpcBase(DefaultOptionsMixin):
         '''
         return self.socket_queue.is_closed
 
+    @property
+    def compression_stats(self):
+        '''
+        :property: dict | None -- Message and byte counts, compression
+                   ratios and CPU time spent if the ``compression`` option
+                   is set, see ``bsonrpc.compression.CompressionStats``.
+        '''
+        codec = self.socket_queue.codec
+        if isinstance(codec, CompressionCodec):
+            return codec.stats.as_dict()
+        return None
+
+    def stats(self):
+        '''
+        Snapshot of the traffic and state of this connection.
+
+        :returns: dict -- Counters of ``bsonrpc.stats.ConnectionStats``:
+                  messages and bytes in and out, ``recvs`` and
+                  ``frames_per_recv``, ``encode_time``/``decode_time``
+                  (seconds), error responses by code (``errors_in``,
+                  ``errors_out``), ``decode_errors`` and message size
+                  histograms (``sizes_in``, ``sizes_out``). Also
+                  ``queue_depth`` (received messages waiting for the
+                  dispatcher), ``pending`` (requests waiting for
+                  responses), ``in_flight``/``in_flight_peak`` (handlers
+                  running), ``compression`` (``compression_stats``) and
+                  ``memory``: bytes held (see ``bsonrpc.memory``) and
+                  ``pending``/``pending_peak`` requests.
+        '''
+        stats = self.socket_queue.stats.as_dict()
+        stats['queue_depth'] = self.socket_queue.queue_depth
+        stats['pending'] = self.dispatcher.pending_count
+        stats['in_flight'] = self.dispatcher.in_flight
+        stats['in_flight_peak'] = self.dispatcher.in_flight_peak
+        stats['compression'] = self.compression_stats
+        memory = self.socket_queue.memory.as_dict()
+        memory['pending'] = self.dispatcher.pending_count
+        memory['pending_peak'] = self.dispatcher.pending_peak
+        stats['memory'] = memory
+        stats['latency'] = dict(
+            (name, histograms.as_dict())
+            for name, histograms in self.latency_stats().items())
+        stages = self.stage_stats()
+        stats['stages'] = stages.as_dict() if stages is not None else None
+        return stats
+
+    def stage_stats(self, reset=False):
+        '''
+        Snapshot of the histograms of time spent in each stage of
+        processing messages, see ``bsonrpc.stages``.
+
+        :param reset: Start over with empty histograms.
+        :type reset: bool
+        :returns: bsonrpc.histogram.MethodHistograms | None -- Histograms
+                  by stage name, ``None`` unless the ``stage_timing``
+                  option is set.
+        '''
+        timer = self.socket_queue.stage_timer
+        return timer.histograms(reset) if timer is not None else None
+
+    def stage_samples(self):
+        '''
+        :returns: list of dicts -- Stage times (seconds), ``method`` and
+                  ``id`` of the latest sampled requests, see the
+                  ``stage_sample_every`` option.
+        '''
+        timer = self.socket_queue.stage_timer
+        return timer.samples() if timer is not None else []
+
+    def slow_requests(self, clear=False):
+        '''
+        Dump the slow and profiled requests recorded, see
+        ``bsonrpc.slowlog`` and the ``slow_request_threshold`` and
+        ``slow_request_profile_every`` options.
+
+        :param clear: Empty the record.
+        :type clear: bool
+        :returns: list of dicts -- Records, oldest first, see
+                  ``bsonrpc.slowlog.SlowRequestLog.entries``.
+        '''
+        slow_log = self.dispatcher.slow_log
+        return slow_log.entries(clear) if slow_log is not None else []
+
+    def latency_stats(self, reset=False):
+        '''
+        Snapshot of the latency histograms by method name:
+
+        * ``calls``: round-trip times of requests invoked on this side
+          (responses received, including error responses)
+        * ``handler_wall``: wall clock time of request handlers on this
+          side (for streams, until the last item is sent)
+        * ``handler_cpu``: CPU time of the threads running the handlers,
+          i.e. of the whole thread with greenlets and zero for handlers
+          in a process pool. Empty on platforms without thread CPU time
+          (``time.thread_time`` or ``RUSAGE_THREAD``).
+
+        Snapshots of several connections can be combined with
+        ``MethodHistograms.merge``.
+
+        :param reset: Start over with empty histograms.
+        :type reset: bool
+        :returns: dict -- ``bsonrpc.histogram.MethodHistograms`` by name.
+        '''
+        return {
+            'calls': self.call_latency.snapshot(reset),
+            'handler_wall': self.dispatcher.handler_wall.snapshot(reset),
+            'handler_cpu': self.dispatcher.handler_cpu.snapshot(reset),
+        }
+
     def invoke_request(self, method_name, *args, **kwargs):
         '''
         Invoke RPC Request.
@@ -76,26 +248,107 @@ class RpcBase(DefaultOptionsMixin):
           be used in a single call.
           (Naturally the timeout argument does not count to the rule.)
         '''
-        rec = re.compile(r'^_*timeout$')
-        to_keys = sorted(filter(lambda x: rec.match(x), kwargs.keys()))
-        if to_keys:
-            timeout = kwargs[to_keys[0]]
-            del kwargs[to_keys[0]]
-        else:
-            timeout = None
-        msg_id = six.next(self.id_generator)
+        timeout = _pop_timeout(kwargs)
+        return self._round_trip(
+            self.definitions.request(None, method_name, args, kwargs),
+            timeout)
+
+    def invoke_stream(self, method_name, *args, **kwargs):
+        '''
+        Invoke RPC Request expecting the result as a stream of items.
+
+        Items yielded by a generator handler, or the items of a list
+        result, are sent by the peer one by one and at most
+        ``stream_window`` items ahead of the consumption. Other results are
+        received as a single item.
+
+        :param method_name: Name of the request method.
+        :type method_name: str
+        :param args: Arguments
+        :param kwargs: Keyword Arguments. A ``timeout`` (see
+                       ``invoke_request``) limits the wait for each item.
+        :returns: ResultStream -- Iterator over the items.
+        :raises: BsonRpcError
+        '''
+        timeout = _pop_timeout(kwargs)
+        stream = ResultStream(self, self.stream_window, timeout)
+        stream.msg_id, _ = self.dispatcher.register(
+            None if self.id_generator is None else self._next_id(), stream)
+        msg = self.definitions.request(stream.msg_id, method_name,
+                                       args, kwargs)
+        msg['stream'] = self.stream_window
+        try:
+            self.socket_queue.put(msg)
+        except Exception:
+            self.dispatcher.unregister(stream.msg_id)
+            raise
+        return stream
+
+    def _next_id(self):
+        if self.id_generator is None:
+            return six.next(self._batch_ids)
+        with self._id_generator_lock:
+            return six.next(self.id_generator)
+
+    def _round_trip(self, msg, timeout):
+        # Request id is allocated by the dispatcher unless custom generator.
+        scope = ResultScope(
+            self.dispatcher,
+            None if self.id_generator is None else self._next_id())
+        started = monotonic()
         try:
-            with ResultScope(self.dispatcher, msg_id) as promise:
-                self.socket_queue.put(
-                    self.definitions.request(
-                        msg_id, method_name, args, kwargs))
+            with scope as promise:
+                msg['id'] = scope.msg_id
+                self.socket_queue.put(msg)
                 result = promise.wait(timeout)
         except RuntimeError:
             raise ResponseTimeout(u'Waiting response expired.')
+        if not isinstance(result, ConnectionClosed):
+            self.call_latency.record(msg['method'], monotonic() - started)
         if isinstance(result, Exception):
             raise result
         return result
 
+    def _request_stub(self, method_name, timeout):
+        '''
+        Build a callable equivalent to ``invoke_request(method_name, ...,
+        _____timeout=timeout)`` with the per-method work done up front.
+        '''
+        protocol = self.protocol
+        protocol_version = self.protocol_version
+        set_params = self.definitions.set_params
+
+        def _stub(*args, **kwargs):
+            call_timeout = timeout
+            if kwargs and any(key[-7:] == 'timeout' for key in kwargs):
+                kwargs['_____timeout'] = timeout
+                call_timeout = _pop_timeout(kwargs)
+                kwargs.pop('_____timeout', None)
+            msg = {
+                protocol: protocol_version,
+                'method': method_name,
+            }
+            return self._round_trip(
+                set_params(msg, args, kwargs), call_timeout)
+        return _stub
+
+    def _notification_stub(self, method_name):
+        '''
+        Build a callable equivalent to
+        ``invoke_notification(method_name, ...)``.
+        '''
+        protocol = self.protocol
+        protocol_version = self.protocol_version
+        set_params = self.definitions.set_params
+
+        def _stub(*args, **kwargs):
+            msg = {
+                protocol: protocol_version,
+                'method': method_name,
+            }
+            self.socket_queue.put(set_params(msg, args, kwargs))
+        return _stub
+
     def invoke_notification(self, method_name, *args, **kwargs):
         '''
         Send an RPC Notification.
@@ -160,6 +413,24 @@ class RpcBase(DefaultOptionsMixin):
         # Closing the socket queue causes the dispatcher to close also.
         self.socket_queue.close()
 
+    def drain(self, timeout=None):
+        '''
+        Close the connection gracefully: new requests from the peer are
+        answered with a ``ServerDraining`` error (code -32001, safe to
+        retry elsewhere), the requests, batches and notifications being
+        handled are let finish and send their responses, then the
+        connection is closed.
+
+        :param timeout: Max time in seconds to wait for the handlers,
+                        the connection is closed regardless.
+        :type timeout: float | None
+        :returns: bool -- True if all handlers finished in time.
+        '''
+        self.dispatcher.start_draining()
+        drained = self.dispatcher.wait_idle(timeout)
+        self.close()
+        return drained
+
     def join(self, timeout=None):
         '''
         Wait for the internal dispatcher to shut down.
@@ -170,6 +441,98 @@ class RpcBase(DefaultOptionsMixin):
         self.dispatcher.join(timeout=timeout)
 
 
+class BatchCallMixin(object):
+    '''
+    ``batch_call`` for connectors whose codec supports batches.
+    '''
+
+    def batch_call(self, batch_calls, timeout=None):
+        '''
+        :param batch_calls: Batch of requests/notifications to be executed on
+                            the peer node. Use ``BatchBuilder()`` and pass the
+                            object here as a parameter.
+
+                            Example:
+
+                            .. code-block:: python
+
+                              bb = BatchBuilder(['swapit', 'times'], ['logit'])
+                              bb.swapit('hello')    # request
+                              bb.times(3, 5)        # request
+                              bb.logit('world')     # notification
+                              results = rpc.batch_call(bb, timeout=15.0)
+                              # results: ['olleh', 15]
+
+                            Note that ``BatchBuilder`` is used and behaves like
+                            the peer-proxy returned by ``.get_peer_proxy()``.
+
+                            Instead of BatchBuilder you may give a simple list
+                            argument which must be in the following format:
+                            [("r"/"n", "<method-name>", args, kwargs), ...]
+        :type batch_calls: bsonrpc.BatchBuilder | list of 4-tuples
+        :param timeout: Timeout in seconds for waiting results. Default: None
+        :type timeout: float | None
+        :returns: * list of results to requests, in order of original requests.
+                    Each result may be:
+
+                    * a single return value or
+                    * a tuple of return values or
+                    * an Exception object
+
+                  * ``None`` if ``batch_calls`` contained only notifications.
+        :raises: ResponseTimeout in case batch_calls contains requests,
+                 for which response batch did not arrive within timeout.
+        '''
+        def _compose_batch(batch_calls):
+            request_ids = []
+            batch = []
+            try:
+                for call_type, method_name, args, kwargs in batch_calls:
+                    if call_type.lower().startswith('n'):
+                        batch.append(
+                            self.definitions.notification(
+                                method_name, args, kwargs))
+                    else:
+                        msg_id = self._next_id()
+                        batch.append(
+                            self.definitions.request(
+                                msg_id, method_name, args, kwargs))
+                        request_ids.append(msg_id)
+            except Exception as e:
+                raise BsonRpcError(
+                    u'Malformed batch call: ' + six.text_type(e))
+            return request_ids, batch
+
+        if isinstance(batch_calls, BatchBuilder):
+            batch_calls = batch_calls._batch_calls
+        if not batch_calls:
+            raise BsonRpcError(u'Refusing to send an empty batch.')
+        format_info = (
+            u'Argument "batch_calls"(list) is expected to contain '
+            u'4-tuples of (str, str, list, dict) -types.')
+        for item in batch_calls:
+            assert len(item) == 4, format_info
+            assert isinstance(item[0], six.string_types), format_info
+            assert isinstance(item[1], six.string_types), format_info
+            assert isinstance(item[2], (list, tuple)), format_info
+            assert isinstance(item[3], dict), format_info
+        request_ids, batch = _compose_batch(batch_calls)
+        # Notifications only:
+        if not request_ids:
+            self.socket_queue.put(batch)
+            return None
+        # At least one request in the batch:
+        try:
+            with ResultScope(self.dispatcher, tuple(request_ids)) as promise:
+                self.socket_queue.put(batch)
+                results = promise.wait(timeout)
+        except RuntimeError:
+            raise ResponseTimeout(u'Timeout for waiting batch result.')
+        if isinstance(results, Exception):
+            raise results
+        return results
+
+
 class DefaultServices(object):
 
     _request_handlers = {}
@@ -177,13 +540,15 @@ class DefaultServices(object):
     _notification_handlers = {}
 
 
-class BSONRpc(RpcBase):
+class BSONRpc(RpcBase, BatchCallMixin):
     '''
     BSON RPC Connector. Follows closely `JSON-RPC 2.0`_ specification
     with only few differences:
 
-    * Batches are not supported since BSON does not support top-level lists.
     * Keyword 'jsonrpc' has been replaced by 'bsonrpc'
+    * Batches are sent in an envelope document ``{'batch': [...]}`` since
+      BSON does not support top-level lists. (Peers of versions without
+      batch support answer them with an invalid request error.)
 
     Connects via socket to RPC peer node. Provides access to the services
     provided by the peer node and makes local services available for the peer.
@@ -242,7 +607,7 @@ class BSONRpc(RpcBase):
                 **options)
 
 
-class JSONRpc(RpcBase):
+class JSONRpc(RpcBase, BatchCallMixin):
     '''
     JSON RPC Connector. Implements the `JSON-RPC 2.0`_ specification.
 
@@ -316,88 +681,61 @@ class JSONRpc(RpcBase):
                 services=services,
                 **options)
 
-    def batch_call(self, batch_calls, timeout=None):
-        '''
-        :param batch_calls: Batch of requests/notifications to be executed on
-                            the peer node. Use ``BatchBuilder()`` and pass the
-                            object here as a parameter.
 
-                            Example:
+class MsgPackRpc(RpcBase, BatchCallMixin):
+    '''
+    MessagePack RPC Connector. Follows closely `JSON-RPC 2.0`_
+    specification, messages encoded in MessagePack and framed with a
+    4-byte big endian length prefix. Differences to JSON RPC:
 
-                            .. code-block:: python
+    * Keyword 'jsonrpc' has been replaced by 'msgpackrpc'
+    * Binary data (``bytes``) is sent as is.
 
-                              bb = BatchBuilder(['swapit', 'times'], ['logit'])
-                              bb.swapit('hello')    # request
-                              bb.times(3, 5)        # request
-                              bb.logit('world')     # notification
-                              results = jsonrpc.batch_call(bb, timeout=15.0)
-                              # results: ['olleh', 15]
+    Not the array based MessagePack-RPC protocol.
 
-                            Note that ``BatchBuilder`` is used and behaves like
-                            the peer-proxy returned by ``.get_peer_proxy()``.
+    To use MsgPackRpc you need to install the ``msgpack`` package.
 
-                            Instead of BatchBuilder you may give a simple list
-                            argument which must be in the following format:
-                            [("r"/"n", "<method-name>", args, kwargs), ...]
-        :type batch_calls: bsonrpc.BatchBuilder | list of 4-tuples
-        :param timeout: Timeout in seconds for waiting results. Default: None
-        :type timeout: float | None
-        :returns: * list of results to requests, in order of original requests.
-                    Each result may be:
+    .. _`JSON-RPC 2.0`: http://www.jsonrpc.org/specification
+    '''
 
-                    * a single return value or
-                    * a tuple of return values or
-                    * an Exception object
+    #: Protocol name used in messages
+    protocol = 'msgpackrpc'
 
-                  * ``None`` if ``batch_calls`` contained only notifications.
-        :raises: ResponseTimeout in case batch_calls contains requests,
-                 for which response batch did not arrive within timeout.
+    #: Protocol version used in messages
+    protocol_version = '2.0'
+
+    def __init__(self, socket, services=None, **options):
         '''
-        def _compose_batch(batch_calls):
-            request_ids = []
-            batch = []
-            try:
-                for call_type, method_name, args, kwargs in batch_calls:
-                    if call_type.lower().startswith('n'):
-                        batch.append(
-                            self.definitions.notification(
-                                method_name, args, kwargs))
-                    else:
-                        msg_id = six.next(self.id_generator)
-                        batch.append(
-                            self.definitions.request(
-                                msg_id, method_name, args, kwargs))
-                        request_ids.append(msg_id)
-            except Exception as e:
-                raise BsonRpcError(
-                    u'Malformed batch call: ' + six.text_type(e))
-            return request_ids, batch
+        :param socket: Socket connected to the peer. (Anything behaving like
+                       a socket and implementing socket methods ``close``,
+                       ``recv``, ``sendall`` and ``shutdown`` is equally
+                       viable)
+        :type socket: socket.socket
+        :param services: Object providing request handlers and
+                         notification handlers to be exposed to peer.
+                         See `Providing Services`_ for details.
+        :type services: ``@service_class`` Class | ``None``
+        :param options: Modify behavior by overriding the library defaults.
 
-        if isinstance(batch_calls, BatchBuilder):
-            batch_calls = batch_calls._batch_calls
-        if not batch_calls:
-            raise BsonRpcError(u'Refusing to send an empty batch.')
-        format_info = (
-            u'Argument "batch_calls"(list) is expected to contain '
-            u'4-tuples of (str, str, list, dict) -types.')
-        for item in batch_calls:
-            assert len(item) == 4, format_info
-            assert isinstance(item[0], six.string_types), format_info
-            assert isinstance(item[1], six.string_types), format_info
-            assert isinstance(item[2], (list, tuple)), format_info
-            assert isinstance(item[3], dict), format_info
-        request_ids, batch = _compose_batch(batch_calls)
-        # Notifications only:
-        if not request_ids:
-            self.socket_queue.put(batch)
-            return None
-        # At least one request in the batch:
-        try:
-            with ResultScope(self.dispatcher, tuple(request_ids)) as promise:
-                self.socket_queue.put(batch)
-                results = promise.wait(timeout)
-        except RuntimeError:
-            raise ResponseTimeout(u'Timeout for waiting batch result.')
-        if isinstance(results, Exception):
-            raise results
-        return results
+        **Available options:**
+
+        .. include:: options.snippet
+
+        **custom_codec_implementation**
+          Is by default ``None`` in which case the ``msgpack`` library is
+          used. Otherwise it must have callable attributes ``dumps`` and
+          ``loads`` converting between python data and MessagePack bytes,
+          with ``bytes`` as the binary type.
+
+        All options as well as any possible custom/extra options are
+        available as attributes of the constructed class object.
+        '''
+        self.codec = MessageCodec.MSGPACK
+        if not services:
+            services = DefaultServices()
+        cci = options.get('custom_codec_implementation', None)
+        super(MsgPackRpc, self).__init__(
+                socket,
+                MsgPackCodec(custom_codec_implementation=cci),
+                services=services,
+                **options)
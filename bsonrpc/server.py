@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+'''
+RpcServer: accepts connections on a TCP or Unix socket and serves
+each of them with a JSONRpc/BSONRpc connector.
+'''
+import errno
+import logging
+import os
+import stat
+
+import six
+
+from bsonrpc.concurrent import HandlerPool, new_lock, sleep, spawn
+from bsonrpc.misc import monotonic
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import JSONRpc
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+_ACCEPT_POLL_INTERVAL = 0.5
+
+
+def _socket_module(threading_model):
+    if threading_model == ThreadingModel.GEVENT:
+        import gevent.socket as socket_module
+    else:
+        import socket as socket_module
+    return socket_module
+
+
+def bind_socket(address, threading_model=ThreadingModel.THREADS,
+                backlog=128, reuse_port=False):
+    '''
+    Create a TCP or Unix socket bound to ``address``.
+
+    :param backlog: Listen backlog or ``None`` to only bind the socket.
+    :returns: socket
+    '''
+    socket_module = _socket_module(threading_model)
+    if isinstance(address, six.string_types):
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)  # Stale socket file.
+        except OSError:
+            pass
+        sock = socket_module.socket(socket_module.AF_UNIX,
+                                    socket_module.SOCK_STREAM)
+    else:
+        family = socket_module.AF_INET
+        if ':' in address[0]:
+            family = socket_module.AF_INET6
+        sock = socket_module.socket(family, socket_module.SOCK_STREAM)
+        sock.setsockopt(socket_module.SOL_SOCKET,
+                        socket_module.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket_module.SOL_SOCKET,
+                            socket_module.SO_REUSEPORT, 1)
+    sock.bind(address)
+    if backlog is not None:
+        sock.listen(backlog)
+    return sock
+
+
+class RpcServer(object):
+    '''
+    Multi-connection RPC server.
+
+    Listens on a TCP or Unix socket and serves each accepted connection
+    with an ``rpc_cls`` connector. Request handlers of all connections are
+    executed in one shared ``HandlerPool``.
+
+    Example:
+    ::
+
+      server = RpcServer(('0.0.0.0', 6000), MyServices, BSONRpc)
+      server.serve_forever()
+    '''
+
+    def __init__(self, address, services, rpc_cls=JSONRpc,
+                 max_connections=None, max_accept_rate=None,
+                 handler_pool_size=64, backlog=128, reuse_port=False,
+                 listener=None, **options):
+        '''
+        :param address: ``(host, port)`` for TCP or a path for a Unix
+                        socket.
+        :type address: tuple | str
+        :param services: ``@service_class`` instance shared by all
+                         connections or a factory (e.g. the class) called
+                         without arguments to create a services object for
+                         each connection.
+        :param rpc_cls: Connector class.
+        :type rpc_cls: bsonrpc.JSONRpc | bsonrpc.BSONRpc
+        :param max_connections: Maximum number of simultaneous connections.
+                                Excess connections are closed right after
+                                accepting. Default: ``None`` (unlimited)
+        :type max_connections: int | None
+        :param max_accept_rate: Maximum number of accepted connections per
+                                second. Default: ``None`` (unlimited)
+        :type max_accept_rate: float | None
+        :param handler_pool_size: Size of the shared handler pool.
+        :type handler_pool_size: int
+        :param backlog: Listen backlog.
+        :type backlog: int
+        :param reuse_port: Set ``SO_REUSEPORT`` on the TCP listener so that
+                           several processes can listen on the same port.
+        :type reuse_port: bool
+        :param listener: Already listening socket (e.g. inherited from a
+                         parent process) to accept connections from instead
+                         of binding ``address``. The socket is polled so
+                         that it can be shared between processes.
+        :type listener: socket.socket | None
+        :param options: Options for the connectors, see `JSONRpc Objects`_
+                        and `BSONRpc Objects`_. By default
+                        ``concurrent_request_handling`` is the shared
+                        handler pool. With the ``handshake`` option each
+                        accepted connection handshakes in a thread/greenlet
+                        of its own and counts towards ``max_connections``
+                        meanwhile.
+        '''
+        self.address = address
+        self.rpc_cls = rpc_cls
+        self.max_connections = max_connections
+        self.max_accept_rate = max_accept_rate
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.threading_model = options.get(
+            'threading_model', rpc_cls.threading_model)
+        self.handler_pool = HandlerPool(handler_pool_size,
+                                        self.threading_model)
+        options.setdefault('concurrent_request_handling', self.handler_pool)
+        self.options = options
+        if (hasattr(services, '_request_handlers') and
+                not isinstance(services, type)):
+            self._services_factory = lambda: services
+        else:
+            self._services_factory = services
+        self._connections = []
+        # Accepted sockets still handshaking.
+        self._handshaking = set()
+        self._lock = new_lock(ThreadingModel.THREADS)
+        self._listener = listener
+        self._owns_listener = listener is None
+        self._accept_thread = None
+        self._stopping = False
+        self._accepted = 0
+        self._rejected = 0
+        self._reaped = 0
+
+    def _bind(self):
+        return bind_socket(self.address, self.threading_model,
+                           self.backlog, self.reuse_port)
+
+    @property
+    def bound_address(self):
+        '''
+        :property: Address the server listens on (e.g. the actual port
+                   if port 0 was given).
+        '''
+        return self._listener.getsockname()
+
+    @property
+    def connection_count(self):
+        '''
+        :property: int -- Number of open connections.
+        '''
+        return len(self._prune())
+
+    def connections(self):
+        '''
+        :returns: list of the open connector objects.
+        '''
+        return list(self._prune())
+
+    def stats(self):
+        '''
+        :returns: dict -- ``connections`` (open), ``handshaking``,
+                  ``accepted``, ``rejected`` and ``reaped`` (closed for
+                  being idle) connection counts and handler ``pool``
+                  stats.
+        '''
+        return {
+            'connections': self.connection_count,
+            'handshaking': len(self._handshaking),
+            'accepted': self._accepted,
+            'rejected': self._rejected,
+            'reaped': self._reaped,
+            'pool': self.handler_pool.stats(),
+        }
+
+    def _prune(self):
+        with self._lock:
+            connections = []
+            for rpc in self._connections:
+                if not rpc.is_closed:
+                    connections.append(rpc)
+                elif rpc.reaped:
+                    self._reaped += 1
+            self._connections = connections
+            return self._connections
+
+    def _throttle(self, last_accept):
+        if not self.max_accept_rate:
+            return
+        wait = last_accept + 1.0 / self.max_accept_rate - monotonic()
+        if wait > 0:
+            sleep(self.threading_model, wait)
+
+    def _serve(self, sock, peer):
+        self._accepted += 1
+        label = u'%s#%d' % (six.text_type(peer or 'unix'), self._accepted)
+        options = dict(self.options)
+        options.setdefault('connection_id', label)
+        try:
+            rpc = self.rpc_cls(sock, self._services_factory(), **options)
+        except Exception as e:
+            logging.error(u'Failed to serve connection %s: %s', label, e)
+            sock.close()
+            return
+        with self._lock:
+            stopped = self._stopping
+            if not stopped:
+                self._connections.append(rpc)
+        if stopped:
+            rpc.close()  # Handshake completed while stopping.
+
+    def _serve_handshaking(self, sock, peer):
+        # The handshake blocks until the peer's hello, up to
+        # handshake_timeout: not on the accept thread.
+        try:
+            self._serve(sock, peer)
+        finally:
+            with self._lock:
+                self._handshaking.discard(sock)
+
+    def _accept_loop(self):
+        last_accept = 0.0
+        while not self._stopping:
+            self._throttle(last_accept)
+            try:
+                sock, peer = self._listener.accept()
+            except _socket_module(self.threading_model).timeout:
+                continue  # Polling a shared listener.
+            except Exception as e:
+                if self._stopping:
+                    break
+                logging.error(u'Accept failed: %s', e)
+                if getattr(e, 'errno', None) in (errno.EMFILE, errno.ENFILE):
+                    sleep(self.threading_model, 0.1)
+                continue
+            last_accept = monotonic()
+            if self._stopping:
+                sock.close()
+                break
+            if (self.max_connections is not None and
+                    len(self._prune()) + len(self._handshaking) >=
+                    self.max_connections):
+                self._rejected += 1
+                sock.close()
+                continue
+            if self.options.get('handshake', self.rpc_cls.handshake):
+                with self._lock:
+                    self._handshaking.add(sock)
+                spawn(self.threading_model, self._serve_handshaking,
+                      sock, peer)
+            else:
+                self._serve(sock, peer)
+
+    def _wake_accept(self):
+        # Closing the listener does not wake up a blocking accept() on every
+        # platform (nor shutdown() on Unix sockets), a connection does.
+        socket_module = _socket_module(self.threading_model)
+        try:
+            waker = socket_module.socket(self._listener.family,
+                                         socket_module.SOCK_STREAM)
+            waker.settimeout(1.0)
+            waker.connect(self.bound_address)
+            waker.close()
+        except Exception:
+            pass
+
+    def start(self):
+        '''
+        Start listening and accepting connections in the background.
+
+        :returns: self
+        '''
+        self._stopping = False
+        if self._owns_listener:
+            self._listener = self._bind()
+        else:
+            # accept() of a listener shared with other processes cannot be
+            # woken up without disturbing the others, poll instead.
+            self._listener.settimeout(_ACCEPT_POLL_INTERVAL)
+        self._accept_thread = spawn(self.threading_model, self._accept_loop)
+        return self
+
+    def serve_forever(self):
+        '''
+        Start the server and block until it is stopped.
+        '''
+        if self._accept_thread is None:
+            self.start()
+        self._accept_thread.join()
+
+    def stop(self, timeout=None, drain=True):
+        '''
+        Stop accepting connections, close the open connections and wait for
+        their handlers to finish.
+
+        :param timeout: Max time in seconds to wait in total, for the
+                        accept loop, the connections and the handlers.
+        :type timeout: float | None
+        :param drain: Let the requests being handled respond before closing
+                      the connections, see ``drain()`` of the connectors.
+        :type drain: bool
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+
+        def _remaining():
+            if deadline is None:
+                return None
+            return max(0.0, deadline - monotonic())
+
+        self._stopping = True
+        if self._listener is not None:
+            if self._owns_listener:
+                self._wake_accept()
+            self._listener.close()
+        if self._accept_thread is not None:
+            self._accept_thread.join(_remaining())
+        with self._lock:
+            handshaking = list(self._handshaking)
+        for sock in handshaking:
+            try:
+                # Fails the handshake waiting for the peer.
+                sock.shutdown(_socket_module(self.threading_model).SHUT_RDWR)
+            except Exception:
+                pass
+        connections = self.connections()
+        if drain:
+            for rpc in connections:
+                rpc.dispatcher.start_draining()
+        for rpc in connections:
+            try:
+                if drain:
+                    rpc.drain(_remaining())
+                else:
+                    rpc.close()
+            except Exception:
+                pass  # Closed by peer meanwhile.
+        with self._lock:
+            connections = list(self._connections)
+            self._connections = []
+        for rpc in connections:
+            rpc.join(_remaining())
+        self.handler_pool.shutdown(_remaining())
+        if self._owns_listener and isinstance(self.address,
+                                              six.string_types):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''
+Capture of slow requests with sampled profiling.
+
+With the ``slow_request_threshold`` option, requests whose handler runs
+longer than the threshold (seconds) are recorded with their method, id,
+parameter sizes, queue wait and execution time. With
+``slow_request_profile_every`` every n:th request runs under ``cProfile``
+and is recorded with its top frames, slow or not. Records are kept in a
+ring of the latest ``slow_request_log_size`` entries per connection,
+dumped with ``slow_requests()`` of the connector.
+
+One handler is profiled at a time per process: a sampled request starting
+while another one is profiled runs unprofiled. With gevent the profile
+covers the greenlets switched to while the handler runs.
+'''
+import cProfile
+import pstats
+import time
+from collections import deque
+from threading import Lock
+
+from bsonrpc.misc import monotonic
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+# Profilers of concurrent threads would interfere with each other.
+_profiling = Lock()
+
+
+def param_sizes(args, kwargs):
+    '''
+    :returns: list | dict -- ``len()`` of each parameter (``None`` for
+              unsized values), by position or by name.
+    '''
+    def _size(value):
+        try:
+            return len(value)
+        except TypeError:
+            return None
+    if kwargs:
+        return dict((name, _size(value)) for name, value in kwargs.items())
+    return [_size(value) for value in args]
+
+
+def top_frames(profiler, count):
+    '''
+    :returns: list of dicts -- The ``count`` functions with the most
+              cumulative time: ``function`` ("file:line(name)"),
+              ``calls``, ``own`` and ``cumulative`` seconds.
+    '''
+    stats = pstats.Stats(profiler).stats
+    ordered = sorted(stats.items(), key=lambda item: item[1][3],
+                     reverse=True)[:count]
+    return [{'function': '%s:%d(%s)' % func,
+             'calls': calls,
+             'own': own,
+             'cumulative': cumulative}
+            for func, (_, calls, own, cumulative, _) in ordered]
+
+
+class RequestProfile(object):
+    '''
+    Measurement of one request, from ``SlowRequestLog.start()``.
+    '''
+
+    __slots__ = ('args', 'kwargs', 'started', 'profiler')
+
+    def __init__(self, args, kwargs, profiler):
+        self.args = args
+        self.kwargs = kwargs
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.enable()
+        self.started = monotonic()
+
+
+class SlowRequestLog(object):
+    '''
+    Ring of slow and profiled requests of a connection.
+    '''
+
+    def __init__(self, threshold=None, profile_every=0, size=100,
+                 frames=20):
+        '''
+        :param threshold: Record requests whose handler takes longer than
+                          this (seconds), ``None`` for none.
+        :type threshold: float | None
+        :param profile_every: Profile every n:th request, 0 for none.
+        :type profile_every: int
+        :param size: Number of the latest records kept.
+        :type size: int
+        :param frames: Number of top frames kept of profiled requests.
+        :type frames: int
+        '''
+        self.threshold = threshold
+        self.profile_every = profile_every
+        self.frames = frames
+        self._entries = deque(maxlen=size)
+        self._requests = 0
+
+    def start(self, args, kwargs):
+        '''
+        Start measuring a request handler, profiled if sampled.
+
+        :returns: RequestProfile
+        '''
+        profiler = None
+        if self.profile_every:
+            self._requests += 1
+            if (not self._requests % self.profile_every and
+                    _profiling.acquire(False)):
+                profiler = cProfile.Profile()
+        return RequestProfile(args, kwargs, profiler)
+
+    def finish(self, msg, measurement, queue_wait=None):
+        '''
+        Stop measuring and record the request if slow or profiled.
+
+        :param msg: The request message.
+        :param measurement: From ``start()``.
+        :param queue_wait: Seconds from receiving the request to its
+                           execution, if known.
+        '''
+        elapsed = monotonic() - measurement.started
+        profiler = measurement.profiler
+        if profiler is not None:
+            profiler.disable()
+            _profiling.release()
+        slow = self.threshold is not None and elapsed > self.threshold
+        if not slow and profiler is None:
+            return
+        self._entries.append({
+            'time': time.time(),
+            'method': msg.get('method'),
+            'id': msg.get('id'),
+            'param_sizes': param_sizes(measurement.args, measurement.kwargs),
+            'queue_wait': queue_wait,
+            'execution': elapsed,
+            'slow': slow,
+            'profile': (top_frames(profiler, self.frames)
+                        if profiler is not None else None),
+        })
+
+    def entries(self, clear=False):
+        '''
+        :param clear: Empty the ring.
+        :type clear: bool
+        :returns: list of dicts -- Records, oldest first: ``time`` (epoch
+                  seconds), ``method``, ``id``, ``param_sizes``,
+                  ``queue_wait`` and ``execution`` (seconds), ``slow``
+                  and ``profile`` (top frames, ``None`` unless profiled).
+        '''
+        entries = list(self._entries)
+        if clear:
+            for _ in entries:
+                self._entries.popleft()
+        return entries
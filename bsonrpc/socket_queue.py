@@ -2,12 +2,20 @@
 '''
 JSON & BSON codecs and the SocketQueue class which uses them.
 '''
+from collections import deque
 from socket import error as socket_error
-from struct import unpack
-
-from bsonrpc.concurrent import new_lock, new_queue, spawn
+from struct import pack, unpack
+
+from bsonrpc.attachments import IncomingAttachments, split_attachments
+from bsonrpc.concurrent import _new_event, new_lock, new_queue, spawn
+from bsonrpc.definitions import Fragment, SplicedMessage
+from bsonrpc.memory import MemoryStats
+from bsonrpc.misc import monotonic
+from bsonrpc.options import MemoryBudgetAction
+from bsonrpc.stats import ConnectionStats
 from bsonrpc.exceptions import (
-    BsonRpcError, DecodingError, EncodingError, FramingError)
+    BsonRpcError, DecodingError, EncodingError, FramingError,
+    MemoryBudgetExceeded)
 
 __license__ = 'http://mozilla.org/MPL/2.0/'
 
@@ -22,17 +30,27 @@ class BSONCodec(object):
           * No size penalties.
       * Explicit type for datetime.
     Cons:
-      * No top-level arrays -> no batch support.
+      * No top-level arrays -> batches are sent in an envelope document
+        ``{'batch': [...]}``.
     '''
 
+    #: Key of the envelope document of batches.
+    batch_key = 'batch'
+
     def __init__(self, custom_codec_implementation=None):
+        # Codecs with equal identity produce identical bytes.
+        self.identity = ('bson', custom_codec_implementation)
         if custom_codec_implementation is not None:
             self._loads = custom_codec_implementation.loads
             self._dumps = custom_codec_implementation.dumps
         else:
             # Use implementation from pymongo or from pybson
             import bson
-            if hasattr(bson, 'BSON'):
+            if hasattr(bson, 'encode') and hasattr(bson, 'decode'):
+                # pymongo >= 3.9
+                self._loads = bson.decode
+                self._dumps = bson.encode
+            elif hasattr(bson, 'BSON'):
                 # pymongo
                 self._loads = lambda raw: bson.BSON.decode(bson.BSON(raw))
                 self._dumps = lambda msg: bytes(bson.BSON.encode(msg))
@@ -43,16 +61,54 @@ class BSONCodec(object):
 
     def loads(self, b_msg):
         try:
-            return self._loads(b_msg)
+            msg = self._loads(b_msg)
         except Exception as e:
             raise DecodingError(e)
+        # Messages carry the protocol key -> a document with the batch key
+        # alone is a batch envelope.
+        if (isinstance(msg, dict) and len(msg) == 1 and
+                isinstance(msg.get(self.batch_key), list)):
+            return msg[self.batch_key]
+        return msg
 
     def dumps(self, msg):
         try:
+            if isinstance(msg, list):
+                return self._dumps_batch(msg)
+            if isinstance(msg, SplicedMessage):
+                return self._dumps_spliced(msg)
             return self._dumps(msg)
         except Exception as e:
             raise EncodingError(e)
 
+    def _dumps_spliced(self, spliced):
+        # Document: int32 length, elements, terminating null byte.
+        body = (self._dumps(spliced.msg)[4:-1] +
+                b''.join(f.data for f in spliced.fragments))
+        return pack('<i', len(body) + 5) + body + b'\x00'
+
+    def _dumps_batch(self, msgs):
+        # Envelope document with one array element, the array being a
+        # document of embedded documents keyed '0', '1', ...
+        items = b''.join(
+            b'\x03' + str(index).encode('ascii') + b'\x00' +
+            (self._dumps_spliced(msg) if isinstance(msg, SplicedMessage)
+             else self._dumps(msg))
+            for index, msg in enumerate(msgs))
+        body = (b'\x04' + self.batch_key.encode('ascii') + b'\x00' +
+                pack('<i', len(items) + 5) + items + b'\x00')
+        return pack('<i', len(body) + 5) + body + b'\x00'
+
+    def fragment(self, members):
+        '''
+        Encode the members of ``members`` (dict) into a ``Fragment``
+        to be spliced into outgoing messages.
+        '''
+        try:
+            return Fragment(self._dumps(members)[4:-1], len(members))
+        except Exception as e:
+            raise EncodingError(e)
+
     def extract_message(self, raw_bytes):
         rb_len = len(raw_bytes)
         if rb_len < 4:
@@ -80,13 +136,21 @@ class JSONCodec(object):
     def __init__(self, extractor, framer, custom_codec_implementation=None):
         self._extractor = extractor
         self._framer = framer
+        # Codecs with equal identity produce identical (unframed) bytes.
+        self.identity = ('json', custom_codec_implementation)
         if custom_codec_implementation is not None:
             self._loads = custom_codec_implementation.loads
-            self._dumps = custom_codec_implementation.dumps
+            dumps = custom_codec_implementation.dumps
+            self._encode = lambda msg: dumps(msg,
+                                             separators=(',', ':'),
+                                             sort_keys=True)
         else:
             import json
             self._loads = json.loads
-            self._dumps = json.dumps
+            # Reuse one encoder: json.dumps with non-default arguments
+            # would construct a new one on every call.
+            self._encode = json.JSONEncoder(separators=(',', ':'),
+                                            sort_keys=True).encode
 
 
     def loads(self, b_msg):
@@ -95,11 +159,38 @@ class JSONCodec(object):
         except Exception as e:
             raise DecodingError(e)
 
+    def _dumps_plain(self, msg):
+        return self._encode(msg).encode('utf-8')
+
+    def _dumps_spliced(self, msg):
+        if not isinstance(msg, SplicedMessage):
+            return self._dumps_plain(msg)
+        data = b','.join(f.data for f in msg.fragments if f.data)
+        body = self._dumps_plain(msg.msg)
+        if len(body) > 2:
+            return body[:-1] + b',' + data + b'}'
+        return b'{' + data + b'}'
+
     def dumps(self, msg):
         try:
-            return self._dumps(msg,
-                               separators=(',', ':'),
-                               sort_keys=True).encode('utf-8')
+            if isinstance(msg, SplicedMessage):
+                return self._dumps_spliced(msg)
+            if (isinstance(msg, list) and
+                    any(isinstance(m, SplicedMessage) for m in msg)):
+                return (b'[' +
+                        b','.join(self._dumps_spliced(m) for m in msg) +
+                        b']')
+            return self._dumps_plain(msg)
+        except Exception as e:
+            raise EncodingError(e)
+
+    def fragment(self, members):
+        '''
+        Encode the members of ``members`` (dict) into a ``Fragment``
+        to be spliced into outgoing messages.
+        '''
+        try:
+            return Fragment(self._dumps_plain(members)[1:-1], len(members))
         except Exception as e:
             raise EncodingError(e)
 
@@ -116,6 +207,121 @@ class JSONCodec(object):
             raise FramingError(e)
 
 
+def _msgpack_map_header(count):
+    if count < 16:
+        return pack('B', 0x80 | count)
+    if count < 1 << 16:
+        return pack('>BH', 0xde, count)
+    return pack('>BI', 0xdf, count)
+
+
+def _msgpack_array_header(count):
+    if count < 16:
+        return pack('B', 0x90 | count)
+    if count < 1 << 16:
+        return pack('>BH', 0xdc, count)
+    return pack('>BI', 0xdd, count)
+
+
+def _msgpack_map_members(packed):
+    # Encoded members of an encoded map, without the map header.
+    first = ord(packed[:1])
+    if first & 0xf0 == 0x80:
+        return packed[1:]
+    return packed[3:] if first == 0xde else packed[5:]
+
+
+class MsgPackCodec(object):
+    '''
+    Encode/Decode messages to/from MessagePack format, framed with a
+    4-byte big endian length prefix.
+
+    Pros:
+      * Compact, fast to encode and decode.
+      * Explicit type for binary data.
+      * Top-level arrays -> batches.
+      * Messages are extracted in O(1) from the length prefix, with the
+        rest of the buffer returned as a ``memoryview`` of it.
+    Cons:
+      * No datetime type.
+    '''
+
+    def __init__(self, custom_codec_implementation=None):
+        # Codecs with equal identity produce identical (unframed) bytes.
+        self.identity = ('msgpack', custom_codec_implementation)
+        if custom_codec_implementation is not None:
+            self._loads = custom_codec_implementation.loads
+            self._dumps = custom_codec_implementation.dumps
+        else:
+            import msgpack
+            self._loads = lambda raw: msgpack.unpackb(raw, raw=False)
+            self._dumps = lambda msg: msgpack.packb(msg, use_bin_type=True)
+
+    def loads(self, b_msg):
+        try:
+            return self._loads(b_msg)
+        except Exception as e:
+            raise DecodingError(e)
+
+    def _dumps_spliced(self, msg):
+        if not isinstance(msg, SplicedMessage):
+            return self._dumps(msg)
+        count = len(msg.msg) + sum(f.count for f in msg.fragments)
+        return (_msgpack_map_header(count) +
+                _msgpack_map_members(self._dumps(msg.msg)) +
+                b''.join(f.data for f in msg.fragments))
+
+    def dumps(self, msg):
+        try:
+            if isinstance(msg, SplicedMessage):
+                return self._dumps_spliced(msg)
+            if (isinstance(msg, list) and
+                    any(isinstance(m, SplicedMessage) for m in msg)):
+                return (_msgpack_array_header(len(msg)) +
+                        b''.join(self._dumps_spliced(m) for m in msg))
+            return self._dumps(msg)
+        except Exception as e:
+            raise EncodingError(e)
+
+    def fragment(self, members):
+        '''
+        Encode the members of ``members`` (dict) into a ``Fragment``
+        to be spliced into outgoing messages.
+        '''
+        try:
+            return Fragment(_msgpack_map_members(self._dumps(members)),
+                            len(members))
+        except Exception as e:
+            raise EncodingError(e)
+
+    def extract_message(self, raw_bytes):
+        if len(raw_bytes) < 4:
+            return None, raw_bytes
+        end = 4 + unpack('>I', raw_bytes[:4])[0]
+        if len(raw_bytes) < end:
+            return None, raw_bytes
+        # Not copying the rest: messages pipelined in one buffer would
+        # copy it once per message.
+        view = memoryview(raw_bytes)
+        return view[4:end].tobytes(), view[end:]
+
+    def into_frame(self, message_bytes):
+        return pack('>I', len(message_bytes)) + message_bytes
+
+
+class _Timed(object):
+    '''
+    Received message with its stage times, in the queue.
+    '''
+
+    __slots__ = ('msg', 'timing', 'queued')
+
+    def __init__(self, msg, timing, queued):
+        self.msg = msg
+        self.timing = timing
+        self.queued = queued
+
+
 class SocketQueue(object):
     '''
     SocketQueue is a duplex Queue connected to a given socket and
@@ -128,7 +334,12 @@ class SocketQueue(object):
 
     SHUT_RDWR = 2
 
-    def __init__(self, socket, codec, threading_model):
+    def __init__(self, socket, codec, threading_model,
+                 attachment_spool_size=1 << 20, stage_timer=None,
+                 memory_budget=None,
+                 memory_budget_action=MemoryBudgetAction.BACKPRESSURE,
+                 initial_bytes=b'', attachment_max_size=None,
+                 attachment_max_count=None, attachment_max_total=None):
         '''
         :param socket: Socket connected to rpc peer node.
         :type socket: socket.socket
@@ -137,13 +348,77 @@ class SocketQueue(object):
         :param threading_model: Threading model
         :type threading_model: bsonrpc.options.ThreadingModel.GEVENT or
                                bsonrpc.options.ThreadingModel.THREADS
+        :param attachment_spool_size: Received attachments larger than this
+                                      are spooled to temporary files.
+        :type attachment_spool_size: int
+        :param stage_timer: Records the time spent in each stage of
+                            receiving and sending messages.
+        :type stage_timer: bsonrpc.stages.StageTimer | None
+        :param memory_budget: Bytes the connection may hold, see
+                              ``bsonrpc.memory``. ``None`` for unlimited.
+        :type memory_budget: int | None
+        :param memory_budget_action: What to do when over the budget.
+        :type memory_budget_action: bsonrpc.options.MemoryBudgetAction
+        :param initial_bytes: Bytes already received from ``socket``.
+        :type initial_bytes: bytes
+        :param attachment_max_size: Attachments announced larger than this
+                                    close the connection with a
+                                    ``FramingError``. ``None`` for no
+                                    limit.
+        :type attachment_max_size: int | None
+        :param attachment_max_count: Messages announcing more attachments
+                                     than this close the connection with a
+                                     ``FramingError``. ``None`` for no
+                                     limit.
+        :type attachment_max_count: int | None
+        :param attachment_max_total: Messages announcing attachments of
+                                     more bytes in total than this close the
+                                     connection with a ``FramingError``.
+                                     ``None`` for no limit.
+        :type attachment_max_total: int | None
         '''
         self.socket = socket
         self.codec = codec
+        self.attachment_spool_size = attachment_spool_size
+        self.attachment_max_size = attachment_max_size
+        self.attachment_max_count = attachment_max_count
+        self.attachment_max_total = attachment_max_total
+        self._incoming = None
+        #: Time (``bsonrpc.misc.monotonic``) bytes were last received.
+        self.last_received = monotonic()
+        #: Traffic counters.
+        self.stats = ConnectionStats()
+        self.stage_timer = stage_timer
+        # Stage timing of the message being received.
+        self._first_bytes = self._chunk_time = 0.0
+        self._extract_time = self._decode_time = 0.0
+        #: Bytes held by the connection.
+        self.memory = MemoryStats()
+        self.memory_budget = memory_budget
+        self.memory_budget_action = memory_budget_action
+        # Set when bytes held are released, for the receiver waiting for
+        # the budget.
+        self._released = _new_event(threading_model)
+        # A message was queued while over the budget.
+        self._probed = False
+        # Sizes of the items in _queue, in the same order.
+        self._sizes = deque()
+        self._incoming_size = 0
+        #: Called by the receiver with each received message. Returns
+        #: ``True`` if it took the message, which is then not queued.
+        self.bypass = None
         self._queue = new_queue(threading_model)
         self._lock = new_lock(threading_model)
-        self._receiver_thread = spawn(threading_model, self._receiver)
         self._closed = False
+        bbuffer = b''
+        if initial_bytes:
+            try:
+                bbuffer = self._to_queue(initial_bytes)
+            except DecodingError as e:
+                self.stats.decode_errors += 1
+                self._enqueue(e)
+        self._receiver_thread = spawn(threading_model, self._receiver,
+                                      bbuffer)
 
     @property
     def is_closed(self):
@@ -160,18 +435,80 @@ class SocketQueue(object):
             self._closed = True
             self.socket.shutdown(self.SHUT_RDWR)
 
-    def put(self, item):
+    def put(self, item, block=True, timing=None):
         '''
         Put item to queue -> codec -> socket.
 
         :param item: Message object.
         :type item: dict, list or None
+        :param block: Wait while another thread is sending. If ``False``
+                      the item is dropped instead.
+        :type block: bool
+        :param timing: Dict to add the stage times of sending to, if stage
+                       timing is enabled.
+        :type timing: dict | None
+        :returns: bool -- Whether the item was sent.
         '''
         if self._closed:
             raise BsonRpcError('Attempt to put items to closed queue.')
+        started = monotonic()
+        item, attachments = split_attachments(item)
         msg_bytes = self.codec.into_frame(self.codec.dumps(item))
-        with self._lock:
-            self.socket.sendall(msg_bytes)
+        encoded = monotonic()
+        self.memory.sending(len(msg_bytes))
+        try:
+            return self._send(item, msg_bytes, attachments, block, timing,
+                              started, encoded)
+        finally:
+            self.memory.sending(-len(msg_bytes))
+            if self.memory_budget is not None:
+                self._released.set()
+
+    def _send(self, item, msg_bytes, attachments, block, timing, started,
+              encoded):
+        if not self._lock.acquire(block):
+            return False
+        timer = self.stage_timer
+        try:
+            if timer is not None:
+                locked = monotonic()
+                self.socket.sendall(msg_bytes)
+                timer.record('encode', encoded - started, timing)
+                timer.record('send_lock', locked - encoded, timing)
+                timer.record('send', monotonic() - locked, timing)
+            else:
+                self.socket.sendall(msg_bytes)
+            # Counted once sent: dropped and failed puts are not.
+            self.stats.sent(item, len(msg_bytes), encoded - started)
+            if attachments:
+                try:
+                    for attachment in attachments:
+                        attachment.write_to(self.socket)
+                        self.stats.bytes_out += attachment.size
+                except Exception:
+                    # Peer is waiting for the announced bytes, the stream
+                    # cannot be recovered.
+                    self.close()
+                    raise
+        finally:
+            self._lock.release()
+        return True
+
+    @property
+    def over_budget(self):
+        '''
+        :property: bool -- Holding more than ``memory_budget`` bytes.
+        '''
+        return (self.memory_budget is not None and
+                self.memory.total > self.memory_budget)
+
+    @property
+    def queue_depth(self):
+        '''
+        :property: int -- Received messages waiting to be taken with
+                   ``get()``.
+        '''
+        return self._queue.qsize()
 
     def get(self):
         '''
@@ -183,35 +520,160 @@ class SocketQueue(object):
                   May also be Exception object in case of parsing or
                   framing errors.
         '''
-        return self._queue.get()
+        return self.get_timed()[0]
+
+    def get_timed(self):
+        '''
+        Like ``get()`` but with the stage times of receiving the message.
+
+        :returns: (message item, dict of seconds by stage | None)
+        '''
+        item = self._queue.get()
+        self.memory.taken(self._sizes.popleft())
+        if self.memory_budget is not None:
+            self._released.set()
+        if type(item) is _Timed:
+            self.stage_timer.record(
+                'queue_wait', monotonic() - item.queued, item.timing)
+            return item.msg, item.timing
+        return item, None
+
+    def _enqueue(self, item, size=0):
+        if self.over_budget:
+            self._probed = True
+        self._sizes.append(size)
+        self.memory.queued(size)
+        self._queue.put(item)
 
     def _to_queue(self, bbuffer):
-        b_msg, bbuffer = self.codec.extract_message(bbuffer)
-        while b_msg is not None:
-            self._queue.put(self.codec.loads(b_msg))
-            b_msg, bbuffer = self.codec.extract_message(bbuffer)
-        return bbuffer
+        # Codecs may return the rest of the buffer as a memoryview of it,
+        # copied into bytes once for the next chunk to be appended.
+        while True:
+            if self._incoming is not None:
+                bbuffer = self._incoming.feed(bbuffer)
+                if not self._incoming.done:
+                    return bytes(bbuffer)
+                msg = self._incoming.message()
+                self._incoming = None
+                if self.bypass is not None and self.bypass(msg):
+                    pass
+                elif self.stage_timer is not None:
+                    # recv covers receiving the attachments too.
+                    self._enqueue(
+                        self._timed(msg, self._decode_time, monotonic()),
+                        self._incoming_size)
+                else:
+                    self._enqueue(msg, self._incoming_size)
+            if self.stage_timer is not None:
+                started = monotonic()
+                b_msg, bbuffer = self.codec.extract_message(bbuffer)
+                self._extract_time += monotonic() - started
+            else:
+                b_msg, bbuffer = self.codec.extract_message(bbuffer)
+            if b_msg is None:
+                return bytes(bbuffer)
+            started = monotonic()
+            msg = self.codec.loads(b_msg)
+            decoded = monotonic()
+            self.stats.received(msg, len(b_msg), decoded - started)
+            if IncomingAttachments.announced_by(msg):
+                spool_size = self.attachment_spool_size
+                # Spooled attachments are not held in memory.
+                incoming_size = len(b_msg) + sum(
+                    size for size in msg['attachments']
+                    if size <= spool_size)
+                if (self.memory_budget is not None and
+                        incoming_size > self.memory_budget):
+                    # Backpressure cannot help.
+                    raise MemoryBudgetExceeded(
+                        u'Message with attachments of %d bytes exceeds the '
+                        u'memory budget of %d bytes.' %
+                        (incoming_size, self.memory_budget))
+                self._incoming = IncomingAttachments(
+                    msg, spool_size, self.attachment_max_size,
+                    self.attachment_max_count, self.attachment_max_total)
+                self._incoming_size = incoming_size
+                self._decode_time = decoded - started
+            elif self.bypass is not None and self.bypass(msg):
+                pass
+            elif self.stage_timer is not None:
+                self._enqueue(self._timed(msg, decoded - started, decoded),
+                              len(b_msg))
+            else:
+                self._enqueue(msg, len(b_msg))
+
+    def _timed(self, msg, decode_time, decoded):
+        timer = self.stage_timer
+        timing = {}
+        timer.record('recv', self._chunk_time - self._first_bytes, timing)
+        timer.record('extract', self._extract_time, timing)
+        timer.record('decode', decode_time, timing)
+        # Rest of the buffer arrived with the last chunk (at the latest).
+        self._first_bytes = self._chunk_time
+        self._extract_time = 0.0
+        return _Timed(msg, timing, decoded)
+
+    def _held(self):
+        # Bytes of the attachments being received into memory.
+        if self._incoming is None:
+            return 0
+        return self._incoming.held
+
+    def _wait_for_budget(self, buffered):
+        memory = self.memory
+        budget = self.memory_budget
+        while memory.total > budget and not self._closed:
+            if (buffered > budget or self.memory_budget_action ==
+                    MemoryBudgetAction.CLOSE):
+                raise MemoryBudgetExceeded(
+                    u'Connection holds %d bytes, memory budget is %d '
+                    u'bytes.' % (memory.total, budget))
+            if not self._probed:
+                # Read on until one more message is queued, responses
+                # taken by bypass reach their callers meanwhile.
+                return
+            self._released.clear()
+            if memory.total <= budget:
+                break
+            # Let the dispatcher and senders catch up. Not reading makes
+            # TCP flow control slow down the peer.
+            self._released.wait(0.1)
+        self._probed = False
 
-    def _receiver(self):
-        bbuffer = b''
+    def _receiver(self, bbuffer=b''):
         while True:
             try:
-                chunk = self.socket.recv(self.BUFSIZE)
+                if self.memory_budget is not None:
+                    self._wait_for_budget(len(bbuffer) + self._held())
+                if self._incoming is None:
+                    chunk = self.socket.recv(self.BUFSIZE)
+                else:
+                    chunk = self.socket.recv(self._incoming.recv_size)
+                self.last_received = monotonic()
+                if self.stage_timer is not None:
+                    if not bbuffer:
+                        self._first_bytes = self.last_received
+                    self._chunk_time = self.last_received
+                self.stats.recvs += 1
+                self.stats.bytes_in += len(chunk)
+                peak = len(bbuffer) + len(chunk) + self._held()
                 bbuffer = self._to_queue(bbuffer + chunk)
+                self.memory.buffered(len(bbuffer) + self._held(), peak)
                 if chunk == b'':
                     break
             except DecodingError as e:
-                self._queue.put(e)
+                self.stats.decode_errors += 1
+                self._enqueue(e)
             except (OSError, socket_error) as e:
                 # shutdown() from another greenlet
                 if e.errno != 9:
-                    self._queue.put(e)
+                    self._enqueue(e)
                 break
             except Exception as e:
-                self._queue.put(e)
+                self._enqueue(e)
                 break
         self._closed = True
-        self._queue.put(None)
+        self._enqueue(None)
         try:  # Just in case somehow socket is still open:
             self.socket.shutdown(self.SHUT_RDWR)
         except:
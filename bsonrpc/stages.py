@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+Latency breakdown of messages by processing stage, enabled with the
+``stage_timing`` option.
+
+Stages of received messages:
+
+* ``recv``: from the arrival of the first bytes of the message to the
+  ``recv`` completing it
+* ``extract``: framing, i.e. finding the message in the received bytes
+  (including rescans while it was incomplete)
+* ``decode``: decoding the message
+* ``queue_wait``: waiting in the ``SocketQueue`` for the dispatcher
+* ``dispatch``: classifying the message in the dispatcher
+
+Stages of requests and sent messages:
+
+* ``worker_wait``: from the dispatcher handing a request over to the
+  start of its execution by a thread/greenlet/pool worker
+* ``handler``: executing the request handler
+* ``encode``: encoding and framing a sent message
+* ``send_lock``: waiting for other threads sending on the connection
+* ``send``: ``sendall`` of the message
+'''
+from collections import deque
+
+from bsonrpc.histogram import MethodHistograms
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+STAGES = ('recv', 'extract', 'decode', 'queue_wait', 'dispatch',
+          'worker_wait', 'handler', 'encode', 'send_lock', 'send')
+
+
+class StageTimer(object):
+    '''
+    Per-stage histograms of a connection and the complete breakdowns of
+    sampled requests.
+    '''
+
+    def __init__(self, sample_every=0, max_samples=100):
+        '''
+        :param sample_every: Keep the breakdown of every n:th handled
+                             request, 0 for none.
+        :type sample_every: int
+        :param max_samples: Number of the latest samples kept.
+        :type max_samples: int
+        '''
+        self.sample_every = sample_every
+        self._histograms = MethodHistograms()
+        self._samples = deque(maxlen=max_samples)
+        self._requests = 0
+
+    def record(self, stage, seconds, timing=None):
+        '''
+        Record ``seconds`` spent in ``stage``, also into the per-message
+        ``timing`` dict if given.
+        '''
+        self._histograms.record(stage, seconds)
+        if timing is not None:
+            timing[stage] = seconds
+
+    def finish(self, msg, timing):
+        '''
+        A request has been responded, keep its ``timing`` if sampled.
+        '''
+        if not self.sample_every:
+            return
+        self._requests += 1
+        if self._requests % self.sample_every:
+            return
+        sample = dict((stage, seconds) for stage, seconds in timing.items()
+                      if stage in STAGES)
+        sample['method'] = msg.get('method')
+        sample['id'] = msg.get('id')
+        self._samples.append(sample)
+
+    def histograms(self, reset=False):
+        '''
+        :returns: bsonrpc.histogram.MethodHistograms -- Snapshot of the
+                  histograms by stage name.
+        '''
+        return self._histograms.snapshot(reset)
+
+    def samples(self):
+        '''
+        :returns: list of dicts -- Sampled requests, oldest first: seconds
+                  by stage, ``method`` and ``id``.
+        '''
+        return list(self._samples)
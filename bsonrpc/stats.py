@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Traffic statistics of connections.
+
+Counters are plain attributes updated without locks by the threads
+sending and the receiver of the connection, which keeps them cheap on the
+hot path. A snapshot taken while messages are flowing may therefore be
+slightly inconsistent (e.g. bytes counted before the message).
+'''
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+#: Request answered with ``RpcBase.stats()`` if the ``introspection``
+#: option is set.
+INTROSPECTION_METHOD = 'rpc.stats'
+
+# Message sizes are counted in power of two buckets: 1, 2, 4, ... 2**31+.
+_BUCKETS = 32
+
+
+def size_histogram(buckets):
+    '''
+    :returns: dict -- Message counts by upper bound of size in bytes (as
+              strings, for BSON), empty buckets left out.
+    '''
+    return dict(('%d' % (1 << index), count)
+                for index, count in enumerate(buckets) if count)
+
+
+def _error_code(msg):
+    error = msg.get('error')
+    if type(error) is dict:
+        return '%s' % error.get('code')
+    return None
+
+
+class ConnectionStats(object):
+    '''
+    Counters of the messages sent and received by a ``SocketQueue``.
+    Times are wall clock seconds spent encoding/decoding messages.
+    '''
+
+    __slots__ = ('messages_out', 'bytes_out', 'encode_time', 'errors_out',
+                 'sizes_out', 'messages_in', 'bytes_in', 'recvs',
+                 'decode_time', 'decode_errors', 'errors_in', 'sizes_in')
+
+    def __init__(self):
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.encode_time = 0.0
+        #: Error responses sent: {"<code>": count}
+        self.errors_out = {}
+        self.sizes_out = [0] * _BUCKETS
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.recvs = 0
+        self.decode_time = 0.0
+        self.decode_errors = 0
+        #: Error responses received: {"<code>": count}
+        self.errors_in = {}
+        self.sizes_in = [0] * _BUCKETS
+
+    @staticmethod
+    def _count_errors(counts, item):
+        if type(item) is dict:
+            if 'error' in item:
+                code = _error_code(item)
+                counts[code] = counts.get(code, 0) + 1
+        elif type(item) is list:
+            for msg in item:
+                if type(msg) is dict and 'error' in msg:
+                    code = _error_code(msg)
+                    counts[code] = counts.get(code, 0) + 1
+
+    def sent(self, item, size, elapsed):
+        '''
+        Count a sent message of ``size`` bytes which took ``elapsed``
+        seconds to encode.
+        '''
+        self.messages_out += 1
+        self.bytes_out += size
+        self.encode_time += elapsed
+        self.sizes_out[min(_BUCKETS - 1, (size - 1).bit_length())] += 1
+        self._count_errors(self.errors_out, item)
+
+    def received(self, msg, size, elapsed):
+        '''
+        Count a received message of ``size`` bytes which took ``elapsed``
+        seconds to decode.
+        '''
+        self.messages_in += 1
+        self.decode_time += elapsed
+        self.sizes_in[min(_BUCKETS - 1, (size - 1).bit_length())] += 1
+        self._count_errors(self.errors_in, msg)
+
+    def as_dict(self):
+        '''
+        :returns: dict -- The counters, ``frames_per_recv`` (messages
+                  received per ``recv`` call) and the size histograms
+                  ``sizes_out``/``sizes_in``.
+        '''
+        stats = dict((name, getattr(self, name)) for name in self.__slots__)
+        stats['errors_out'] = dict(self.errors_out)
+        stats['errors_in'] = dict(self.errors_in)
+        stats['sizes_out'] = size_histogram(self.sizes_out)
+        stats['sizes_in'] = size_histogram(self.sizes_in)
+        stats['frames_per_recv'] = (float(self.messages_in) / self.recvs
+                                    if self.recvs else 0.0)
+        return stats
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+'''
+Server-streaming: results of request handlers sent to the caller item by
+item, with credit-based flow control.
+
+Messages of a stream share the id of the request:
+
+* Request with a ``stream`` member: the initial credit, i.e. number of
+  items the caller is ready to receive.
+* ``{"id": <id>, "stream_item": <item>}`` from the handler side for each
+  item. Each item consumes one credit.
+* ``{"id": <id>, "stream_credit": <n>}`` from the caller side to grant
+  more credit, ``"stream_cancel": true`` added to stop the stream.
+* A normal response ends the stream: ``result`` is the number of items
+  sent or ``error`` tells why the stream failed.
+'''
+import types
+
+from bsonrpc.concurrent import _new_event, new_lock, new_queue
+from bsonrpc.exceptions import ResponseTimeout
+from bsonrpc.options import ThreadingModel
+
+__license__ = 'http://mozilla.org/MPL/2.0/'
+
+
+def materialize(result):
+    '''
+    :returns: Items of a generator as a list for a non-streaming response,
+              other results as is.
+    '''
+    if isinstance(result, types.GeneratorType):
+        return list(result)
+    return result
+
+
+def iter_items(result):
+    '''
+    :returns: Iterator over the items to stream: generators and lists are
+              streamed item by item, other results as a single item.
+    '''
+    if isinstance(result, (types.GeneratorType, list, tuple)):
+        return iter(result)
+    return iter([result])
+
+
+def _queue_empty(threading_model):
+    if threading_model == ThreadingModel.GEVENT:
+        from gevent.queue import Empty
+    else:
+        from six.moves.queue import Empty
+    return Empty
+
+
+class StreamCredit(object):
+    '''
+    Credit of a stream on the handler side.
+    '''
+
+    def __init__(self, threading_model, credit):
+        self._credit = credit
+        self._cancelled = False
+        self._lock = new_lock(threading_model)
+        self._available = _new_event(threading_model)
+
+    def grant(self, count):
+        with self._lock:
+            self._credit += count
+            self._available.set()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            self._available.set()
+
+    def take(self):
+        '''
+        Wait for and consume one credit.
+
+        :returns: bool -- False if the stream has been cancelled.
+        '''
+        while True:
+            with self._lock:
+                if self._cancelled:
+                    return False
+                if self._credit > 0:
+                    self._credit -= 1
+                    return True
+                self._available.clear()
+            self._available.wait()
+
+
+class ResultStream(object):
+    '''
+    Iterator over the items streamed by the peer in response to
+    ``invoke_stream``. Grants more credit to the peer as items are consumed.
+
+    Use as a context manager or call ``close()`` to stop the stream before
+    it has been consumed to the end.
+
+    Example:
+    ::
+
+      with rpc.invoke_stream('query', 'SELECT ...') as rows:
+          for row in rows:
+              process(row)
+    '''
+
+    def __init__(self, rpc, window, timeout=None):
+        '''
+        :param rpc: Connector of the stream.
+        :param window: Number of items the peer may send ahead.
+        :type window: int
+        :param timeout: Max time in seconds to wait for each item.
+        :type timeout: float | None
+        '''
+        self.window = window
+        self.timeout = timeout
+        #: Request id of the stream.
+        self.msg_id = None
+        #: Number of items sent by the peer, set at the end of the stream.
+        self.count = None
+        self._rpc = rpc
+        self._queue = new_queue(rpc.threading_model)
+        self._empty = _queue_empty(rpc.threading_model)
+        self._consumed = 0
+        self._done = False
+
+    # Dispatcher side:
+
+    def put_item(self, item):
+        self._queue.put((True, item))
+
+    def set(self, value):
+        self._queue.put((False, value))
+
+    # Caller side:
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        try:
+            is_item, value = self._queue.get(timeout=self.timeout)
+        except self._empty:
+            self.close()
+            raise ResponseTimeout(u'Waiting stream item expired.')
+        if is_item:
+            self._consumed += 1
+            if self._consumed >= max(1, self.window // 2):
+                self._rpc.socket_queue.put(
+                    self._rpc.definitions.stream_control(
+                        self.msg_id, self._consumed))
+                self._consumed = 0
+            return value
+        self._finish()
+        if isinstance(value, Exception):
+            raise value
+        self.count = value
+        raise StopIteration
+
+    next = __next__
+
+    def _finish(self):
+        self._done = True
+        self._rpc.dispatcher.unregister(self.msg_id)
+
+    def close(self):
+        '''
+        Cancel the stream unless it has ended.
+        '''
+        if self._done:
+            return
+        self._finish()
+        try:
+            self._rpc.socket_queue.put(
+                self._rpc.definitions.stream_control(
+                    self.msg_id, 0, cancel=True))
+        except Exception:
+            pass  # Connection closed, nothing to cancel.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -13,9 +13,10 @@ class PeerProxy(object):
             self._rpc = rpc
 
         def __getattr__(self, name):
-            def _curried(*args, **kwargs):
-                return self._rpc.invoke_notification(name, *args, **kwargs)
-            return _curried
+            stub = self._rpc._notification_stub(name)
+            # Cached: next lookups won't reach __getattr__.
+            setattr(self, name, stub)
+            return stub
 
     def __init__(self, rpc, requests, notifications, timeout):
         def _item_in(item, collection):
@@ -30,15 +31,16 @@ class PeerProxy(object):
 
     def __getattr__(self, name):
         if self._requests is None or name in self._requests:
-            def _curried(*args, **kwargs):
-                return self._rpc.invoke_request(
-                    name, *args, _____timeout=self._timeout, **kwargs)
-            return _curried
-        if self._notifications is None or name in self._notifications:
-            return getattr(self._n, name)
-        raise AttributeError(
-            "'%s' object has no attribute '%s'" %
-            (self.__class__.__name__, name))
+            stub = self._rpc._request_stub(name, self._timeout)
+        elif self._notifications is None or name in self._notifications:
+            stub = getattr(self._n, name)
+        else:
+            raise AttributeError(
+                "'%s' object has no attribute '%s'" %
+                (self.__class__.__name__, name))
+        # Cached: next lookups won't reach __getattr__.
+        setattr(self, name, stub)
+        return stub
 
 
 class BatchBuilder(PeerProxy):
@@ -57,6 +59,16 @@ class BatchBuilder(PeerProxy):
         def invoke_notification(self, method, *args, **kwargs):
             self.par._batch_calls.append(('n', method, args, kwargs))
 
+        def _request_stub(self, method, timeout):
+            def _stub(*args, **kwargs):
+                self.invoke_request(method, *args, **kwargs)
+            return _stub
+
+        def _notification_stub(self, method):
+            def _stub(*args, **kwargs):
+                self.invoke_notification(method, *args, **kwargs)
+            return _stub
+
     def __init__(self, requests=None, notifications=None):
         self._batch_calls = []
         super(BatchBuilder, self).__init__(
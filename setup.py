@@ -44,6 +44,6 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     keywords='bson json rpc bson-rpc json-rpc bsonrpc jsonrpc gevent',
-    packages=find_packages(exclude=['contrib', 'doc', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'contrib', 'doc', 'tests']),
     install_requires=['six'],
 )
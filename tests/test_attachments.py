@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import socket as tsocket
+import tempfile
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.attachments import Attachment, IncomingAttachments
+from bsonrpc.exceptions import ConnectionClosed, FramingError
+from bsonrpc.interfaces import notification, request, service_class
+from bsonrpc.loopback import loopback_pair
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+
+def _digest(data):
+    if not isinstance(data, memoryview):
+        data = data.read()
+    return hashlib.sha1(data).hexdigest()
+
+
+@service_class
+class BlobServices(object):
+
+    def __init__(self):
+        self.notified = []
+
+    @request
+    def upload(self, name, blob):
+        return {'name': name, 'kind': type(blob).__name__,
+                'sha1': _digest(blob)}
+
+    @request
+    def download(self, size):
+        return Attachment(b'z' * size)
+
+    @request
+    def pair(self, first, second):
+        return [Attachment(first.encode('utf-8')), 'middle',
+                Attachment(second.encode('utf-8'))]
+
+    @notification
+    def store(self, blob):
+        self.notified.append(bytes(blob))
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _pair(kind, threading_model):
+    if kind == 'loopback':
+        return loopback_pair(threading_model)
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    return socket_module.socketpair()
+
+
+@pytest.mark.parametrize('transport', ['socketpair', 'loopback'])
+def test_attachments(protocol_cls, threading_model, transport):
+    s1, s2 = _pair(transport, threading_model)
+    services = BlobServices()
+    srv = protocol_cls(s1, services, threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       attachment_spool_size=1000)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       attachment_spool_size=1000)
+    proxy = cli.get_peer_proxy()
+    small = b'\x00\x01binary' * 10
+    assert proxy.upload('small', Attachment(small)) == {
+        'name': 'small', 'kind': 'memoryview',
+        'sha1': hashlib.sha1(small).hexdigest()}
+    with tempfile.TemporaryFile() as blob:
+        content = b'0123456789' * 5000
+        blob.write(b'skipped' + content)
+        blob.seek(len(b'skipped'))
+        result = proxy.upload('big', Attachment(blob))
+        assert result['kind'] == 'SpooledTemporaryFile'
+        assert result['sha1'] == hashlib.sha1(content).hexdigest()
+    assert bytes(proxy.download(5)) == b'zzzzz'
+    assert proxy.download(5000).read() == b'z' * 5000
+    first, middle, second = proxy.pair(u'ab', u'')
+    assert (bytes(first), middle, bytes(second)) == (b'ab', 'middle', b'')
+    cli.invoke_notification('store', Attachment(b'note'))
+    assert proxy.upload('after', Attachment(b'')) == {
+        'name': 'after', 'kind': 'memoryview',
+        'sha1': hashlib.sha1(b'').hexdigest()}
+    assert services.notified == [b'note']
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_attachment_max_size(protocol_cls, threading_model):
+    s1, s2 = _pair('socketpair', threading_model)
+    srv = protocol_cls(s1, BlobServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       attachment_max_size=100)
+    cli = protocol_cls(s2, threading_model=threading_model)
+    proxy = cli.get_peer_proxy(timeout=5.0)
+    assert proxy.upload('fits', Attachment(b'x' * 100))['name'] == 'fits'
+    # The server may close before the client has sent the attachment.
+    with pytest.raises((ConnectionClosed, IOError)):
+        proxy.upload('too big', Attachment(b'x' * 101))
+    srv.join(1.0)
+    assert srv.is_closed
+    cli.close()
+    cli.join(1.0)
+
+
+@pytest.mark.parametrize('options, upload', [
+    ({'attachment_max_count': 2}, [b'a', b'b', b'c']),
+    ({'attachment_max_total': 100}, [b'x' * 60, b'y' * 60]),
+    ({'memory_budget': 10000}, [b'x' * 20000]),
+])
+def test_attachment_limits(protocol_cls, threading_model, options, upload):
+    s1, s2 = _pair('socketpair', threading_model)
+    srv = protocol_cls(s1, BlobServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       attachment_spool_size=1 << 20, **options)
+    cli = protocol_cls(s2, threading_model=threading_model)
+    proxy = cli.get_peer_proxy(timeout=5.0)
+    assert proxy.pair(u'a', u'b')[1] == 'middle'
+    with pytest.raises((ConnectionClosed, IOError)):
+        proxy.pair(*[Attachment(data) for data in upload])
+    srv.join(1.0)
+    assert srv.is_closed
+    cli.close()
+    cli.join(1.0)
+
+
+def test_incoming_attachments():
+    msg = {'params': [{'$attachment': -1}, {'$attachment': 0},
+                      {'$attachment': 1}, {'$attachment': 2}],
+           'attachments': [3, 2000]}
+    incoming = IncomingAttachments(msg, spool_size=1000)
+    assert incoming.feed(b'abcd') == b''
+    # Spooled attachments are not held in memory.
+    assert incoming.held == 3
+    assert incoming.feed(b'x' * 2000) == b'x'
+    assert incoming.done
+    assert incoming.held == 3
+    params = incoming.message()['params']
+    assert params[0] == {'$attachment': -1}
+    assert bytes(params[1]) == b'abc'
+    assert params[2].read() == b'd' + b'x' * 1999
+    assert params[3] == {'$attachment': 2}
+    for sizes, limits in (([1, 2, 3], {'max_count': 2}),
+                          ([60, 60], {'max_total': 100}),
+                          ([101], {'max_size': 100})):
+        with pytest.raises(FramingError):
+            IncomingAttachments({'attachments': sizes}, 1000, **limits)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from benchmarks import proxy_overhead
+
+
+def test_proxy_overhead_runs(capsys):
+    # Patches private connector methods, runs against their signatures.
+    proxy_overhead.main(['-n', '5'])
+    out = capsys.readouterr().out
+    for label in ('client generic', 'client stub', 'round trip generic',
+                  'round trip stub'):
+        assert out.count(label) == 2
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import pytest
+
+from bsonrpc.compression import CompressionCodec
+from bsonrpc.exceptions import FramingError
+from bsonrpc.framing import (
+    JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.socket_queue import BSONCodec, JSONCodec
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+
+def _codecs():
+    yield BSONCodec()
+    for framing in (JSONFramingNetstring, JSONFramingNone,
+                    JSONFramingRFC7464):
+        yield JSONCodec(framing.extract_message, framing.into_frame)
+
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'bz2', 'lzma'])
+def test_compression_codec(algorithm):
+    for inner in _codecs():
+        codec = CompressionCodec(inner, algorithm, threshold=100)
+        small = {'id': 1, 'result': 'x'}
+        large = {'id': 2, 'result': 'abc' * 1000}
+        stream = b''.join(codec.into_frame(codec.dumps(msg))
+                          for msg in (small, large, small))
+        stream += b'\x01'  # Beginning of the next frame.
+        received = []
+        b_msg, stream = codec.extract_message(stream)
+        while b_msg is not None:
+            received.append(codec.loads(b_msg))
+            b_msg, stream = codec.extract_message(stream)
+        assert received == [small, large, small]
+        assert stream == b'\x01'
+        stats = codec.stats.as_dict()
+        assert stats['messages_out'] == 3
+        assert stats['compressed_out'] == 1
+        assert stats['compressed_in'] == 1
+        assert stats['ratio_out'] < 0.2
+        assert stats['compress_time'] >= 0
+
+
+def test_compression_errors():
+    with pytest.raises(ValueError):
+        CompressionCodec(BSONCodec(), 'snappy')
+    codec = CompressionCodec(BSONCodec())
+    with pytest.raises(FramingError):
+        codec.extract_message(b'\x09\x00\x00\x00\x01x')
+
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'bz2', 'lzma'])
+def test_decompression_limit(algorithm):
+    sender = CompressionCodec(BSONCodec(), algorithm, threshold=0)
+    frame = sender.into_frame(sender.dumps({'result': 'x' * 100000}))
+    assert len(frame) < 2000
+    receiver = CompressionCodec(BSONCodec(), algorithm, max_size=50000)
+    with pytest.raises(FramingError):
+        receiver.extract_message(frame)
+    receiver = CompressionCodec(BSONCodec(), algorithm, max_size=200000)
+    b_msg, rest = receiver.extract_message(frame)
+    assert receiver.loads(b_msg) == {'result': 'x' * 100000}
+    unlimited = CompressionCodec(BSONCodec(), algorithm, max_size=None)
+    assert unlimited.extract_message(frame)[0] == b_msg
+
+
+@pytest.mark.parametrize('protocol_cls', [BSONRpc, JSONRpc])
+def test_compressed_connection(protocol_cls):
+    s1, s2 = socket.socketpair()
+    srv = protocol_cls(s1, EchoServices(), compression='zlib')
+    cli = protocol_cls(s2, compression='zlib', compression_threshold=64)
+    value = {'rows': [{'name': 'row', 'value': i % 10} for i in range(500)]}
+    assert cli.get_peer_proxy().echo(value) == value
+    assert cli.get_peer_proxy().echo('tiny') == 'tiny'
+    stats = cli.compression_stats
+    assert stats['compressed_out'] == 1
+    assert stats['compressed_in'] == 1
+    assert stats['ratio_in'] < 0.5
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+    s3, s4 = socket.socketpair()
+    plain = protocol_cls(s3)
+    assert plain.compression_stats is None
+    plain.close()
+    plain.join(1.0)
+    s4.close()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bsonrpc.concurrent import new_promise, spawn
+from bsonrpc.options import ThreadingModel
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def test_future_set_before_wait(threading_model):
+    future = new_promise(threading_model)
+    assert not future.is_set()
+    future.set(42)
+    assert future.is_set()
+    assert future.wait(0.1) == 42
+    assert future._waiter is None
+
+
+def test_future_wait(threading_model):
+    future = new_promise(threading_model)
+    waiters = [spawn(threading_model, future.wait, 2.0) for _ in range(3)]
+    setter = spawn(threading_model, future.set, 'value')
+    setter.join()
+    for waiter in waiters:
+        waiter.join()
+    assert future.wait() == 'value'
+
+
+def test_future_timeout(threading_model):
+    future = new_promise(threading_model)
+    with pytest.raises(RuntimeError):
+        future.wait(0.01)
+
+
+def test_future_callbacks(threading_model):
+    calls = []
+    future = new_promise(threading_model)
+    future.add_done_callback(lambda v: calls.append(('first', v)))
+    future.set(7)
+    future.add_done_callback(lambda v: calls.append(('second', v)))
+    assert calls == [('first', 7), ('second', 7)]
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+import time
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.concurrent import sleep, spawn
+from bsonrpc.exceptions import ConnectionClosed, ServerDraining
+from bsonrpc.interfaces import request, rpc_request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.server import RpcServer
+
+
+@service_class
+class SlowServices(object):
+
+    def __init__(self, threading_model=ThreadingModel.THREADS):
+        self.threading_model = threading_model
+
+    @request
+    def slow(self, seconds):
+        sleep(self.threading_model, seconds)
+        return 'done'
+
+    @rpc_request
+    def drain_self(self, rpc):
+        try:
+            rpc.drain(1.0)
+        except AttributeError:
+            return 'refused'
+        return 'drained'
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _pair(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    srv = protocol_cls(s1, SlowServices(threading_model),
+                       threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    return srv, cli
+
+
+def test_drain(protocol_cls, threading_model):
+    srv, cli = _pair(protocol_cls, threading_model)
+    results = []
+    caller = spawn(threading_model,
+                   lambda: results.append(cli.invoke_request('slow', 0.3)))
+    for _ in range(100):
+        if srv.dispatcher.in_flight:
+            break
+        sleep(threading_model, 0.01)
+    assert srv.dispatcher.in_flight == 1
+    drainer = spawn(threading_model,
+                    lambda: results.append(srv.drain(2.0)))
+    sleep(threading_model, 0.05)
+    with pytest.raises(ServerDraining):
+        cli.invoke_request('slow', 0)
+    caller.join(2.0)
+    drainer.join(2.0)
+    assert set(results) == set(['done', True])
+    assert srv.is_closed
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_drain_timeout(protocol_cls, threading_model):
+    srv, cli = _pair(protocol_cls, threading_model)
+    errors = []
+
+    def _call():
+        try:
+            cli.invoke_request('slow', 0.5)
+        except ConnectionClosed as e:
+            errors.append(e)
+
+    cli.invoke_notification('nothing')
+    caller = spawn(threading_model, _call)
+    sleep(threading_model, 0.05)
+    started = time.time()
+    assert srv.drain(0.1) is False
+    assert time.time() - started < 0.4
+    assert srv.is_closed
+    caller.join(2.0)
+    assert len(errors) == 1
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_server_stop_drains(protocol_cls):
+    server = RpcServer(('127.0.0.1', 0), SlowServices(), rpc_cls=protocol_cls)
+    server.start()
+    sock = tsocket.create_connection(server.bound_address)
+    cli = protocol_cls(sock)
+    results = []
+    caller = spawn(ThreadingModel.THREADS,
+                   lambda: results.append(cli.invoke_request('slow', 0.3)))
+    time.sleep(0.1)
+    server.stop(2.0)
+    caller.join(2.0)
+    assert results == ['done']
+    cli.join(1.0)
+
+
+def test_drain_not_allowed_in_handler(protocol_cls, threading_model):
+    srv, cli = _pair(protocol_cls, threading_model)
+    assert cli.invoke_request('drain_self') == 'refused'
+    cli.close()
+    srv.join(1.0)
+
+
+def test_server_stop_timeout_is_total(protocol_cls):
+    server = RpcServer(('127.0.0.1', 0), SlowServices(), rpc_cls=protocol_cls)
+    server.start()
+    sock = tsocket.create_connection(server.bound_address)
+    cli = protocol_cls(sock)
+    errors = []
+
+    def _call():
+        try:
+            cli.invoke_request('slow', 1.5)
+        except ConnectionClosed as e:
+            errors.append(e)
+    caller = spawn(ThreadingModel.THREADS, _call)
+    time.sleep(0.1)
+    started = time.time()
+    server.stop(0.3)
+    assert time.time() - started < 0.6
+    caller.join(3.0)
+    assert len(errors) == 1  # Closed before the handler finished.
+    cli.close()
+    cli.join(1.0)
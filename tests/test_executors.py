@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import socket as tsocket
+from concurrent.futures import ThreadPoolExecutor
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.exceptions import BsonRpcError
+from bsonrpc.executors import shutdown_process_pool
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+_executor_threads = ThreadPoolExecutor(2)
+
+
+@service_class
+class CpuServices(object):
+
+    def __init__(self, factor=3):
+        self.factor = factor
+
+    @request(executor='process')
+    def pid(self):
+        return os.getpid()
+
+    @request(executor='process')
+    def sum_of_squares(self, n):
+        return sum(i * i for i in range(n)) * self.factor
+
+    @request(executor='process', cache=True)
+    def cached_pid(self, key):
+        return os.getpid()
+
+    @request(executor='process')
+    def fail(self):
+        raise ValueError('bad input')
+
+    @request(executor=_executor_threads)
+    def in_thread_pool(self, value):
+        return value * 2
+
+    @request
+    def local_pid(self):
+        return os.getpid()
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def teardown_module(module):
+    shutdown_process_pool()
+
+
+def test_process_executor(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    srv = protocol_cls(s1, CpuServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    cli = protocol_cls(s2, threading_model=threading_model)
+    proxy = cli.get_peer_proxy()
+    assert proxy.local_pid() == os.getpid()
+    assert proxy.pid() != os.getpid()
+    assert proxy.sum_of_squares(1000) == 3 * sum(i * i for i in range(1000))
+    first = proxy.cached_pid('a')
+    assert proxy.cached_pid('a') == first
+    with pytest.raises(BsonRpcError) as error:
+        proxy.fail()
+    assert 'bad input' in str(error.value)
+    assert proxy.in_thread_pool(21) == 42
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+    s1.close()
+    s2.close()
+
+
+def test_invalid_executor():
+    with pytest.raises(TypeError):
+        request(executor='gpu')(lambda self: None)
+
+
+def test_services_sent_once_per_worker():
+    from bsonrpc import executors
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(1)
+    services = CpuServices()
+    sent = []
+    submit = pool.submit
+
+    def _submit(fn, *args):
+        sent.append(fn.__name__)
+        return submit(fn, *args)
+    pool.submit = _submit
+    try:
+        for n in (10, 20, 30):
+            assert executors.run_in_executor(
+                pool, ThreadingModel.THREADS, services, 'sum_of_squares',
+                (n,), {}) == 3 * sum(i * i for i in range(n))
+    finally:
+        pool.shutdown()
+    assert sent == ['_call_registered', '_register_and_call',
+                    '_call_registered', '_call_registered']
+
+
+def test_services_objects_of_one_class():
+    connections = []
+    for factor in (1, 2):
+        s1, s2 = tsocket.socketpair()
+        connections.append((JSONRpc(s1, CpuServices(factor)), JSONRpc(s2)))
+    try:
+        for _ in range(3):
+            for factor, (_, cli) in zip((1, 2), connections):
+                assert (cli.invoke_request('sum_of_squares', 10) ==
+                        factor * 285)
+    finally:
+        for srv, cli in connections:
+            cli.close()
+            cli.join(1.0)
+            srv.join(1.0)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import json
+import socket as tsocket
+
+import gevent
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.exceptions import HandshakeError
+from bsonrpc.framing import JSONFramingNone, JSONFramingRFC7464
+from bsonrpc.handshake import MAGIC, choose
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.socket_queue import JSONCodec
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _connect(threading_model, srv_cls, srv_options, cli_cls, cli_options):
+    '''
+    Construct both connectors concurrently: each waits for the other's
+    hello.
+    '''
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    results = {}
+
+    def _server():
+        try:
+            results['srv'] = srv_cls(
+                s1, EchoServices(), threading_model=threading_model,
+                concurrent_request_handling=threading_model, handshake=True,
+                handshake_timeout=2.0, **srv_options)
+        except Exception as e:
+            results['srv'] = e
+
+    if threading_model == ThreadingModel.GEVENT:
+        server = gevent.spawn(_server)
+    else:
+        import threading
+        server = threading.Thread(target=_server)
+        server.start()
+    try:
+        cli = cli_cls(s2, threading_model=threading_model, handshake=True,
+                      handshake_timeout=2.0, **cli_options)
+    except Exception as e:
+        cli = e
+    server.join()
+    return results['srv'], cli
+
+
+def _close(srv, cli):
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_choose():
+    local = {'protocol': 'jsonrpc', 'framings': ['rfc7464', 'none'],
+             'compression': 'lzma', 'accepts': ['zlib'],
+             'features': ['batch', 'stream']}
+    peer = {'protocol': 'jsonrpc', 'framings': ['none', 'rfc7464'],
+            'compression': 'zlib', 'accepts': ['bz2', 'zlib'],
+            'features': ['stream']}
+    assert choose(local, peer) == {
+        'protocol': 'jsonrpc', 'framing': 'rfc7464',
+        'compression_out': None, 'compression_in': 'zlib',
+        'features': ['stream']}
+    with pytest.raises(HandshakeError):
+        choose(local, dict(peer, framings=['netstring']))
+
+
+def test_negotiated_framing(threading_model):
+    srv, cli = _connect(
+        threading_model,
+        JSONRpc, {'handshake_framings': [JSONFramingRFC7464, JSONFramingNone]},
+        JSONRpc, {'framing_cls': JSONFramingNone})
+    assert srv.negotiated == cli.negotiated
+    assert cli.negotiated['framing'] == 'rfc7464'
+    assert cli.framing_cls is JSONFramingRFC7464
+    assert 'batch' in cli.negotiated['features']
+    assert cli.invoke_request('echo', 'hello') == 'hello'
+    assert cli.batch_call([('r', 'echo', ['a'], {}),
+                           ('r', 'echo', ['b'], {})]) == ['a', 'b']
+    _close(srv, cli)
+
+
+def test_negotiated_compression(threading_model):
+    srv, cli = _connect(threading_model, BSONRpc, {},
+                        BSONRpc, {'compression': 'zlib'})
+    assert cli.negotiated['compression_out'] == 'zlib'
+    assert srv.negotiated['compression_in'] == 'zlib'
+    assert srv.negotiated['compression_out'] is None
+    assert cli.invoke_request('echo', 'x' * 10000) == 'x' * 10000
+    assert cli.compression_stats['compressed_out'] == 1
+    assert srv.compression_stats['compressed_in'] == 1
+    assert srv.compression_stats['compressed_out'] == 0
+    _close(srv, cli)
+
+
+def test_protocol_mismatch(threading_model):
+    srv, cli = _connect(threading_model, BSONRpc, {}, JSONRpc, {})
+    assert isinstance(srv, HandshakeError)
+    assert isinstance(cli, HandshakeError)
+
+
+def test_messages_right_after_hello():
+    s1, s2 = tsocket.socketpair()
+    hello = {'version': 1, 'protocol': 'jsonrpc', 'framings': ['none'],
+             'compression': None, 'accepts': [], 'features': []}
+    codec = JSONCodec(JSONFramingNone.extract_message,
+                      JSONFramingNone.into_frame)
+    request_bytes = codec.into_frame(codec.dumps(
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'echo', 'params': ['hi']}))
+    s2.sendall(MAGIC + json.dumps(hello).encode('utf-8') + b'\n' +
+               request_bytes)
+    srv = JSONRpc(s1, EchoServices(), handshake=True)
+    received = b''
+    while not received.endswith(b'}'):
+        received += s2.recv(4096)
+    line, _, response = received.partition(b'\n')
+    assert line.startswith(MAGIC)
+    assert json.loads(response.decode('utf-8'))['result'] == 'hi'
+    s2.close()
+    srv.join(1.0)
+
+
+def test_peer_without_handshake():
+    s1, s2 = tsocket.socketpair()
+    s2.sendall(b'{"jsonrpc": "2.0", "method": "echo"}\n')
+    with pytest.raises(HandshakeError):
+        JSONRpc(s1, EchoServices(), handshake=True)
+    s1.close()
+    s2.close()
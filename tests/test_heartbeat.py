@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+import time
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.concurrent import sleep
+from bsonrpc.exceptions import ConnectionClosed
+from bsonrpc.heartbeat import monitor
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.server import RpcServer
+
+
+@service_class
+class SlowServices(object):
+
+    @request
+    def hang(self, seconds):
+        time.sleep(seconds)
+        return 'late'
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _socket_module(threading_model):
+    if threading_model == ThreadingModel.GEVENT:
+        return gsocket
+    return tsocket
+
+
+def _wait_for(threading_model, condition, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        sleep(threading_model, 0.02)
+    return condition()
+
+
+def test_idle_connection_is_reaped(protocol_cls, threading_model):
+    s1, s2 = _socket_module(threading_model).socketpair()
+    reaped = monitor(threading_model).reaped
+    rpc = protocol_cls(s1, threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       idle_timeout=0.2)
+    silent = s2  # Peer which never answers.
+    assert _wait_for(threading_model, lambda: rpc.is_closed)
+    assert rpc.reaped
+    assert monitor(threading_model).reaped == reaped + 1
+    silent.close()
+
+
+def test_heartbeats_keep_connection_alive(protocol_cls, threading_model):
+    s1, s2 = _socket_module(threading_model).socketpair()
+    pings = monitor(threading_model).pings
+    rpc = protocol_cls(s1, threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       heartbeat_interval=0.05, idle_timeout=0.3)
+    peer = protocol_cls(s2, threading_model=threading_model,
+                        concurrent_request_handling=threading_model)
+    sleep(threading_model, 0.8)
+    assert not rpc.is_closed
+    assert not rpc.reaped
+    assert monitor(threading_model).pings > pings
+    rpc.close()
+    peer.close()
+    rpc.join(1.0)
+    peer.join(1.0)
+
+
+def test_pending_requests_fail_when_closed(protocol_cls):
+    s1, s2 = tsocket.socketpair()
+    srv = protocol_cls(s1, SlowServices(), concurrent_request_handling=None)
+    cli = protocol_cls(s2, idle_timeout=0.2)
+    started = time.time()
+    with pytest.raises(ConnectionClosed):
+        cli.invoke_request('hang', 2.0, timeout=5.0)
+    assert time.time() - started < 1.5
+    assert cli.reaped
+    srv.close()
+    srv.join(3.0)
+
+
+def test_server_counts_reaped(protocol_cls):
+    server = RpcServer(('127.0.0.1', 0), SlowServices(),
+                       rpc_cls=protocol_cls, idle_timeout=0.2)
+    server.start()
+    try:
+        sock = tsocket.create_connection(server.bound_address)
+        assert _wait_for(ThreadingModel.THREADS,
+                         lambda: server.stats()['accepted'] == 1)
+        assert _wait_for(ThreadingModel.THREADS,
+                         lambda: server.stats()['reaped'] == 1)
+        assert sock.recv(1) == b''
+        sock.close()
+    finally:
+        server.stop(1.0)
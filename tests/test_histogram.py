@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import random
+import socket
+
+import pytest
+
+from bsonrpc.histogram import (
+    Histogram, MethodHistograms, bucket_index, bucket_range)
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.rpc import BSONRpc
+
+
+@service_class
+class Services(object):
+
+    @request
+    def spin(self, n):
+        return sum(range(n))
+
+    @request
+    def fail(self):
+        raise ValueError('failed')
+
+
+def test_buckets():
+    previous = -1
+    for micros in list(range(200)) + [10 ** e + d for e in range(3, 10)
+                                      for d in (-1, 0, 1)]:
+        index = bucket_index(micros)
+        low, high = bucket_range(index)
+        assert low <= micros <= high
+        assert high - low <= max(1, micros * 0.032)
+        if micros < 200:
+            assert index >= previous
+            previous = index
+
+
+def test_percentiles():
+    random.seed(1)
+    values = [random.expovariate(1000.0) for _ in range(10000)]
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for percent in (50, 90, 99, 99.9):
+        exact = values[int(round(percent / 100.0 * len(values))) - 1]
+        assert abs(histogram.percentile(percent) - exact) <= \
+            max(2e-6, exact * 0.04)
+    stats = histogram.as_dict()
+    assert stats['count'] == 10000
+    assert stats['max'] == values[-1]
+    assert Histogram().percentile(50) is None
+
+
+def test_merge_and_reset():
+    first = MethodHistograms()
+    second = MethodHistograms()
+    for _ in range(10):
+        first.record('a', 0.001)
+        second.record('a', 0.003)
+        second.record('b', 0.002)
+    merged = first.snapshot().merge(second)
+    assert merged.get('a').count == 20
+    assert merged.get('a').min == 0.001
+    assert merged.get('a').max == 0.003
+    assert merged.methods() == ['a', 'b']
+    assert first.get('a').count == 10  # Snapshot is a copy.
+    snapshot = second.snapshot(reset=True)
+    assert snapshot.get('b').count == 10
+    assert second.get('b') is None
+
+
+def test_connection_latency():
+    s1, s2 = socket.socketpair()
+    srv = BSONRpc(s1, Services())
+    cli = BSONRpc(s2)
+    proxy = cli.get_peer_proxy()
+    for _ in range(20):
+        proxy.spin(10000)
+    try:
+        proxy.fail()
+    except Exception:
+        pass
+    calls = cli.latency_stats()['calls']
+    assert calls.get('spin').count == 20
+    assert calls.get('fail').count == 1
+    handler = srv.latency_stats(reset=True)
+    assert handler['handler_wall'].get('spin').count == 20
+    assert handler['handler_cpu'].get('spin').count == 20
+    assert handler['handler_cpu'].get('spin').total > 0
+    assert srv.latency_stats()['handler_wall'].get('spin') is None
+    assert cli.stats()['latency']['calls']['spin']['count'] == 20
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_no_thread_cpu_time(monkeypatch):
+    from bsonrpc import dispatcher
+    monkeypatch.setattr(dispatcher, 'thread_time', None)
+    s1, s2 = socket.socketpair()
+    srv = BSONRpc(s1, Services())
+    cli = BSONRpc(s2)
+    cli.get_peer_proxy().spin(100)
+    handler = srv.latency_stats()
+    assert handler['handler_wall'].get('spin').count == 1
+    assert handler['handler_cpu'].get('spin') is None
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_rusage_thread_time():
+    from bsonrpc import misc
+    if not hasattr(misc.resource, 'RUSAGE_THREAD'):
+        pytest.skip('No RUSAGE_THREAD on this platform.')
+    started = misc._rusage_thread_time()
+    sum(i * i for i in range(100000))
+    assert misc._rusage_thread_time() > started
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bsonrpc import loadgen
+
+
+@pytest.mark.parametrize('argv', [
+    ['-c', 'bson', '--shape', 'binary', '-j', '2', '-n', '2'],
+    ['-c', 'json', '-b', '5', '-m', 'payload', '--shape', 'dict'],
+    ['-c', 'bson', '-b', '5', '--shape', 'binary'],
+    ['-c', 'msgpack', '-b', '5', '--shape', 'binary'],
+    ['-m', 'sleep', '--sleep', '0.001', '-r', '200', '-j', '4'],
+    ['-t', 'gevent', '-r', '200', '-j', '4'],
+])
+def test_loadgen(argv, capsys):
+    result = loadgen.main(argv + ['-d', '0.3', '-s', '10'])
+    stats = result.as_dict()
+    assert stats['calls'] > 0
+    assert stats['errors'] == 0
+    assert stats['latency']['count'] > 0
+    assert 'throughput' in capsys.readouterr().out
+
+
+def test_open_loop_rate():
+    assert loadgen.main(['-r', '100', '-j', '2', '-d', '0.5',
+                         '--json']).calls == 50
+
+
+def test_invalid_combinations():
+    with pytest.raises(SystemExit):
+        loadgen._parse_args(['-c', 'json', '--shape', 'binary'])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.loopback import loopback_pair
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def test_loopback_rpc(protocol_cls, threading_model):
+    s1, s2 = loopback_pair(threading_model, buffer_limit=1024)
+    srv = protocol_cls(s1, EchoServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    cli = protocol_cls(s2, threading_model=threading_model)
+    proxy = cli.get_peer_proxy()
+    assert proxy.echo(u'hello') == u'hello'
+    big = u'x' * 10000  # Larger than the buffer limit.
+    assert proxy.echo(big) == big
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+    assert srv.is_closed
+    assert cli.is_closed
+
+
+def test_loopback_buffer_limit():
+    s1, s2 = loopback_pair(buffer_limit=10)
+    s1.sendall(b'0123456789')
+    assert s2.buffered == 10
+    sent = threading.Event()
+
+    def _send():
+        s1.sendall(b'abc')
+        sent.set()
+    thr = threading.Thread(target=_send)
+    thr.start()
+    assert not sent.wait(0.1)  # Blocked until the peer receives.
+    assert s2.recv(4096) == b'0123456789'
+    assert sent.wait(1.0)
+    thr.join()
+    assert s2.recv(4096) == b'abc'
+
+
+def test_loopback_shutdown():
+    s1, s2 = loopback_pair()
+    s1.sendall(b'last words')
+    s1.close()
+    assert s2.recv(4096) == b'last words'
+    assert s2.recv(4096) == b''
+    with pytest.raises(IOError):
+        s2.sendall(b'nobody listens')
+
+
+def test_loopback_close_releases_blocked_writer():
+    a, b = loopback_pair(buffer_limit=10)
+    a.sendall(b'0123456789')
+    errors = []
+
+    def _send():
+        try:
+            a.sendall(b'abc')
+        except IOError as e:
+            errors.append(e)
+    thr = threading.Thread(target=_send)
+    thr.daemon = True
+    thr.start()
+    thr.join(0.1)
+    assert thr.is_alive()  # Blocked on the full buffer.
+    a.close()
+    thr.join(1.0)
+    assert not thr.is_alive()
+    assert len(errors) == 1
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+import time
+
+import gevent
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.concurrent import spawn
+from bsonrpc.exceptions import ConnectionClosed
+from bsonrpc.interfaces import (
+    notification, request, rpc_request, service_class)
+from bsonrpc.options import MemoryBudgetAction, ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+
+@service_class
+class SlowServices(object):
+
+    def __init__(self, threading_model):
+        self.noted = 0
+        self._sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+                       else gevent.sleep)
+
+    @request
+    def echo(self, value):
+        return value
+
+    @notification
+    def note(self, value):
+        self._sleep(0.01)
+        self.noted += 1
+
+
+@service_class
+class RelayServices(object):
+
+    def __init__(self, threading_model):
+        self.noted = 0
+        self._sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+                       else gevent.sleep)
+
+    @rpc_request
+    def relay(self, rpc, value, queued):
+        for _ in range(200):
+            if rpc.socket_queue.queue_depth >= queued:
+                break
+            self._sleep(0.01)
+        return rpc.get_peer_proxy(timeout=2.0).echo(value)
+
+    @notification
+    def note(self, value):
+        self.noted += 1
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _pair(protocol_cls, threading_model, **options):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    services = SlowServices(threading_model)
+    srv = protocol_cls(s1, services, threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       **options)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    return services, srv, cli
+
+
+def test_accounting(protocol_cls, threading_model):
+    _, srv, cli = _pair(protocol_cls, threading_model)
+    for _ in range(3):
+        cli.invoke_request('echo', 'x' * 10000)
+    memory = cli.stats()['memory']
+    assert memory['inbound'] == memory['outbound'] == 0
+    assert memory['pending'] == 0
+    assert memory['pending_peak'] == 1
+    assert memory['outbound_peak'] > 10000
+    sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+             else gevent.sleep)
+    # The server counts the response sent after sendall has returned.
+    for _ in range(100):
+        memory = srv.stats()['memory']
+        if memory['total'] == 0:
+            break
+        sleep(0.01)
+    assert memory['inbound_peak'] > 10000
+    assert memory['recv_buffer_peak'] > 10000
+    assert memory['total'] == 0
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+def test_backpressure(protocol_cls, threading_model):
+    services, srv, cli = _pair(protocol_cls, threading_model,
+                               memory_budget=20000)
+    sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+             else gevent.sleep)
+    for _ in range(20):
+        cli.invoke_notification('note', 'x' * 5000)
+    for _ in range(500):
+        if services.noted == 20:
+            break
+        sleep(0.01)
+    assert services.noted == 20
+    # Within the budget, give or take a message and a recv.
+    assert srv.stats()['memory']['inbound_peak'] < 20000 + 5100 + 4096
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
+
+
+@pytest.mark.parametrize('action', [MemoryBudgetAction.BACKPRESSURE,
+                                    MemoryBudgetAction.CLOSE])
+def test_budget_exceeded(protocol_cls, threading_model, action):
+    _, srv, cli = _pair(protocol_cls, threading_model, memory_budget=10000,
+                        memory_budget_action=action)
+    assert cli.invoke_request('echo', 'x' * 100) == 'x' * 100
+    with pytest.raises(ConnectionClosed):
+        cli.invoke_request('echo', 'x' * 50000)
+    srv.join(1.0)
+    assert srv.is_closed
+    cli.join(1.0)
+
+
+def test_response_bypasses_budget(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    services = RelayServices(threading_model)
+    # The dispatcher runs relay() itself and cannot take the response.
+    srv = protocol_cls(s1, services, threading_model=threading_model,
+                       concurrent_request_handling=None,
+                       memory_budget=2000)
+    cli = protocol_cls(s2, SlowServices(threading_model),
+                       threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    results = []
+    caller = spawn(threading_model, lambda: results.append(
+        cli.get_peer_proxy(timeout=5.0).relay('x' * 100, 3)))
+    sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+             else gevent.sleep)
+    for _ in range(100):
+        if srv.dispatcher.in_flight:
+            break
+        sleep(0.01)
+    # Queued behind relay(), they take the server over the budget.
+    for _ in range(3):
+        cli.invoke_notification('note', 'y' * 800)
+    caller.join(5.0)
+    assert results == ['x' * 100]
+    assert srv.stats()['memory']['inbound_peak'] > 2000
+    for _ in range(100):
+        if services.noted == 3:
+            break
+        sleep(0.01)
+    assert services.noted == 3
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
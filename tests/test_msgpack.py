@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import msgpack
+import pytest
+
+from bsonrpc.definitions import SplicedMessage
+from bsonrpc.exceptions import DecodingError
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import MsgPackRpc
+from bsonrpc.socket_queue import MsgPackCodec
+
+
+@service_class
+class BinaryServices(object):
+
+    @request
+    def reverse(self, data):
+        return data[::-1]
+
+
+def test_frames():
+    codec = MsgPackCodec()
+    msg = {u'msgpackrpc': u'2.0', u'id': 1, u'result': b'\x00\xff'}
+    framed = codec.into_frame(codec.dumps(msg))
+    assert codec.extract_message(framed[:3]) == (None, framed[:3])
+    assert codec.extract_message(framed[:-1]) == (None, framed[:-1])
+    raw, rest = codec.extract_message(framed + framed[:2])
+    assert rest == framed[:2]
+    assert codec.loads(raw) == msg
+    # Pipelined messages are extracted without copying the rest.
+    rest = framed * 3
+    for _ in range(3):
+        raw, rest = codec.extract_message(rest)
+        assert isinstance(rest, memoryview)
+        assert codec.loads(raw) == msg
+    assert codec.extract_message(rest) == (None, b'')
+    with pytest.raises(DecodingError):
+        codec.loads(b'\xc1')
+
+
+def test_spliced():
+    codec = MsgPackCodec()
+    fragment = codec.fragment({u'result': [1, u'two', b'3']})
+    assert fragment.count == 1
+    for head in ({u'id': 7}, dict((u'k%d' % i, i) for i in range(20))):
+        spliced = SplicedMessage(head, fragment)
+        expected = dict(head, result=[1, u'two', b'3'])
+        assert codec.loads(codec.dumps(spliced)) == expected
+        assert (codec.loads(codec.dumps([spliced, {u'id': 8}])) ==
+                [expected, {u'id': 8}])
+
+
+def test_custom_codec_implementation():
+    class Implementation(object):
+
+        def __init__(self):
+            self.calls = 0
+
+        def dumps(self, msg):
+            self.calls += 1
+            return msgpack.packb(msg, use_bin_type=True)
+
+        def loads(self, raw):
+            self.calls += 1
+            return msgpack.unpackb(raw, raw=False)
+
+    impl = Implementation()
+    s1, s2 = socket.socketpair()
+    srv = MsgPackRpc(s1, BinaryServices(), custom_codec_implementation=impl)
+    cli = MsgPackRpc(s2, custom_codec_implementation=impl)
+    assert cli.invoke_request('reverse', b'\x01\x02\x03') == b'\x03\x02\x01'
+    assert impl.calls == 4
+    cli.close()
+    srv.close()
+
+
+def test_binary_roundtrip():
+    s1, s2 = socket.socketpair()
+    srv = MsgPackRpc(s1, BinaryServices(),
+                     concurrent_request_handling=ThreadingModel.THREADS)
+    cli = MsgPackRpc(s2)
+    data = bytes(bytearray(range(256))) * 300
+    assert cli.invoke_request('reverse', data) == data[::-1]
+    assert cli.invoke_request('reverse', u'äbc') == u'cbä'
+    cli.close()
+    srv.close()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bsonrpc.exceptions import BsonRpcError
+from bsonrpc.pending import PendingTable
+
+
+def test_register_resolve():
+    table = PendingTable(size=2)
+    ids = [table.register(n) for n in range(5)]
+    assert len(set(ids)) == 5
+    assert len(table) == 5
+    assert [table.get(msg_id) for msg_id in ids] == list(range(5))
+    assert table.get('not-from-table') is None
+    assert table.get(-1) is None
+    table.unregister(ids[0])
+    assert table.get(ids[0]) is None
+    assert len(table) == 4
+
+
+def test_slot_reuse_generation():
+    table = PendingTable(size=1)
+    first = table.register('first')
+    table.unregister(first)
+    second = table.register('second')
+    assert second != first
+    assert first % PendingTable.STRIDE == second % PendingTable.STRIDE
+    # Late response to the expired request:
+    assert table.get(first) is None
+    assert table.get(second) == 'second'
+    table.unregister(first)
+    assert table.get(second) == 'second'
+
+
+def test_table_full():
+    table = PendingTable(size=4)
+    table.STRIDE = 8
+    for n in range(8):
+        table.register(n)
+    with pytest.raises(BsonRpcError):
+        table.register(8)
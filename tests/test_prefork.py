@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.prefork import PreforkServer
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+
+@service_class
+class PidServices(object):
+
+    @request
+    def pid(self):
+        return os.getpid()
+
+    @request
+    def slow(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def _call_pid(rpc_cls, address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    rpc = rpc_cls(sock)
+    try:
+        return rpc.get_peer_proxy().pid()
+    finally:
+        rpc.close()
+        rpc.join(1.0)
+
+
+@pytest.mark.parametrize('reuse_port', [True, False])
+def test_prefork_tcp(reuse_port):
+    server = PreforkServer(('127.0.0.1', 0), PidServices, BSONRpc,
+                           workers=2, reuse_port=reuse_port,
+                           restart_delay=0.1, stats_interval=0.05).start()
+    try:
+        pids = server.pids
+        assert len(pids) == 2
+        address = server.bound_address
+        for _ in range(6):
+            assert _call_pid(BSONRpc, address) in pids
+        assert _wait_for(lambda: server.stats()['accepted'] == 6)
+        stats = server.stats()
+        assert stats['workers'] == 2
+        assert len(stats['per_worker']) == 2
+        # A dead worker is restarted and its stats are kept.
+        os.kill(pids[0], signal.SIGKILL)
+        assert _wait_for(lambda: (len(server.pids) == 2 and
+                                  pids[0] not in server.pids))
+        assert server.stats()['restarts'] == 1
+        assert server.stats()['accepted'] == 6
+        assert _call_pid(BSONRpc, address) in server.pids
+    finally:
+        server.stop(timeout=2.0)
+    assert server.pids == []
+
+
+def test_prefork_unix_shared_listener():
+    path = os.path.join(tempfile.mkdtemp(), 'rpc.sock')
+    server = PreforkServer(path, PidServices(), JSONRpc, workers=2,
+                           stats_interval=0.05).start()
+    try:
+        assert not server.reuse_port
+        for _ in range(4):
+            assert _call_pid(JSONRpc, path) in server.pids
+        assert _wait_for(lambda: server.stats()['accepted'] == 4)
+    finally:
+        server.stop(timeout=2.0)
+    assert not os.path.exists(path)
+
+
+def test_prefork_stop_drains_within_timeout():
+    server = PreforkServer(('127.0.0.1', 0), PidServices, JSONRpc,
+                           workers=1, stats_interval=0.05).start()
+    sock = socket.create_connection(server.bound_address)
+    rpc = JSONRpc(sock)
+    results = []
+    caller = threading.Thread(
+        target=lambda: results.append(rpc.get_peer_proxy().slow(1.0)))
+    caller.start()
+    assert _wait_for(lambda: server.stats()['busy'] == 1)
+    # The worker drains for the parent's timeout, not a fixed one.
+    server.stop(timeout=3.0)
+    caller.join(1.0)
+    assert results == [1.0]
+    assert server.pids == []
+    rpc.close()
+    rpc.join(1.0)
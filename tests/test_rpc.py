@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 import pytest
 import six
+import threading
+import time
 
 import socket as tsocket
 import gevent.socket as gsocket
 
-from bsonrpc.exceptions import ServerError
+from bsonrpc.cache import ResultCache, default_cache_key
+from bsonrpc.exceptions import ResponseTimeout, ServerError
 from bsonrpc.interfaces import (
     notification, request, rpc_request, service_class)
 from bsonrpc.options import ThreadingModel
-from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.rpc import BSONRpc, JSONRpc, MsgPackRpc
 from bsonrpc.util import BatchBuilder
 
 
@@ -21,7 +24,7 @@ def _socketpair(tmodel):
 
 
 @pytest.fixture(scope='module',
-                params=[BSONRpc, JSONRpc])
+                params=[BSONRpc, JSONRpc, MsgPackRpc])
 def protocol_cls(request):
     return request.param
 
@@ -80,6 +83,12 @@ class ServerServices(object):
         rpc.close_after_response()
         return a * b
 
+    @request
+    def sleeper(self, timeout):
+        self.history.append(('sleeper', timeout))
+        time.sleep(timeout)
+        return timeout
+
     @notification
     def yaman(self, neva_sei_neva):
         self.history.append(('yaman', neva_sei_neva))
@@ -103,6 +112,31 @@ class ServerServices(object):
         raise Exception('Thriller!')
 
 
+@service_class
+class CachedServices(object):
+
+    def __init__(self):
+        self.history = []
+
+    @request(cache=True)
+    def slow_square(self, x):
+        self.history.append(('slow_square', x))
+        time.sleep(0.1)
+        return x * x
+
+    @rpc_request(cache=ResultCache(ttl=0.2, key=lambda name, **kw: name))
+    def greeting(self, rpc, name, punctuation='!'):
+        self.history.append(('greeting', name, punctuation))
+        return u'Hello ' + name + punctuation
+
+    @request(cache=True)
+    def fail_once(self, txt):
+        self.history.append(('fail_once', txt))
+        if len(self.history) == 1:
+            raise Exception('Not this time!')
+        return txt
+
+
 @service_class
 class ClientServices(object):
 
@@ -161,8 +195,29 @@ def test_server_disconnect(protocol_cls, options):
     assert srv_ser.history == [('server_disconnect', 12, 34)]
 
 
-def test_batch(options):
-    srv_ser, cli_ser, srv, cli = _basix(JSONRpc, options)
+def test_peer_proxy_stubs(protocol_cls, options):
+    srv_ser, cli_ser, srv, cli = _basix(protocol_cls, options)
+    proxy = cli.get_peer_proxy(timeout=0.5)
+    assert proxy.swapper is proxy.swapper
+    assert proxy.n.yaman is proxy.n.yaman
+    assert proxy.swapper('abc') == 'cba'
+    assert proxy.sleeper(timeout=0.1) == 0.1
+    with pytest.raises(ResponseTimeout):
+        proxy.sleeper(timeout=0.8)
+    assert proxy.sleeper(timeout=0.6, ______timeout=1.0) == 0.6
+    proxy.n.yaman('note')
+    cli.close()
+    srv.join()
+    assert srv_ser.history == [('swapper', 'abc'),
+                               ('sleeper', 0.1),
+                               ('sleeper', 0.8),
+                               ('sleeper', 0.6),
+                               ('yaman', 'note')]
+
+
+@pytest.mark.parametrize('batch_cls', [BSONRpc, JSONRpc, MsgPackRpc])
+def test_batch(batch_cls, options):
+    srv_ser, cli_ser, srv, cli = _basix(batch_cls, options)
     b1 = BatchBuilder(['complicated', 'swapper'], ['yaman'])
     b1.yaman('note')
     b1.swapper('firstie')
@@ -201,3 +256,130 @@ def test_exception(protocol_cls, options):
     with pytest.raises(ServerError):
         proxy.panicker('Michael Jackson')
     cli.close()
+
+
+def _clear_caches(services_cls):
+    for method in services_cls._request_handlers.values():
+        method._result_cache.clear()
+
+
+def test_cached_request(protocol_cls, options):
+    _clear_caches(CachedServices)
+    s1, s2 = _socketpair(options['threading_model'])
+    services = CachedServices()
+    srv = protocol_cls(s1, services, **options)
+    cli = protocol_cls(s2, **options)
+    proxy = cli.get_peer_proxy()
+    with pytest.raises(ServerError):
+        proxy.fail_once('abc')
+    assert proxy.fail_once('abc') == 'abc'
+    assert proxy.fail_once('abc') == 'abc'
+    assert proxy.greeting(name=u'World') == u'Hello World!'
+    assert proxy.greeting(name=u'World', punctuation=u'?') == u'Hello World!'
+    time.sleep(0.3)
+    assert proxy.greeting(name=u'World', punctuation=u'?') == u'Hello World?'
+    assert services.history == [('fail_once', 'abc'),
+                                ('fail_once', 'abc'),
+                                ('greeting', 'World', '!'),
+                                ('greeting', 'World', '?')]
+    cli.close()
+    srv.join()
+
+
+def test_default_cache_key():
+    assert default_cache_key(1) == default_cache_key(1)
+    assert len(set([default_cache_key(1), default_cache_key(True),
+                    default_cache_key(1.0)])) == 3
+    assert default_cache_key(a=[1, {'b': 2}]) == default_cache_key(
+        a=[1, {'b': 2}])
+    assert default_cache_key(a=[1]) != default_cache_key(a=[True])
+    assert default_cache_key({'b': 1}) != default_cache_key({'b': 1.0})
+
+
+def test_cache_fetch_base_exception():
+    cache = ResultCache()
+
+    class Killed(BaseException):
+        pass
+
+    def _killed():
+        raise Killed()
+
+    with pytest.raises(Killed):
+        cache.fetch('key', _killed, ThreadingModel.THREADS)
+    assert cache.fetch('key', lambda: 'value',
+                       ThreadingModel.THREADS) == 'value'
+    assert cache.misses == 2
+
+
+def test_cached_request_single_flight():
+    options = {'threading_model': ThreadingModel.THREADS}
+    _clear_caches(CachedServices)
+    services = CachedServices()
+    clients = []
+    servers = []
+    for _ in range(2):
+        s1, s2 = _socketpair(ThreadingModel.THREADS)
+        servers.append(JSONRpc(s1, services, **options))
+        clients.append(JSONRpc(s2, **options))
+    results = []
+
+    def _call(cli):
+        results.append(cli.invoke_request('slow_square', 12))
+
+    threads = [threading.Thread(target=_call, args=(cli,))
+               for cli in clients * 3]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    assert results == [144] * 6
+    assert services.history == [('slow_square', 12)]
+    for cli in clients:
+        cli.close()
+    for srv in servers:
+        srv.join()
+
+
+def test_concurrent_callers(protocol_cls, options):
+    if options['threading_model'] == ThreadingModel.GEVENT:
+        from gevent import spawn as start_caller
+    else:
+        def start_caller(fn, *args):
+            thr = threading.Thread(target=fn, args=args)
+            thr.start()
+            return thr
+    srv_ser, cli_ser, srv, cli = _basix(protocol_cls, options)
+    proxy = cli.get_peer_proxy()
+    results = []
+
+    def _caller(idx):
+        for n in range(20):
+            txt = u'%d-%d' % (idx, n)
+            results.append(proxy.swapper(txt) == txt[::-1])
+
+    callers = [start_caller(_caller, idx) for idx in range(20)]
+    for caller in callers:
+        caller.join()
+    assert len(results) == 400 and all(results)
+    assert len(cli.dispatcher._pending) == 0
+    cli.close()
+    srv.join()
+
+
+def test_custom_id_generator(protocol_cls, options):
+    def _ids():
+        n = 0
+        while True:
+            n += 1
+            yield u'custom-%d' % n
+
+    s1, s2 = _socketpair(options['threading_model'])
+    srv = protocol_cls(s1, ServerServices(), **options)
+    cli = protocol_cls(s2, id_generator=_ids(), **options)
+    proxy = cli.get_peer_proxy()
+    assert proxy.swapper('abc') == 'cba'
+    assert proxy.swapper('def') == 'fed'
+    assert six.next(cli.id_generator) == u'custom-3'
+    cli.close()
+    srv.join()
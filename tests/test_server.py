@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import socket as tsocket
+import tempfile
+import time
+
+import gevent.socket as gsocket
+
+from bsonrpc.concurrent import HandlerPool
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.server import RpcServer
+
+
+@service_class
+class CountingServices(object):
+
+    instances = 0
+
+    def __init__(self):
+        CountingServices.instances += 1
+        self.calls = 0
+
+    @request
+    def count(self):
+        self.calls += 1
+        return self.calls
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def _connect(address, tmodel):
+    socket_module = tsocket if tmodel == ThreadingModel.THREADS else gsocket
+    family = (socket_module.AF_UNIX if isinstance(address, str)
+              else socket_module.AF_INET)
+    sock = socket_module.socket(family, socket_module.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def _wait_for(condition, timeout=2.0, tmodel=ThreadingModel.THREADS):
+    sleep = time.sleep
+    if tmodel == ThreadingModel.GEVENT:
+        import gevent
+        sleep = gevent.sleep
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        sleep(0.01)
+    return condition()
+
+
+def test_tcp_server_factory(protocol_cls, threading_model):
+    CountingServices.instances = 0
+    server = RpcServer(('127.0.0.1', 0), CountingServices, protocol_cls,
+                       threading_model=threading_model).start()
+    address = server.bound_address
+    clients = [protocol_cls(_connect(address, threading_model),
+                            threading_model=threading_model)
+               for _ in range(3)]
+    for cli in clients:
+        proxy = cli.get_peer_proxy()
+        assert proxy.count() == 1
+        assert proxy.count() == 2
+    assert CountingServices.instances == 3
+    assert server.connection_count == 3
+    stats = server.stats()
+    assert stats['accepted'] == 3
+    assert stats['rejected'] == 0
+    clients[0].close()
+    assert _wait_for(lambda: server.connection_count == 2,
+                     tmodel=threading_model)
+    server.stop(timeout=2.0)
+    for cli in clients:
+        cli.join(1.0)
+        assert cli.is_closed
+
+
+def test_unix_server_shared_services():
+    path = os.path.join(tempfile.mkdtemp(), 'rpc.sock')
+    services = CountingServices()
+    server = RpcServer(path, services, max_connections=1).start()
+    first = JSONRpc(_connect(path, ThreadingModel.THREADS))
+    assert first.get_peer_proxy().count() == 1
+    second = JSONRpc(_connect(path, ThreadingModel.THREADS))
+    second.join(2.0)
+    assert second.is_closed
+    assert server.stats()['rejected'] == 1
+    assert first.get_peer_proxy().count() == 2
+    server.stop(timeout=2.0)
+    assert not os.path.exists(path)
+    first.join(1.0)
+    assert first.is_closed
+
+
+def test_silent_client_does_not_block_accept(threading_model):
+    server = RpcServer(('127.0.0.1', 0), CountingServices, JSONRpc,
+                       max_connections=2, threading_model=threading_model,
+                       handshake=True, handshake_timeout=3.0).start()
+    address = server.bound_address
+    silent = _connect(address, threading_model)  # Never sends its hello.
+    assert _wait_for(lambda: server.stats()['handshaking'] == 1,
+                     tmodel=threading_model)
+    started = time.time()
+    cli = JSONRpc(_connect(address, threading_model),
+                  threading_model=threading_model, handshake=True,
+                  handshake_timeout=3.0)
+    assert cli.get_peer_proxy().count() == 1
+    assert time.time() - started < 1.0
+    # The silent client counts towards max_connections.
+    third = _connect(address, threading_model)
+    assert third.recv(10) == b''
+    assert server.stats()['rejected'] == 1
+    server.stop(timeout=2.0)
+    assert time.time() - started < 2.0
+    assert _wait_for(lambda: server.stats()['handshaking'] == 0,
+                     tmodel=threading_model)
+    cli.join(1.0)
+    assert cli.is_closed
+    for sock in (silent, third):
+        sock.close()
+
+
+def test_handler_pool():
+    pool = HandlerPool(2)
+    results = []
+    tasks = [pool.spawn(results.append, n) for n in range(10)]
+    for task in tasks:
+        task.join(1.0)
+        assert not task.is_alive()
+    assert sorted(results) == list(range(10))
+    assert pool.stats()['workers'] <= 2
+    pool.shutdown(1.0)
+    assert pool.stats()['workers'] == 0
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+import time
+
+import gevent
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.slowlog import SlowRequestLog, param_sizes
+
+
+@service_class
+class SlowServices(object):
+
+    def __init__(self, threading_model):
+        self._sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+                       else gevent.sleep)
+
+    @request
+    def nap(self, seconds, payload):
+        self._sleep(seconds)
+        return len(payload)
+
+    @request
+    def spin(self):
+        return sum(range(10000))
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def test_param_sizes():
+    assert param_sizes(('abc', 5, [1, 2]), {}) == [3, None, 2]
+    assert param_sizes((), {'data': b'xy'}) == {'data': 2}
+
+
+def test_ring_is_bounded():
+    log = SlowRequestLog(threshold=0.0, size=2)
+    for msg_id in range(3):
+        log.finish({'method': 'm', 'id': msg_id}, log.start((), {}))
+    assert [entry['id'] for entry in log.entries(clear=True)] == [1, 2]
+    assert log.entries() == []
+
+
+def test_slow_requests(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    srv = protocol_cls(s1, SlowServices(threading_model),
+                       threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       slow_request_threshold=0.05,
+                       slow_request_profile_every=2)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    assert cli.invoke_request('nap', 0.1, 'x' * 100) == 100
+    assert cli.invoke_request('spin') == sum(range(10000))
+    assert cli.invoke_request('nap', 0.0, '') == 0
+    entries = srv.slow_requests()
+    assert [(e['method'], e['slow']) for e in entries] == [('nap', True),
+                                                           ('spin', False)]
+    slow, profiled = entries
+    assert slow['param_sizes'] == [None, 100]
+    assert slow['execution'] >= 0.1
+    assert slow['queue_wait'] >= 0.0
+    assert slow['profile'] is None
+    assert any('spin' in frame['function'] for frame in profiled['profile'])
+    # Disabled by default.
+    assert cli.slow_requests() == []
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
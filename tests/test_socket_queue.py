@@ -4,6 +4,7 @@ import pytest
 import socket as tsocket
 import gevent.socket as gsocket
 
+from bsonrpc.definitions import SplicedMessage
 from bsonrpc.exceptions import DecodingError, EncodingError, FramingError
 from bsonrpc.framing import (
     JSONFramingNetstring, JSONFramingNone, JSONFramingRFC7464)
@@ -71,6 +72,26 @@ def test_codec_exceptions(codec):
         codec.dumps(impossible)
 
 
+def test_codec_spliced(codec):
+    head = {'jsonrpc': '2.0', 'id': 'msg-1'}
+    fragment = codec.fragment({'method': 'foo', 'params': [1, 2, 3, 4, 5]})
+    assert codec.loads(codec.dumps(SplicedMessage(head, fragment))) == msg1
+    assert codec.loads(codec.dumps(SplicedMessage({}, fragment))) == {
+        'method': 'foo', 'params': [1, 2, 3, 4, 5]}
+
+
+def test_codec_batch(codec):
+    fragment = codec.fragment({'result': [1, 2]})
+    batch = [msg1, SplicedMessage({'id': 'msg-2'}, fragment), msg2]
+    expected = [msg1, {'id': 'msg-2', 'result': [1, 2]}, msg2]
+    assert codec.loads(codec.dumps(batch)) == expected
+    assert codec.loads(codec.dumps([msg1, msg2])) == [msg1, msg2]
+    if isinstance(codec, BSONCodec):
+        # Not an envelope: other members besides 'batch'.
+        assert codec.loads(codec.dumps({'batch': [], 'id': 1})) == {
+            'batch': [], 'id': 1}
+
+
 @pytest.fixture(scope='module',
                 params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
 def threading_model(request):
@@ -103,6 +124,23 @@ def test_socket_queue_basics(codec, threading_model):
     sq2.join()
 
 
+def test_socket_queue_sent_stats(threading_model):
+    s1, s2 = _socketpair(threading_model)
+    codec = BSONCodec()
+    sq1 = SocketQueue(s1, codec, threading_model)
+    sq2 = SocketQueue(s2, codec, threading_model)
+    assert sq1.put(msg1)
+    sq1._lock.acquire()  # Another thread sending.
+    assert not sq1.put(msg2, block=False)
+    sq1._lock.release()
+    assert sq1.stats.messages_out == 1
+    assert sq1.stats.bytes_out == len(codec.dumps(msg1))
+    assert sq2.get() == msg1
+    sq1.close()
+    sq1.join()
+    sq2.join()
+
+
 def test_socket_queue_garbage(codec, threading_model):
     s1, s2 = _socketpair(threading_model)
     sq = SocketQueue(s2, codec, threading_model)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+import time
+
+import gevent
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.attachments import Attachment
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.stages import STAGES, StageTimer
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+    @request
+    def size(self, data):
+        return len(data)
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def test_sampling():
+    timer = StageTimer(sample_every=2, max_samples=2)
+    for msg_id in range(6):
+        timing = {}
+        timer.record('handler', 0.001, timing)
+        timer.finish({'method': 'm', 'id': msg_id}, timing)
+    assert timer.samples() == [{'handler': 0.001, 'method': 'm', 'id': 3},
+                               {'handler': 0.001, 'method': 'm', 'id': 5}]
+    assert timer.histograms(reset=True).get('handler').count == 6
+    assert timer.histograms().get('handler') is None
+
+
+def test_stage_stats(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    srv = protocol_cls(s1, EchoServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       stage_timing=True, stage_sample_every=1)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    for _ in range(5):
+        cli.invoke_request('echo', 'x' * 10000)
+    assert cli.invoke_request('size', Attachment(b'y' * 5000)) == 5000
+    # Sending is recorded after the response has been sent.
+    sleep = (time.sleep if threading_model == ThreadingModel.THREADS
+             else gevent.sleep)
+    for _ in range(100):
+        if len(srv.stage_samples()) == 6:
+            break
+        sleep(0.01)
+    stages = srv.stage_stats()
+    assert stages.methods() == sorted(STAGES)
+    for stage in STAGES:
+        assert stages.get(stage).count == 6
+    samples = srv.stage_samples()
+    assert [sample['method'] for sample in samples] == ['echo'] * 5 + ['size']
+    assert set(samples[-1]) == set(STAGES) | set(['method', 'id'])
+    assert srv.stats()['stages']['handler']['count'] == 6
+    # Not recorded without the option.
+    assert cli.stage_stats() is None
+    assert cli.stage_samples() == []
+    assert cli.stats()['stages'] is None
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
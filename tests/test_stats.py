@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.exceptions import MethodNotFound
+from bsonrpc.interfaces import notification, request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+from bsonrpc.stats import ConnectionStats, size_histogram
+
+
+@service_class
+class EchoServices(object):
+
+    @request
+    def echo(self, value):
+        return value
+
+    @notification
+    def note(self):
+        pass
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+def test_size_histogram():
+    stats = ConnectionStats()
+    stats.sent({}, 1, 0.0)
+    stats.sent({}, 100, 0.0)
+    stats.sent({}, 128, 0.0)
+    stats.sent({'error': {'code': -32601}}, 129, 0.0)
+    assert size_histogram(stats.sizes_out) == {'1': 1, '128': 2, '256': 1}
+    assert stats.errors_out == {'-32601': 1}
+    assert stats.as_dict()['bytes_out'] == 358
+
+
+def test_connection_stats(protocol_cls, threading_model):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    srv = protocol_cls(s1, EchoServices(), threading_model=threading_model,
+                       concurrent_request_handling=threading_model,
+                       introspection=True)
+    cli = protocol_cls(s2, threading_model=threading_model,
+                       concurrent_request_handling=threading_model)
+    for _ in range(5):
+        cli.invoke_request('echo', 'x' * 1000)
+    cli.invoke_notification('note')
+    with pytest.raises(MethodNotFound):
+        cli.invoke_request('missing')
+    stats = cli.stats()
+    assert stats['messages_out'] == 7
+    assert stats['messages_in'] == 6
+    assert stats['bytes_out'] > 5000
+    assert stats['errors_in'] == {'-32601': 1}
+    assert stats['pending'] == 0
+    assert stats['recvs'] >= 1
+    assert stats['frames_per_recv'] > 0
+    assert stats['encode_time'] > 0
+    assert sum(stats['sizes_in'].values()) == 6
+    assert stats['compression'] is None
+    # Introspection over the connection.
+    remote = cli.invoke_request('rpc.stats')
+    assert remote['messages_in'] == 8
+    assert remote['errors_out'] == {'-32601': 1}
+    assert remote['in_flight'] == 1
+    assert remote['in_flight_peak'] >= 1
+    # Not answered without the option.
+    with pytest.raises(MethodNotFound):
+        srv.invoke_request('rpc.stats')
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import socket as tsocket
+
+import gevent.socket as gsocket
+import pytest
+
+from bsonrpc.concurrent import sleep
+from bsonrpc.exceptions import BsonRpcError
+from bsonrpc.interfaces import request, service_class
+from bsonrpc.options import ThreadingModel
+from bsonrpc.rpc import BSONRpc, JSONRpc
+
+
+@service_class
+class StreamingServices(object):
+
+    def __init__(self):
+        self.produced = 0
+        self.closed = False
+
+    @request
+    def count(self, n):
+        try:
+            for i in range(n):
+                self.produced = i + 1
+                yield {'i': i}
+        finally:
+            self.closed = True
+
+    @request
+    def items(self):
+        return [1, 2, 3]
+
+    @request
+    def single(self):
+        return 'one'
+
+    @request
+    def broken(self):
+        yield 1
+        raise ValueError('stream broke')
+
+
+@pytest.fixture(scope='module',
+                params=[BSONRpc, JSONRpc])
+def protocol_cls(request):
+    return request.param
+
+
+@pytest.fixture(scope='module',
+                params=[ThreadingModel.THREADS, ThreadingModel.GEVENT])
+def threading_model(request):
+    return request.param
+
+
+@pytest.mark.parametrize('concurrent', [True, False])
+def test_streams(protocol_cls, threading_model, concurrent):
+    socket_module = (tsocket if threading_model == ThreadingModel.THREADS
+                     else gsocket)
+    s1, s2 = socket_module.socketpair()
+    services = StreamingServices()
+    srv = protocol_cls(
+        s1, services, threading_model=threading_model,
+        concurrent_request_handling=threading_model if concurrent else None)
+    cli = protocol_cls(s2, threading_model=threading_model, stream_window=4)
+    stream = cli.invoke_stream('count', 100)
+    assert [item['i'] for item in stream] == list(range(100))
+    assert stream.count == 100
+    assert services.closed
+    # Non-streaming call of a generator handler gets a list.
+    assert cli.invoke_request('count', 3) == [{'i': 0}, {'i': 1}, {'i': 2}]
+    assert list(cli.invoke_stream('items')) == [1, 2, 3]
+    assert list(cli.invoke_stream('single')) == ['one']
+    # Producer stops when the window is full.
+    services.closed = False
+    with cli.invoke_stream('count', 1000) as stream:
+        assert next(stream) == {'i': 0}
+        sleep(threading_model, 0.1)
+        assert services.produced <= 5
+    for _ in range(100):
+        if services.closed:
+            break
+        sleep(threading_model, 0.01)
+    assert services.closed  # Cancelled.
+    stream = cli.invoke_stream('broken')
+    assert next(stream) == 1
+    with pytest.raises(BsonRpcError) as error:
+        next(stream)
+    assert 'stream broke' in str(error.value)
+    cli.close()
+    cli.join(1.0)
+    srv.join(1.0)